@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Host-side benchmark of the main loop rule checking, comparing the legacy
+per-iteration rule scan against the compiled rules in upython/rules.py
+
+Reports rule checks per second and bytes allocated per main loop iteration
+(500ms tick, with a new sensor sample every 20 ticks as in main())
+
+Usage:
+    python3 bench_rules.py [iterations]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "upython"))
+
+import rules
+
+# Don't measure logging, only the rule checking
+rules.log_info = lambda msg, *args, **kwargs: None
+
+# Same as main() in upython/lessmostat.py, 10s between samples, 500ms ticks
+TICKS_PER_SAMPLE = 10000 // 500
+
+def turn_ac_heat(ac_heat, on):
+    g_state[ac_heat] = "on" if on else "off"
+
+def turn_fan(on):
+    g_state["fan"] = "on" if on else "off"
+
+def legacy_check_rules(state, temp, humid):
+    """
+    Rule check as it was done inline in the main() loop before the rules module
+    """
+    config = state["config"]
+    hi_threshold_decidegs = config["hi_threshold_decidegs"]
+    lo_threshold_decidegs = config["lo_threshold_decidegs"]
+    hi_threshold_decihumids = config["hi_threshold_decihumids"]
+    lo_threshold_decihumids = config["lo_threshold_decihumids"]
+    ac_rules = config["ac_rules"]
+    heat_rules = config["heat_rules"]
+    for rule in ac_rules + heat_rules:
+        rule_state = rule["state"]
+        rule_temp = rule.get("temp", None)
+        heating = rule in heat_rules
+        cooling = not heating
+        turn_ac_heat_on_count = 0
+        turn_ac_heat_off_count = 0
+        ac_heat_state = state["ac" if cooling else "heat"]
+        ac_heat = "ac" if cooling else "heat"
+        if (rule_temp is not None):
+            under_threshold = (temp*10 <= rule_temp*10 - lo_threshold_decidegs)
+            over_threshold = (temp*10 >= rule_temp*10 + hi_threshold_decidegs)
+            if ((ac_heat_state != "on") and (rule_state == "on") and
+                ((heating and under_threshold) or (cooling and over_threshold))):
+                turn_ac_heat_on_count += 1
+
+            elif ((ac_heat_state != "off") and (rule_state == "on") and
+                ((heating and over_threshold) or (cooling and under_threshold))):
+                turn_ac_heat_off_count += 1
+
+        rule_humid = rule.get("humid", None)
+        if (rule_humid is not None):
+            under_threshold = (humid*10 <= rule_humid*10 - lo_threshold_decihumids)
+            over_threshold = (humid*10 >= rule_humid*10 + hi_threshold_decihumids)
+
+            if ((ac_heat_state != "on") and (rule_state == "on") and over_threshold):
+                turn_ac_heat_on_count +=1
+
+            elif ((ac_heat_state != "off") and (rule_state == "on") and under_threshold):
+                turn_ac_heat_off_count += 1
+
+        if (turn_ac_heat_on_count >= 1):
+            turn_ac_heat(ac_heat, True)
+
+        elif (turn_ac_heat_off_count == 2):
+            turn_ac_heat(ac_heat, False)
+
+    fan_rules = config["fan_rules"]
+    ac_or_heat_on = ((state["heat"] == "on") or (state["ac"] == "on"))
+    for rule in fan_rules:
+        rule_state = rule["state"]
+        if ((rule_state == "on") and (state["fan"] != "on")):
+            turn_fan(True)
+
+        elif ((rule_state == "auto") and ((state["fan"] == "on") != ac_or_heat_on)):
+            turn_fan(ac_or_heat_on)
+
+g_state = {
+    "ac" : "off",
+    "heat" : "off",
+    "fan" : "off",
+    "config" : {
+        "ac_rules" : [ { "state" : "on", "temp" : 25, "humid" : 56 } ],
+        "heat_rules" : [ { "state" : "on", "temp" : 11, "humid" : 70 } ],
+        "fan_rules" : [ { "state" : "auto" } ],
+        "lo_threshold_decidegs" : 4,
+        "hi_threshold_decidegs" : 4,
+        "lo_threshold_decihumids" : 20,
+        "hi_threshold_decihumids" : 40,
+    }
+}
+
+# Temperature and humidity inside the hysteresis band, so no relays are
+# switched and only the steady state checking cost is measured
+temp = 23.4
+humid = 51.2
+
+def legacy_tick(i):
+    legacy_check_rules(g_state, temp, humid)
+
+def compiled_tick(i):
+    if ((i % TICKS_PER_SAMPLE) == 0):
+        rules.rules_set_sensor(temp, humid)
+    rules.rules_check(g_state, turn_ac_heat, turn_fan)
+
+def bench(name, tick, iterations):
+    # Warm up, this also compiles the rules
+    for i in range(TICKS_PER_SAMPLE):
+        tick(i)
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        tick(i)
+    elapsed = time.perf_counter() - start
+
+    # Measure the bytes allocated per iteration as the peak traced memory over
+    # the memory traced before the iteration, ie temporary allocations that
+    # are freed right away (and cause GC pressure on the device) are counted
+    allocated = 0
+    tracemalloc.start()
+    alloc_iterations = min(iterations, 10 * TICKS_PER_SAMPLE)
+    for i in range(alloc_iterations):
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        tick(i)
+        _, peak = tracemalloc.get_traced_memory()
+        allocated += peak - before
+    tracemalloc.stop()
+
+    print("%-10s %12.0f ticks/s %10.2f bytes/tick" % (
+        name, iterations / elapsed, float(allocated) / alloc_iterations
+    ))
+
+def main():
+    iterations = 200000
+    if (len(sys.argv) > 1):
+        iterations = int(sys.argv[1])
+
+    print("%d ticks, new sensor sample every %d ticks" % (iterations, TICKS_PER_SAMPLE))
+    bench("legacy", legacy_tick, iterations)
+    bench("compiled", compiled_tick, iterations)
+
+if (__name__ == "__main__"):
+    main()
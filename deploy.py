@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 Copyright (C) 2021 Antonio Tejada
 
@@ -19,21 +19,32 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 Script to deploy python files to a micropython device exposed via webrepl,
 restart it, and display the console output forever
 
+    python3 deploy.py deploy|forever|fleet|watch [force] [py] [socket] [module.py ...]
+
+The WebReplClient class and the deploy functions can also be used from other
+scripts, many devices can be driven concurrently from the same event loop. See
+simulator/webrepl.py for a fake WebREPL device to run them against
+
 See https://forum.micropython.org/viewtopic.php?t=3124
 See https://github.com/micropython/webrepl/blob/master/webrepl_cli.py
 See https://github.com/Hermann-SW/webrepl/blob/master/webrepl_client.py
 """
+import asyncio
+import binascii
+import contextvars
+import hashlib
+import json
+import logging
+import logging.handlers
 import os
+import re
 import struct
+import subprocess
 import sys
 import time
 
-# This is websocket-client-0.59.0
-# See https://github.com/websocket-client/websocket-client.git
-# See https://websocket-client.readthedocs.io/en/latest/
-import websocket
-
-import logging
+# See https://websockets.readthedocs.io/
+import websockets
 
 import python_minifier as pymin
 
@@ -42,288 +53,977 @@ WEBREPL_PUT_FILE = 1
 WEBREPL_GET_FILE = 2
 WEBREPL_GET_VER  = 3
 
-# Shorter versions of BINARY and TEXT opcode types
-WS_BINARY_DATA = websocket.ABNF.OPCODE_BINARY
-WS_TEXT_DATA = websocket.ABNF.OPCODE_TEXT
-
-WS_DATA_TYPE_NAME = {
-    WS_BINARY_DATA : "binary",
-    WS_TEXT_DATA: "text" 
-}
-
-# WebSocket connection timeout, necessary because otherwise a recv would wait
-# forever without responding to ctrl+c, and using ctrl+break would leave the
-# webrepl in a bad state requiring to manually reboot the device. 1 is known to
-# be too short for the timeout when receiving < 13KB file, longer timeouts will
-# cause ctrl+c to have more latency when displaying the console forever
+# WebSocket receive timeout, necessary because otherwise a recv would wait
+# forever when the device doesn't respond (eg after sending too large chunks).
+# 1 is known to be too short for the timeout when receiving < 13KB file
 WS_TIMEOUT_SECS = 5
 
-def send_req(ws, op, sz=0, fname=b""):
-    rec = struct.pack(WEBREPL_REQ_S, b"WA", op, 0, 0, sz, len(fname), fname)
-    logger.debug("sending %d: %r" % (len(rec), rec))
-    ws.send(rec, WS_BINARY_DATA)
-    
-def recv_binary_data(ws):
+# Chunk size bounds and retries of WebReplClient.put_file
+SEND_MIN_CHUNK_SIZE = 256
+SEND_MAX_CHUNK_SIZE = 4096
+SEND_RETRIES = 3
+# Acks in flight when receiving a file, see WebReplClient.get_file
+RECV_WINDOW = 4
+# Expected size of the log segments other than the newest, see recv_log. The
+# device starts a new segment when a write would go over 8 KB and the writes
+# are at most the 1 KB log buffer, see upython/logging.py
+LOG_SEGMENT_SIZE_HINT = 7 * 1024
+
+class WebReplError(Exception):
+    pass
+
+class WebReplClient:
     """
-    Return the next binary data, ignore and skip any text data
+    WebREPL session with a device
+
+    Text messages are the console, binary messages the file and version
+    requests, see https://github.com/micropython/webrepl/blob/master/webrepl_cli.py
     """
-    while (True):
-        op, data = ws.recv_data()
+    def __init__(self, url, password, timeout_secs=WS_TIMEOUT_SECS):
+        self.url = url
+        self.password = password
+        self.timeout_secs = timeout_secs
+        self.ws = None
+        # See put_file
+        self.send_chunk_size = SEND_MIN_CHUNK_SIZE
+        self.send_max_chunk_size = SEND_MAX_CHUNK_SIZE
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        logger.info("Connecting WebSocket")
+        # The WebREPL doesn't answer pings nor supports compression
+        self.ws = await asyncio.wait_for(websockets.connect(self.url, ping_interval=None,
+            compression=None, max_size=None), self.timeout_secs)
+        await self.login()
+
+    async def close(self):
+        if (self.ws is not None):
+            logger.info("Closing WebSocket")
+            ws = self.ws
+            self.ws = None
+            await ws.close()
+
+    async def reconnect(self):
+        """
+        Close the connection and connect again, the WebREPL doesn't allow
+        concurrent connections and needs to be reconnected after a failed
+        transfer anyway
+        """
+        logger.info("Reconnecting WebSocket")
+        await self.close()
+        # Give time to the device to notice the old connection was closed
+        await asyncio.sleep(1)
+        await self.connect()
+
+    async def recv(self, timeout_secs=None):
+        """
+        @return the next message, str for console text, bytes for binary data
+        """
+        return await asyncio.wait_for(self.ws.recv(),
+            self.timeout_secs if (timeout_secs is None) else timeout_secs)
+
+    async def recv_binary(self):
+        """
+        Return the next binary data, ignore and skip any text data
+        """
+        while (True):
+            data = await self.recv()
+            logger.debug("data %d %r" % (len(data), data))
+            if (isinstance(data, bytes)):
+                return data
+
+    async def recv_text(self, timeout_secs=None):
+        """
+        Return the next console text, ignore and skip any binary data
+        """
+        while (True):
+            data = await self.recv(timeout_secs)
+            if (isinstance(data, str)):
+                return data
+
+    async def send_text(self, s):
+        await self.ws.send(s)
+
+    async def login(self):
+        """
+        Wait for login prompt and send password
+        """
+        logger.info("Waiting for login prompt")
+        while (True):
+            prompt = await self.recv_text()
+            if (prompt == "Password: "):
+                break
+            logger.info("Ignoring %r while waiting for login prompt" % prompt)
+        logger.info("Sending password")
+        await self.send_text("%s\r" % self.password)
+
+    async def send_req(self, op, sz=0, fname=""):
+        fname = fname.encode("utf-8")
+        rec = struct.pack(WEBREPL_REQ_S, b"WA", op, 0, 0, sz, len(fname), fname)
+        logger.debug("sending %d: %r" % (len(rec), rec))
+        await self.ws.send(rec)
+
+    async def recv_status(self):
+        """
+        Receive the status response to a file request and raise if not
+        successful
+        """
+        data = await self.recv_binary()
+        sig, code = struct.unpack("<2sH", data)
+        if not ((sig == b"WB") and (code == 0)):
+            raise WebReplError("Unexpected sig %r or code %d" % (sig, code))
+
+    async def get_ver(self):
+        """
+        @return (major, minor, micro) firmware version tuple
+        """
+        await self.send_req(WEBREPL_GET_VER)
+        data = await self.recv_binary()
+
+        return struct.unpack("<BBB", data)
+
+    async def get_file(self, filename, size=None):
+        """
+        Request and receive a file from the device
+
+        The device sends a chunk for every ack, up to RECV_WINDOW acks are kept
+        in flight so the chunks are not sent one round trip at a time. Acks
+        sent after the end of the file are taken by the device as the start of
+        the next request, so more than one ack is only sent for the chunks
+        expected given the file size, and the connection is reopened if the
+        file turned out to be smaller
+
+        The device closes the connection when the file doesn't exist, in that
+        case the connection is reopened and WebReplError raised
+
+        @param size expected file size, eg the size of the local copy from a
+               previous transfer, None if unknown in which case the chunks are
+               received one round trip at a time
+        @return the file contents
+        """
+        logger.info("get_file %r", filename)
+        start = time.time()
+        try:
+            await self.send_req(WEBREPL_GET_FILE, fname=filename)
+            await self.recv_status()
+
+            await self.ws.send(b"\0")
+            acks = 1
+            chunks = 0
+            data = bytearray()
+            while (True):
+                chunk = await self.recv_binary()
+                (sz,) = struct.unpack("<H", chunk[:2])
+
+                if (sz != len(chunk) - 2):
+                    raise WebReplError("Data vs. size mismatch %d vs. %d" % (len(chunk)-2, sz))
+
+                chunks += 1
+                if (sz == 0):
+                    logger.debug("completed get_file")
+                    break
+
+                if (len(data) == 0):
+                    chunk_size = sz
+                data += chunk[2:]
+
+                # Chunks known to exist, including the empty one that ends the
+                # file. The device sends full chunks except for the last one
+                max_acks = chunks + 1
+                if (size is not None):
+                    max_acks = max(max_acks, (size + chunk_size - 1) // chunk_size + 1)
+                while ((acks < max_acks) and (acks - chunks < RECV_WINDOW)):
+                    await self.ws.send(b"\0")
+                    acks += 1
+
+            await self.recv_status()
+
+            if (acks > chunks):
+                logger.info("%s is smaller than the expected %d bytes, re-connecting to discard %d acks",
+                    filename, size, acks - chunks)
+                await self.reconnect()
+
+        except websockets.exceptions.ConnectionClosed:
+            logger.info("Unable to get %s, re-connecting" % filename)
+            await self.reconnect()
+            raise WebReplError("Unable to get %s" % filename)
+
+        elapsed = time.time() - start
+        logger.info("Received %s %d bytes in %2.3fs %2.2f KB/s", filename, len(data), elapsed,
+            len(data) / 1024.0 / max(elapsed, 0.001))
+
+        return bytes(data)
+
+    async def put_file_chunks(self, filename, data, chunk_size):
+        """
+        Send the file contents in chunk_size websocket frames
+
+        There are no acks for the chunks in the protocol, the chunks are sent
+        back to back and the device only responds once the whole file has been
+        written
+        """
+        await self.send_req(WEBREPL_PUT_FILE, len(data), filename)
+        await self.recv_status()
+
+        for i in range(0, len(data), chunk_size):
+            await self.ws.send(data[i:i+chunk_size])
+
+        await self.recv_status()
+
+    async def put_file(self, filename, data):
+        """
+        Send a file to the device
+
+        The chunk size starts at SEND_MIN_CHUNK_SIZE and doubles after every
+        file sent, until a transfer fails (large chunks are known to make the
+        device time out), then the chunk size is halved and capped for the rest
+        of the session and the file is sent again, up to SEND_RETRIES times.
+        The protocol has no way of resending a single chunk, so the unit of
+        retry is the file
+        """
+        for attempt in range(SEND_RETRIES):
+            chunk_size = self.send_chunk_size
+            start = time.time()
+            try:
+                await self.put_file_chunks(filename, data, chunk_size)
+
+            except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed, WebReplError) as e:
+                if (attempt == SEND_RETRIES - 1):
+                    raise
+                logger.warning("Unable to send %s with %d byte chunks, retrying: %r", filename, chunk_size, e)
+                self.send_max_chunk_size = max(SEND_MIN_CHUNK_SIZE, chunk_size // 2)
+                self.send_chunk_size = self.send_max_chunk_size
+                await self.reconnect()
+                continue
+
+            elapsed = time.time() - start
+            logger.info("Sent %s %d bytes in %2.3fs %2.2f KB/s with %d byte chunks", filename, len(data),
+                elapsed, len(data) / 1024.0 / max(elapsed, 0.001), chunk_size)
+            self.send_chunk_size = min(self.send_max_chunk_size, chunk_size * 2)
+            break
 
-        logger.debug("op %d data %d %r" % (op, len(data), data))
+    async def recv_until(self, marker, timeout_secs):
+        """
+        Receive console text until the marker is found
+
+        @return all the text received
+        """
+        data = ""
+        start = time.time()
+        while (marker not in data):
+            if ((time.time() - start) > timeout_secs):
+                raise WebReplError("Timed out waiting for %r, got %r" % (marker, data[-80:]))
+            try:
+                data += await self.recv_text()
+            except asyncio.TimeoutError:
+                pass
 
-        if (op == WS_BINARY_DATA):
-            return data
+        return data
 
-def recv_ver(ws):
-    send_req(ws, WEBREPL_GET_VER)
-    data = recv_binary_data(ws)
-    data = struct.unpack("<BBB", data)
+    async def exec(self, code, timeout_secs=30):
+        """
+        Execute the code in the device's raw REPL, the REPL must be idle (eg
+        the program interrupted with ctrl+c)
 
-    return data
+        @return the stdout output of the code
+        """
+        # Enter the raw REPL with ctrl+a, the code is not echoed back there
+        await self.send_text("\r\x01")
+        await self.recv_until("raw REPL; CTRL-B to exit\r\n>", self.timeout_secs)
 
-def recv_file(ws, filename, out_filename):
-    """
-    Request and receive a file from the device
-    """
-    logger.info("recv_file %r %r", filename, out_filename)
-    send_req(ws, WEBREPL_GET_FILE, fname=filename)
+        # Send in chunks, the webrepl input buffer is small
+        for i in range(0, len(code), 256):
+            await self.send_text(code[i:i+256])
+        # Execute with ctrl+d, the output is "OK<stdout>\x04<stderr>\x04>"
+        await self.send_text("\x04")
+        data = await self.recv_until("\x04>", timeout_secs)
+        data = data[data.find("OK") + 2:]
+        out, err = data.split("\x04")[:2]
+
+        # Back to the normal REPL with ctrl+b
+        await self.send_text("\x02")
 
-    data = recv_binary_data(ws)
-    sig, code = struct.unpack("<2sH", data)
-    if not ((sig == "WB") and (code == 0)):
-        raise Exception("Unexpected sig %s or code %d", sig, code) 
+        if (err != ""):
+            raise WebReplError("Error executing in raw REPL: %s" % err)
 
-    ws.send("\0", WS_BINARY_DATA)
+        return out
 
-    with open(out_filename, "wb") as f:
+    async def console(self):
+        """
+        Yield the console text as it's received, forever
+        """
         while (True):
-            data = recv_binary_data(ws)
-            (sz,) = struct.unpack("<H", data[:2])
+            try:
+                yield await self.recv_text()
+            except asyncio.TimeoutError:
+                pass
 
-            if (sz != len(data) - 2):
-                raise Exception("Data vs. size mismatch %d vs. %d", len(data)-2, sz)
+async def safe_get_file(client, filename, out_filepath, size=None):
+    """
+    @param size expected file size, None to use the size of the existing
+           out_filepath, see WebReplClient.get_file
+    @return True if the file was received into out_filepath
+    """
+    if ((size is None) and os.path.exists(out_filepath)):
+        size = os.path.getsize(out_filepath)
+    try:
+        data = await client.get_file(filename, size)
+    except WebReplError:
+        logger.exception("Unable to recv %s" % filename)
+        return False
 
-            data = data[2:]
-            f.write(data)
-        
-            if (sz == 0):
-                logger.debug("completed get_file")
+    with open(out_filepath, "wb") as f:
+        f.write(data)
+
+    return True
+
+async def recv_log(client, device):
+    """
+    Receive the log segments listed in the device's log index that haven't
+    been received yet, and concatenate all the received segments into the
+    device's log_filepath
+
+    The segments are kept in the device's log_dirpath, the newest segment in
+    the index is always received since the device is still appending to it.
+    See upython/logging.py
+    """
+    log_dirpath = device["log_dirpath"]
+    if (not os.path.exists(log_dirpath)):
+        os.makedirs(log_dirpath)
+
+    index_filename = log_filename + ".idx"
+    if (not await safe_get_file(client, index_filename, os.path.join(log_dirpath, index_filename))):
+        return
+
+    with open(os.path.join(log_dirpath, index_filename), "r") as f:
+        seqs = [int(l.split(" ", 1)[0]) for l in f if (l.strip() != "")]
+
+    for seq in seqs:
+        segment_filename = "%s.%d" % (log_filename, seq)
+        segment_filepath = os.path.join(log_dirpath, segment_filename)
+        if ((seq == seqs[-1]) or (not os.path.exists(segment_filepath))):
+            # The newest segment only grows since the last time it was
+            # received, the older ones are full
+            size = None if (seq == seqs[-1]) else LOG_SEGMENT_SIZE_HINT
+            if (not await safe_get_file(client, segment_filename, segment_filepath, size)):
+                # Don't leave a partial segment that would be skipped next time
+                if (os.path.exists(segment_filepath)):
+                    os.remove(segment_filepath)
+        else:
+            logger.info("Skipping already received %s", segment_filename)
+
+    concatenate_log(device)
+
+def concatenate_log(device):
+    """
+    Concatenate all the segments received so far into the device's
+    log_filepath, including the ones already deleted in the device
+    """
+    log_dirpath = device["log_dirpath"]
+    prefix = log_filename + "."
+    local_seqs = sorted([int(filename[len(prefix):]) for filename in os.listdir(log_dirpath)
+        if (filename.startswith(prefix) and filename[len(prefix):].isdigit())])
+    with open(device["log_filepath"], "wb") as f:
+        for seq in local_seqs:
+            with open(os.path.join(log_dirpath, "%s.%d" % (log_filename, seq)), "rb") as f_segment:
+                f.write(f_segment.read())
+
+# Helper run on the device to print the log segments from the given segment
+# and offset on, base64 encoded. The output is
+#   S <seq> <size> <offset>
+# for each segment, followed by
+#   D <seq> <base64 data>
+# lines with the segment data from the offset. If the last segment in the
+# index is older than the given one (eg the device's flash was erased), all
+# the segments are printed
+LOG_TAIL_HELPER = """
+import os, ubinascii
+def _tail(name, last_seq, last_offset):
+    seqs = [int(l.split(" ", 1)[0]) for l in open(name + ".idx") if l.strip()]
+    if (len(seqs) > 0) and (seqs[-1] < last_seq):
+        last_seq, last_offset = -1, 0
+    for seq in seqs:
+        if seq < last_seq:
+            continue
+        fn = name + "." + str(seq)
+        try:
+            size = os.stat(fn)[6]
+        except OSError:
+            continue
+        offset = last_offset if ((seq == last_seq) and (last_offset <= size)) else 0
+        print("S", seq, size, offset)
+        f = open(fn, "rb")
+        f.seek(offset)
+        while True:
+            b = f.read(384)
+            if not b:
                 break
-                
-            else:
-                ws.send("\0", WS_BINARY_DATA)
+            print("D", seq, ubinascii.b2a_base64(b).decode().strip())
+        f.close()
+"""
 
-    data = recv_binary_data(ws)
-    sig, code = struct.unpack("<2sH", data)
-    if not ((sig == "WB") and (code == 0)):
-        raise Exception("Unexpected sig %s or code %d", sig, code)
+async def sync_log(client, device):
+    """
+    Receive the log data added since the last sync and append it to the local
+    segments, see LOG_TAIL_HELPER. This is much faster than receiving whole
+    segments with recv_log but needs the REPL to be idle
+
+    The last synced segment and offset are kept in the device's
+    log_sync_filepath
+    """
+    log_dirpath = device["log_dirpath"]
+    log_sync_filepath = device["log_sync_filepath"]
+    if (not os.path.exists(log_dirpath)):
+        os.makedirs(log_dirpath)
 
-def safe_recv_file(ws, url, password, filename, out_filename):
-    # The remote will close and this will throw an exception if the log
-    # file doesn't exist, trap and reconnect
+    sync = { "seq" : -1, "offset" : 0 }
     try:
-        recv_file(ws, filename, out_filename)
-    except websocket._exceptions.WebSocketConnectionClosedException as e:
-        logger.exception("Unable to recv %s, re-connecting" % filename)
-        logger.info("Connecting WebSocket")
-        ws.connect(url,timeout=WS_TIMEOUT_SECS)
-        send_login(ws, password)
+        with open(log_sync_filepath, "r") as f:
+            sync = json.load(f)
+    except:
+        logger.info("No log sync state in %s, syncing the whole log", log_sync_filepath)
+
+    # Sync everything again if the local copy doesn't match the state
+    segment_filepath = os.path.join(log_dirpath, "%s.%d" % (log_filename, sync["seq"]))
+    if ((sync["seq"] >= 0) and
+        ((not os.path.exists(segment_filepath)) or (os.path.getsize(segment_filepath) != sync["offset"]))):
+        logger.warning("Local log doesn't match log sync state %r, syncing the whole log", sync)
+        sync = { "seq" : -1, "offset" : 0 }
+
+    logger.info("Syncing log from segment %d offset %d", sync["seq"], sync["offset"])
+    start = time.time()
+    out = await client.exec(LOG_TAIL_HELPER + "_tail(%r, %d, %d)\n" % (log_filename, sync["seq"], sync["offset"]))
+
+    f = None
+    received = 0
+    try:
+        for l in out.splitlines():
+            fields = l.strip().split(" ")
+            if (fields[0] == "S"):
+                seq, size, offset = [int(field) for field in fields[1:]]
+                if (f is not None):
+                    f.close()
+                segment_filepath = os.path.join(log_dirpath, "%s.%d" % (log_filename, seq))
+                f = open(segment_filepath, "r+b" if ((offset > 0) and os.path.exists(segment_filepath)) else "wb")
+                f.seek(offset)
+                f.truncate()
+                sync = { "seq" : seq, "offset" : offset }
+
+            elif (fields[0] == "D"):
+                data = binascii.a2b_base64(fields[2])
+                f.write(data)
+                received += len(data)
+                sync["offset"] += len(data)
+
+    finally:
+        if (f is not None):
+            f.close()
+        with open(log_sync_filepath, "w") as f:
+            json.dump(sync, f)
+
+    logger.info("Synced %d log bytes in %2.3fs, now at segment %d offset %d",
+        received, time.time() - start, sync["seq"], sync["offset"])
 
-def send_file(ws, filepath, out_filename=None):
+    concatenate_log(device)
+
+async def send_file(client, filepath, out_filename=None):
     """
-    Send a file to the device
+    Send a local file to the device, see WebReplClient.put_file
     """
     logger.info("send_file %r %r", filepath, out_filename)
     if (out_filename is None):
         out_filename = os.path.basename(filepath)
 
-    sz = os.path.getsize(filepath)
-    send_req(ws, WEBREPL_PUT_FILE, sz, out_filename)
-    
-    data = recv_binary_data(ws)
-    sig, code = struct.unpack("<2sH", data)
-    if not ((sig == "WB") and (code == 0)):
-        raise Exception("Unexpected sig %s or code %d", sig, code) 
-
     with open(filepath, "rb") as f:
-        while True:
-            # Sending 1024 chunks is known to make micropython timeout
-            # sometimes, use 512
-            buf = f.read(512)
-            if (buf == ""):
-                break
-            logger.debug("Sending %d %r" %(len(buf), buf))
-            ws.send(buf, WS_BINARY_DATA)
-    
-    data = recv_binary_data(ws)
-    sig, code = struct.unpack("<2sH", data)
-    if not ((sig == "WB") and (code == 0)):
-        raise Exception("Unexpected sig %s or code %d", sig, code) 
-
-def send_login(ws, password):
-    """
-    Wait for login prompt and send password
-    """
-    logger.info("Waiting for login prompt")
-    while (True):
-        prompt = ws.recv()
-        if (prompt == "Password: "):
-            break
-        logger.info("Ignoring %r while waiting for login prompt" % prompt)
-    logger.info("Sending password")
-    ws.send("%s\r" % password)
+        data = f.read()
+
+    await client.put_file(out_filename, data)
+
+# Host of the device being handled by the current task, see DeviceLogFilter
+current_host = contextvars.ContextVar("current_host", default="-")
+
+class DeviceLogFilter(logging.Filter):
+    """
+    Add the host of the device being handled by the current task to the log
+    records, so the interleaved output of a fleet deploy can be told apart
+    """
+    def filter(self, record):
+        record.host = current_host.get()
+        return True
 
 def setup_logger(logger):
-    logging_format = "%(asctime).23s %(levelname)s:%(filename)s(%(lineno)d):[%(thread)d] %(funcName)s: %(message)s"
+    logging_format = "%(asctime).23s %(levelname)s:%(filename)s(%(lineno)d): %(host)s %(funcName)s: %(message)s"
 
     logger_handler = logging.StreamHandler()
     logger_handler.setFormatter(logging.Formatter(logging_format))
-    logger.addHandler(logger_handler) 
+    logger_handler.addFilter(DeviceLogFilter())
+    logger.addHandler(logger_handler)
 
     return logger
 
-modules = ["config.py", "lessmostat.py", "logging.py", "main.py", "mqtt.py", "syncedtime.py", "umqtt_simple.py"]
-log_filename = "lessmostat.log"
-log_filepath = os.path.join("_out", log_filename)
-cfg_filename = "lessmostat.cfg"
-cfg_filepath = os.path.join("upython", cfg_filename)
+def create_device(host, password, log_filepath=None, cfg_filepath=None):
+    """
+    @param log_filepath file to concatenate the received log segments into,
+           None to use one in the device's log directory
+    @param cfg_filepath config file to send after the modules, None to leave
+           the device's config alone
+    """
+    # Log segments received from the device, see recv_log and sync_log
+    log_dirpath = os.path.join("_out", "log", host)
+
+    return {
+        "host" : host,
+        "password" : password,
+        "url" : "ws://%s:8266/" % host,
+        "log_dirpath" : log_dirpath,
+        "log_sync_filepath" : os.path.join(log_dirpath, "sync.json"),
+        "log_filepath" : log_filepath if (log_filepath is not None) else os.path.join(log_dirpath, log_filename),
+        "cfg_filepath" : cfg_filepath,
+        # Local copy of the device's manifest, see send_changed_files
+        "manifest_filepath" : os.path.join(log_dirpath, manifest_filename),
+    }
+
+def read_inventory(inventory_filepath):
+    """
+    Read the fleet inventory, one "host password" line per device, empty lines
+    and lines starting with # are ignored.
 
-logger = logging.getLogger(__name__)
-setup_logger(logger)
-log_level = logging.DEBUG
-log_level = logging.INFO
-logger.setLevel(log_level)
-
-websocket.enableTrace(log_level == logging.DEBUG)
-# XXX This doesn't seem to do anything, the important timeout is the one passed
-#     in with the connection
-websocket.setdefaulttimeout(5)
-
-# host_password.txt a two line file with the host name in the first line and the
-# password in the second
-with open(os.path.join("_out", "host_password.txt"), "r") as f:
-    host, password = [l.strip() for l in f.readlines()]
-    url = "ws://%s:8266/" % host
-
-logger.info("read host and password for host %s", host)
-
-deploy = "deploy" in sys.argv[1:]
-forever = "forever" in sys.argv[1:]
-
-if (not (deploy or forever)):
-    print "One of deploy or forever must be passed as argument!"
-    raise Exception("Missing parameter") 
-
-logger.info("Deleting log file %s", log_filepath)
-try:
-    os.remove(log_filepath)
-except:
-    logger.info("Can't remove log file %s", log_filepath)
-
-if (deploy):
-    ws = websocket.WebSocket()
-    logger.info("Connecting WebSocket")
-    ws.connect(url,timeout=WS_TIMEOUT_SECS)
+    Each device is sent its own upython/lessmostat.<host>.cfg if it exists,
+    otherwise the device's config is not modified, since the devices in a
+    fleet will normally have different MQTT topics
 
-    try:
-        send_login(ws, password)
+    @return list of devices, see create_device
+    """
+    devices = []
+    with open(inventory_filepath, "r") as f:
+        for l in f:
+            l = l.strip()
+            if ((l == "") or l.startswith("#")):
+                continue
+            host, password = l.split(None, 1)
+            cfg_filepath = os.path.join("upython", "lessmostat.%s.cfg" % host)
+            if (not os.path.exists(cfg_filepath)):
+                cfg_filepath = None
+            devices.append(create_device(host, password, cfg_filepath=cfg_filepath))
+
+    return devices
+
+def file_digest(filepath):
+    with open(filepath, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
 
-        ver = recv_ver(ws)
-        logger.info("version %d.%d.%d" % ver)
+def prepare_modules(modules):
+    """
+    Minify the modules, the minified files are cached in min_dirpath by source
+    digest so unchanged sources are not minified again
 
-        if (len(sys.argv) > 2):
-            modules = sys.argv[2:]
-
-        mini_size = 0
-        maxi_size = 0
-        
-        for filename in modules:
-            filepath = os.path.join("upython", filename)
-            
-            # It's not clear minifying helps with out of memory errors, but at
-            # the very least fits more files on disk
-
-            # The minifier is Python 2.x but the micropyton files are Python
-            # 3.x, this causes problems in these two files, where some Python 3
-            # code is converted to Python 2.x (print statement, bytes vs. str),
-            # so don't minify them
-            minify = filename not in ["logging.py", "umqtt_simple.py"]
-
-            if (filepath.endswith(".py") and minify):
-                try:
-                    min_filepath = os.path.join("_out", filename)
+    @return list of (filename, filepath, digest) tuples of the files to send to
+            the device, filename is the name on the device and digest the sha1
+            of the file's contents
+    """
+    if (not os.path.exists(min_dirpath)):
+        os.makedirs(min_dirpath)
+
+    files = []
+    mini_size = 0
+    maxi_size = 0
+
+    for filename in modules:
+        filepath = os.path.join("upython", filename)
+
+        # It's not clear minifying helps with out of memory errors, but at
+        # the very least fits more files on disk
+        if (filepath.endswith(".py")):
+            try:
+                with open(filepath, "r") as f:
+                    s = f.read()
+                min_filepath = os.path.join(min_dirpath, "%s.py" % hashlib.sha1(s.encode("utf-8")).hexdigest())
+                if (os.path.exists(min_filepath)):
+                    logger.info("Using cached minified %s", min_filepath)
+                    with open(min_filepath, "r") as f:
+                        s_min = f.read()
+
+                else:
                     logger.info("Minifying %s to %s", filepath, min_filepath)
-                    with open(filepath, "r") as f:
-                        s = f.read()
                     s_min = pymin.minify(s, filename=filename, remove_literal_statements=True)
-                    with open(min_filepath, "w") as f:
+                    # Write to a temporary file and rename so an interrupted
+                    # write doesn't leave a truncated file in the cache
+                    with open(min_filepath + ".tmp", "w") as f:
                         f.write(s_min)
+                    os.rename(min_filepath + ".tmp", min_filepath)
+
+                mini_size += len(s_min)
+                maxi_size += len(s)
+                logger.info("%d to %d %2.3f%%, total %d to %d %2.3f%%",
+                    len(s), len(s_min), len(s) * 100.0 / len(s_min),
+                    maxi_size, mini_size, maxi_size * 100.0 / mini_size
+                )
+
+                filepath = min_filepath
+            except:
+                logger.exception("Unable to minify %s", filepath)
+
+        files.append((filename, filepath, file_digest(filepath)))
+
+    return files
+
+def compile_modules(files):
+    """
+    Cross-compile the modules to .mpy bytecode with mpy-cross, so the device
+    doesn't need to compile them at import time, which takes time and, more
+    importantly, heap. The compiled files are cached in mpy_dirpath by source
+    and mpy-cross version digest
+
+    main.py is not compiled since only main.py is run at boot
+
+    @param files the prepare_modules files, used for the modules that are not
+           compiled
+    @return (mpy_version, files) tuple with the .mpy version and a list like
+            prepare_modules's with the compiled files, None if mpy-cross is not
+            available
+    """
+    try:
+        mpy_cross_version = subprocess.check_output([mpy_cross_filepath, "--version"]).strip()
+    except:
+        logger.warning("Unable to run %s, deploying .py files", mpy_cross_filepath)
+        return None
+
+    logger.info("Using %s", mpy_cross_version.decode("utf-8"))
+    if (not os.path.exists(mpy_dirpath)):
+        os.makedirs(mpy_dirpath)
+
+    mpy_version = None
+    mpy_files = []
+    for filename, filepath, digest in files:
+        if ((not filename.endswith(".py")) or (filename == "main.py")):
+            mpy_files.append((filename, filepath, digest))
+            continue
+
+        src_filepath = os.path.join("upython", filename)
+        h = hashlib.sha1(mpy_cross_version)
+        with open(src_filepath, "rb") as f:
+            h.update(f.read())
+        mpy_filepath = os.path.join(mpy_dirpath, "%s.mpy" % h.hexdigest())
+        if (os.path.exists(mpy_filepath)):
+            logger.info("Using cached compiled %s", mpy_filepath)
+
+        else:
+            logger.info("Compiling %s to %s", src_filepath, mpy_filepath)
+            # Use the module filename as source name for the tracebacks.
+            # Compile errors are not trapped, there's no point in deploying
+            # a module that doesn't compile
+            subprocess.check_call([mpy_cross_filepath] + mpy_cross_args +
+                ["-s", filename, "-o", mpy_filepath + ".tmp", src_filepath])
+            os.rename(mpy_filepath + ".tmp", mpy_filepath)
+
+        with open(mpy_filepath, "rb") as f:
+            header = f.read(4)
+        if (header[:1] != b"M"):
+            raise Exception("Unexpected header %r in %s" % (header, mpy_filepath))
+        mpy_version = header[1]
+
+        mpy_files.append((filename[:-len(".py")] + ".mpy", mpy_filepath, file_digest(mpy_filepath)))
+
+    return (mpy_version, mpy_files)
+
+def firmware_mpy_version(ver):
+    """
+    @param ver the (major, minor, micro) version tuple returned by
+           WebReplClient.get_ver
+    @return the .mpy version the firmware can import, None if unknown
+    """
+    if (ver >= (1, 19, 0)):
+        return 6
+    if (ver >= (1, 12, 0)):
+        return 5
+    return None
 
-                    mini_size += len(s_min)
-                    maxi_size += len(s)
-                    logger.info("%d to %d %2.3f%%, total %d to %d %2.3f%%",  
-                        len(s), len(s_min), len(s) * 100.0 / len(s_min),
-                        maxi_size, mini_size, maxi_size * 100.0 / mini_size
-                    )
+def deploy_digest(device, files):
+    """
+    @return digest of the names and contents of the files that would be sent to
+            the device
+    """
+    h = hashlib.sha1()
+    for filename, filepath, digest in files:
+        h.update(("%s %s\n" % (filename, digest)).encode("utf-8"))
+    if (device["cfg_filepath"] is not None):
+        h.update(("%s %s\n" % (cfg_filename, file_digest(device["cfg_filepath"]))).encode("utf-8"))
 
-                    filepath = min_filepath
-                except:
-                    logger.exception("Unable to minify %s", filepath)
+    return h.hexdigest()
 
-            send_file(ws, filepath)
+async def recv_manifest(client, device):
+    """
+    Receive the manifest of the files on the device, see send_changed_files
+
+    @return dict of filename to digest, empty if the device has no manifest
+    """
+    manifest_filepath = device["manifest_filepath"]
+    # The manifest sent by the last deploy is usually the one on the device
+    size = None
+    if (os.path.exists(manifest_filepath)):
+        size = os.path.getsize(manifest_filepath)
+        os.remove(manifest_filepath)
+
+    manifest = {}
+    if (await safe_get_file(client, manifest_filename, manifest_filepath, size)):
+        try:
+            with open(manifest_filepath, "r") as f:
+                manifest = json.load(f)
+        except:
+            logger.exception("Ignoring invalid manifest %s", manifest_filepath)
+
+    return manifest
+
+def stale_filenames(files):
+    """
+    @return list of the filenames on the device that would shadow or be
+            shadowed by the given files, ie the .py for a .mpy (MicroPython
+            imports the .py before the .mpy) and viceversa
+    """
+    stale = []
+    for filename, filepath, digest in files:
+        if (filename.endswith(".mpy")):
+            stale.append(filename[:-len(".mpy")] + ".py")
+        elif (filename.endswith(".py") and (filename != "main.py")):
+            stale.append(filename[:-len(".py")] + ".mpy")
+
+    return stale
+
+async def send_changed_files(client, device, files, force=False):
+    """
+    Send the files whose digest differs from the digest in the manifest stored
+    in the device
+
+    @return (manifest, stale) tuple with the updated manifest, to be sent with
+            send_manifest, and the list of files to remove from the device, see
+            stale_filenames
+    """
+    if (force):
+        manifest = {}
+    else:
+        manifest = await recv_manifest(client, device)
+
+    # Files not in the manifest may have been deployed before the manifest
+    # existed, remove all the stale files in that case
+    stale = [filename for filename in stale_filenames(files)
+        if ((len(manifest) == 0) or (filename in manifest))]
+    for filename in stale:
+        manifest.pop(filename, None)
+
+    sent_size = 0
+    skipped_size = 0
+    for filename, filepath, digest in files:
+        if (manifest.get(filename, None) == digest):
+            logger.info("Skipping unchanged %s", filename)
+            skipped_size += os.path.getsize(filepath)
+            continue
+
+        await send_file(client, filepath, filename)
+        sent_size += os.path.getsize(filepath)
+        manifest[filename] = digest
+
+    logger.info("Sent %d bytes, skipped %d bytes of unchanged files", sent_size, skipped_size)
+
+    return manifest, stale
+
+async def send_manifest(client, device, manifest):
+    """
+    Send the manifest updated by send_changed_files
+
+    The manifest is only sent after all the files have been sent and the stale
+    files removed, so an interrupted deploy is redone on the next deploy
+    """
+    manifest_filepath = device["manifest_filepath"]
+    with open(manifest_filepath, "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    await send_file(client, manifest_filepath, manifest_filename)
+
+async def remove_files(client, filenames):
+    """
+    Remove the files from the device, ignoring the ones that don't exist. The
+    REPL must be idle, see WebReplClient.exec
+    """
+    logger.info("Removing %r", filenames)
+    await client.exec("import os\nfor fn in %r:\n    try:\n        os.remove(fn)\n    except OSError:\n        pass\n" %
+        [str(filename) for filename in filenames])
+
+async def recv_boot_report(client, timeout_secs=30):
+    """
+    Wait for the boot heap report printed by main.py after a restart
+
+    @return (free before imports, free after imports) tuple
+    """
+    data = await client.recv_until(" after imports", timeout_secs)
+    m = re.search(r"Boot heap free (\d+) before imports, (\d+) after imports", data)
+    if (m is None):
+        raise WebReplError("Unexpected boot report %r" % data[-80:])
+
+    return (int(m.group(1)), int(m.group(2)))
+
+async def deploy_device(device, files, force=False, mpy_build=None):
+    """
+    Send the changed files and the config to the device and restart it
+
+    @param files list of (filename, filepath, digest) tuples, see prepare_modules
+    @param force send all the files even if unchanged
+    @param mpy_build compiled files to use instead of files if the firmware
+           supports them, see compile_modules
+    """
+    if (not os.path.exists(device["log_dirpath"])):
+        os.makedirs(device["log_dirpath"])
+
+    async with WebReplClient(device["url"], device["password"]) as client:
+        ver = await client.get_ver()
+        logger.info("version %d.%d.%d" % ver)
+
+        if (mpy_build is not None):
+            mpy_version, mpy_files = mpy_build
+            if (mpy_version == firmware_mpy_version(ver)):
+                files = mpy_files
+            else:
+                # Importing an incompatible .mpy fails, which would leave the
+                # device stuck in the REPL
+                logger.warning("Firmware %d.%d.%d doesn't support .mpy version %r, deploying .py files",
+                    ver[0], ver[1], ver[2], mpy_version)
+
+        manifest, stale = await send_changed_files(client, device, files, force)
 
-        safe_recv_file(ws, url, password, log_filename, log_filepath)
-        
         # Break in by sending Ctrl+C
         logger.info("Sending ctrl+c")
-        ws.send("\x03")
+        await client.send_text("\x03")
 
         # The config file is saved at ctrl+c time, send it now so it doesn't get
         # ovewritten
         # Wait some before sending it otherwise it races with the exception
         # handler that writes the file
-        time.sleep(1)
-        send_file(ws, cfg_filepath)
+        await asyncio.sleep(1)
+
+        # The log is also flushed at ctrl+c time, and the REPL is now idle so
+        # only the new log data can be fetched
+        try:
+            await sync_log(client, device)
+        except:
+            logger.exception("Unable to sync log, receiving it instead")
+            await recv_log(client, device)
+
+        if (len(stale) > 0):
+            await remove_files(client, stale)
+        await send_manifest(client, device, manifest)
+
+        if (device["cfg_filepath"] is not None):
+            await send_file(client, device["cfg_filepath"], cfg_filename)
 
         # Restart by sending Ctrl+D
         # XXX Note this is a soft reset, different from machine.reset, which is
         #     a hard reset, should this do a hard reset?
         #     See https://docs.micropython.org/en/v1.8.6/wipy/wipy/tutorial/reset.html
         logger.info("Sending ctrl+d")
-        ws.send("\x04")
+        await client.send_text("\x04")
 
-    finally:
-        ws.close()
+        try:
+            free_before, free_after = await recv_boot_report(client)
+            logger.info("Boot heap free %d bytes before imports, %d after, %d used by imports",
+                free_before, free_after, free_before - free_after)
+        except Exception as e:
+            logger.warning("No boot heap report: %r", e)
+
+async def deploy_fleet_device(device, files, mpy_build, deployed, force):
+    """
+    Deploy to one device of the fleet, run in its own task
 
-if (forever):
-    # Connect and display recv() forever, press ctrl+c to exit (takes a few seconds)
-    # Note pressing ctrl+break will cause the interpreter to not exit cleanly,
-    # ws.close() won't execute and will leave the webrepl session hanging forever,
-    # the only solution is to reboot the micropython device
+    @param deployed dict of host to deploy_digest of the last successful deploy,
+           updated on success
+    @return (host, status, seconds, error) tuple, status is one of "deployed",
+            "skipped" or "failed"
+    """
+    host = device["host"]
+    # Tasks run in a copy of the context, this doesn't affect other tasks
+    current_host.set(host)
+    start = time.time()
+    try:
+        digest = deploy_digest(device, files + ([] if (mpy_build is None) else mpy_build[1]))
+        if ((not force) and (deployed.get(host, None) == digest)):
+            logger.info("Skipping up to date device")
+            return (host, "skipped", time.time() - start, None)
 
-    ws = websocket.WebSocket()
-    logger.info("Connecting WebSocket")
-    ws.connect(url, timeout=WS_TIMEOUT_SECS)
+        await deploy_device(device, files, force, mpy_build)
+
+        deployed[host] = digest
+        with open(deployed_filepath, "w") as f:
+            json.dump(deployed, f, indent=4, sort_keys=True)
+
+        return (host, "deployed", time.time() - start, None)
+
+    except Exception as e:
+        logger.exception("Unable to deploy")
+        return (host, "failed", time.time() - start, repr(e))
+
+async def deploy_fleet(devices, files, mpy_build, force, max_concurrent=8):
+    """
+    Deploy to all the devices concurrently, so the deploy takes as long as the
+    slowest device instead of the sum of all of them
 
+    Devices whose files haven't changed since the last successful deploy are
+    skipped unless force is set
+
+    @return True if no device failed
+    """
+    deployed = {}
     try:
-        send_login(ws, password)
+        with open(deployed_filepath, "r") as f:
+            deployed = json.load(f)
+    except:
+        logger.info("No deploy state in %s, deploying to all devices", deployed_filepath)
+
+    logger.info("Deploying to %d devices", len(devices))
+    start = time.time()
+    semaphore = asyncio.Semaphore(max_concurrent)
+    async def deploy_with_semaphore(device):
+        async with semaphore:
+            return await deploy_fleet_device(device, files, mpy_build, deployed, force)
+    results = await asyncio.gather(*[deploy_with_semaphore(device) for device in devices])
+    elapsed = time.time() - start
+
+    for host, status, secs, error in results:
+        logger.info("%-24s %-8s %7.2fs%s", host, status, secs, "" if (error is None) else " %s" % error)
+
+    failed = len([result for result in results if (result[1] == "failed")])
+    logger.info("Fleet deploy took %2.2fs (%2.2fs sequentially), %d deployed %d skipped %d failed",
+        elapsed, sum([result[2] for result in results]),
+        len([result for result in results if (result[1] == "deployed")]),
+        len([result for result in results if (result[1] == "skipped")]),
+        failed)
+
+    return (failed == 0)
+
+async def display_console(device, deploy, multiplexer):
+    """
+    Connect and display the console forever, press ctrl+c to exit
 
-        ver = recv_ver(ws)
+    @param multiplexer ConsoleMultiplexer to send the console lines to
+    """
+    async with WebReplClient(device["url"], device["password"]) as client:
+        ver = await client.get_ver()
         logger.info("version %d.%d.%d" % ver)
 
         # Pulling the file here would hide micropython interpreter error
         # messages from the deploy above, only pull it if there was no deploy
         if (not deploy):
-            safe_recv_file(ws, url, password, cfg_filename, cfg_filepath)
-            safe_recv_file(ws, url, password, log_filename, log_filepath)
+            await safe_get_file(client, cfg_filename, cfg_filepath)
+            await recv_log(client, device)
 
         try:
-            with open(log_filepath, "r") as f:
+            with open(device["log_filepath"], "r") as f:
                 for l in f:
                     logger.info(l.strip())
         except:
-            logger.info("Not dumping non-existent %s", log_filepath)
+            logger.info("Not dumping non-existent %s", device["log_filepath"])
 
         # XXX Note that if the PC goes to sleep holding this connection it seems
         #     to hang micropython's network stack (!) and you won't be able to
@@ -332,25 +1032,291 @@ if (forever):
         #     network is not available and hard reset? See
         #     https://github.com/micropython/webrepl/issues/36
         logger.info("Displaying console forever, press ctrl+c to end")
-        line = ""
+        await multiplexer.stream_client(device["host"], client)
+
+class LineSplitter:
+    """
+    Split a stream of text into lines
+
+    The text is only scanned once when it's received and joined once when a
+    line is complete, so long bursts are split in linear time. The console
+    sends CRLF line endings, possibly with the CR and the LF in different
+    messages
+    """
+    def __init__(self):
+        # Text received since the last complete line
+        self.parts = []
+
+    def feed(self, text):
+        """
+        @return list of the lines completed by the text, without line endings
+        """
+        i = text.rfind("\n")
+        if (i == -1):
+            self.parts.append(text)
+            return []
+
+        self.parts.append(text[:i])
+        lines = "".join(self.parts).split("\n")
+        self.parts = [text[i+1:]]
+
+        return [l[:-1] if l.endswith("\r") else l for l in lines]
+
+class StdoutConsoleSink:
+    def write(self, host, line):
+        sys.stdout.write("%s %s: %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), host, line))
+        sys.stdout.flush()
+
+    async def close(self):
+        pass
+
+class FileConsoleSink:
+    """
+    Write each device's console to its own rotating file in console_dirpath
+    """
+    def __init__(self, dirpath, max_bytes=1024 * 1024, backup_count=4):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # Host to logger writing to the host's file
+        self.loggers = {}
+        if (not os.path.exists(dirpath)):
+            os.makedirs(dirpath)
+
+    def write(self, host, line):
+        file_logger = self.loggers.get(host, None)
+        if (file_logger is None):
+            handler = logging.handlers.RotatingFileHandler(os.path.join(self.dirpath, "%s.log" % host),
+                maxBytes=self.max_bytes, backupCount=self.backup_count)
+            handler.setFormatter(logging.Formatter("%(asctime).23s %(message)s"))
+            file_logger = logging.getLogger("%s.console.%s" % (__name__, host))
+            file_logger.propagate = False
+            file_logger.setLevel(logging.INFO)
+            file_logger.addHandler(handler)
+            self.loggers[host] = file_logger
+
+        file_logger.info(line)
+
+    async def close(self):
+        for file_logger in self.loggers.values():
+            for handler in file_logger.handlers[:]:
+                handler.close()
+                file_logger.removeHandler(handler)
+
+class SocketConsoleSink:
+    """
+    Send the "host: line" console lines to the clients connected to a local TCP
+    port, eg with nc localhost 8267
+
+    Clients that don't keep up are disconnected instead of buffering lines
+    without limit
+    """
+    def __init__(self, max_buffered_bytes=256 * 1024):
+        self.max_buffered_bytes = max_buffered_bytes
+        self.writers = set()
+        self.server = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.accept, host, port)
+        logger.info("Serving consoles on %s:%d", host, port)
+
+    async def accept(self, reader, writer):
+        logger.info("Console client %r connected", writer.get_extra_info("peername"))
+        self.writers.add(writer)
+
+    def write(self, host, line):
+        data = ("%s: %s\n" % (host, line)).encode("utf-8")
+        for writer in list(self.writers):
+            if (writer.is_closing() or (writer.transport.get_write_buffer_size() > self.max_buffered_bytes)):
+                logger.info("Dropping console client %r", writer.get_extra_info("peername"))
+                self.writers.discard(writer)
+                writer.close()
+                continue
+            writer.write(data)
+
+    async def close(self):
+        for writer in self.writers:
+            writer.close()
+        if (self.server is not None):
+            self.server.close()
+            await self.server.wait_closed()
+
+class ConsoleMultiplexer:
+    """
+    Stream the consoles of many devices concurrently into the sinks, each line
+    prefixed with the device host
+    """
+    def __init__(self, sinks, reconnect_secs=5):
+        self.sinks = sinks
+        self.reconnect_secs = reconnect_secs
+
+    def publish(self, host, line):
+        for sink in self.sinks:
+            sink.write(host, line)
+
+    async def stream_client(self, host, client):
+        """
+        Stream the console of an already connected client until the connection
+        is closed
+        """
+        splitter = LineSplitter()
+        async for text in client.console():
+            for line in splitter.feed(text):
+                self.publish(host, line)
+
+    async def stream_device(self, device):
+        """
+        Stream the console of the device forever, reconnecting when the
+        connection is lost (eg the device reset)
+        """
+        host = device["host"]
+        current_host.set(host)
         while (True):
             try:
-                l = ws.recv()
-                # The console sends CRLF on a different line, ignore those
-                # XXX Accumulate and split by CRLF instead?
-                while (True):
-                    i = l.find("\r\n")
-                    if (i == -1):
-                        line += l
-                        break
-                    line += l[0:i]
-                    logger.info(line)
-                    line = ""
-                    l = l[i+2:]
-
-            except websocket.WebSocketTimeoutException:
-                pass
+                async with WebReplClient(device["url"], device["password"]) as client:
+                    await self.stream_client(host, client)
 
-    finally:
-        logger.info("Closing WebSocket")
-        ws.close()
\ No newline at end of file
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                logger.warning("Console connection lost, reconnecting in %ds: %r", self.reconnect_secs, e)
+
+            await asyncio.sleep(self.reconnect_secs)
+
+    async def run(self, devices):
+        await asyncio.gather(*[self.stream_device(device) for device in devices])
+
+    async def close(self):
+        for sink in self.sinks:
+            await sink.close()
+
+async def create_multiplexer(socket):
+    """
+    @param socket also send the consoles to console_socket_port
+    """
+    sinks = [StdoutConsoleSink(), FileConsoleSink(console_dirpath)]
+    if (socket):
+        sink = SocketConsoleSink()
+        await sink.start("localhost", console_socket_port)
+        sinks.append(sink)
+
+    return ConsoleMultiplexer(sinks)
+
+modules = ["aio.py", "config.py", "history.py", "lessmostat.py", "logging.py", "main.py", "mqtt.py", "outbox.py", "relays.py", "rules.py", "sampler.py", "syncedtime.py", "telemetry.py", "thermal.py", "umqtt_simple.py"]
+log_filename = "lessmostat.log"
+log_filepath = os.path.join("_out", log_filename)
+cfg_filename = "lessmostat.cfg"
+cfg_filepath = os.path.join("upython", cfg_filename)
+# Digest of each file on the device, see send_changed_files
+manifest_filename = "manifest.json"
+# Minified modules by source digest, see prepare_modules
+min_dirpath = os.path.join("_out", "min")
+# Compiled modules by source and mpy-cross version digest, see compile_modules.
+# The mpy-cross version must generate the .mpy version supported by the
+# firmware, see firmware_mpy_version (eg pip install "mpy-cross<1.19" for
+# firmware 1.12 to 1.18)
+mpy_cross_filepath = os.environ.get("MPY_CROSS", "mpy-cross")
+# Add "-O1" to remove the log printing to stdout (and the asserts) at compile
+# time, see upython/logging.py
+mpy_cross_args = []
+mpy_dirpath = os.path.join("_out", "mpy")
+# hosts.txt the fleet inventory, see read_inventory
+inventory_filepath = os.path.join("_out", "hosts.txt")
+# Digest of the files of the last successful fleet deploy to each device
+deployed_filepath = os.path.join("_out", "deployed.json")
+# Per device rotating console files, see FileConsoleSink
+console_dirpath = os.path.join("_out", "console")
+# Local port to fan out the consoles to, see SocketConsoleSink
+console_socket_port = 8267
+
+logger = logging.getLogger(__name__)
+
+async def run(argv):
+    global modules
+
+    deploy = "deploy" in argv
+    forever = "forever" in argv
+    fleet = "fleet" in argv
+    # Stream the consoles of all the devices in the inventory
+    watch = "watch" in argv
+    # Also send the consoles to console_socket_port
+    socket = "socket" in argv
+    force = "force" in argv
+    # Deploy .py files even if mpy-cross is available
+    py = "py" in argv
+
+    if (not (deploy or forever or fleet or watch)):
+        print("One of deploy, forever, fleet or watch must be passed as argument!")
+        return 1
+
+    # Any other arguments are the modules to send
+    args = [arg for arg in argv if (arg not in ["deploy", "forever", "fleet", "watch", "socket", "force", "py"])]
+    if (len(args) > 0):
+        modules = args
+
+    if (fleet or watch):
+        devices = read_inventory(inventory_filepath)
+        logger.info("read %d devices from %s", len(devices), inventory_filepath)
+        ok = True
+        if (fleet):
+            files = prepare_modules(modules)
+            mpy_build = None if py else compile_modules(files)
+            ok = await deploy_fleet(devices, files, mpy_build, force)
+
+        if (watch):
+            multiplexer = await create_multiplexer(socket)
+            try:
+                await multiplexer.run(devices)
+            finally:
+                await multiplexer.close()
+
+        return 0 if ok else 1
+
+    # host_password.txt a two line file with the host name in the first line and the
+    # password in the second
+    with open(os.path.join("_out", "host_password.txt"), "r") as f:
+        host, password = [l.strip() for l in f.readlines()]
+
+    logger.info("read host and password for host %s", host)
+    device = create_device(host, password, log_filepath, cfg_filepath)
+
+    logger.info("Deleting log file %s", log_filepath)
+    try:
+        os.remove(log_filepath)
+    except:
+        logger.info("Can't remove log file %s", log_filepath)
+
+    if (deploy):
+        files = prepare_modules(modules)
+        await deploy_device(device, files, force, None if py else compile_modules(files))
+
+    if (forever):
+        multiplexer = await create_multiplexer(socket)
+        try:
+            await display_console(device, deploy, multiplexer)
+        finally:
+            await multiplexer.close()
+
+    return 0
+
+def main():
+    setup_logger(logger)
+    log_level = logging.DEBUG
+    log_level = logging.INFO
+    logger.setLevel(log_level)
+    if (log_level == logging.DEBUG):
+        websockets_logger = logging.getLogger("websockets")
+        websockets_logger.setLevel(logging.DEBUG)
+        websockets_logger.addHandler(logging.StreamHandler())
+
+    try:
+        return asyncio.run(run(sys.argv[1:]))
+    except KeyboardInterrupt:
+        # Cancelling the tasks closes the WebSocket, which would otherwise leave
+        # the webrepl session hanging until the device is rebooted
+        logger.info("Interrupted")
+        return 1
+
+if (__name__ == "__main__"):
+    sys.exit(main())
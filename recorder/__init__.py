@@ -0,0 +1,10 @@
+"""
+Host-side telemetry recorder for a fleet of lessmostat devices
+
+Subscribes to the info topics of the devices, batches the sensor samples and
+relay changes and appends them to a columnar archive of NumPy arrays
+partitioned by device and day, see archive.py. The archive can be queried by
+time range and downsampled.
+
+See python3 -m recorder --help
+"""
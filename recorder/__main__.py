@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Command line for the recorder, eg record all the devices under the default
+topic roots and query the last day of one of them in 5 minute averages
+
+    python3 -m recorder record --broker 192.168.8.201 --archive _out/archive
+    python3 -m recorder query --archive _out/archive \\
+        --device apartment/lessmostat --from -86400 --period 300
+
+Duty cycle, short cycling and energy of all the devices in the last 30 days, and
+the hourly duty cycle of one of them
+
+    python3 -m recorder analyze --archive _out/archive --from -2592000
+    python3 -m recorder analyze --archive _out/archive \
+        --device apartment/lessmostat --from -86400 --period 3600
+
+Measure the recording throughput against a local broker stand-in with
+
+    python3 -m recorder bench --devices 100 --messages 200000
+"""
+import argparse
+import asyncio
+import calendar
+import json
+import logging
+import shutil
+import tempfile
+import time
+
+from recorder.analytics import analyze_device, duty_grid
+from recorder.archive import Archive, STREAMS
+from recorder.mqtt import MQTTSubscriber, encode_len, encode_str
+from recorder.recorder import Recorder, subscription_patterns
+
+logger = logging.getLogger(__name__)
+
+async def record(args):
+    archive = Archive(args.archive)
+    recorder = Recorder(archive, batch_rows=args.batch_rows, flush_secs=args.flush_secs)
+    host, _, port = args.broker.partition(":")
+    # Without a client id the broker doesn't keep a session
+    subscriber = MQTTSubscriber(host, int(port or 1883), client_id=args.client_id or "lessmostat-recorder",
+        clean_session=(args.client_id is None))
+    task = asyncio.ensure_future(subscriber.run(subscription_patterns(args.topic_root), recorder.on_message))
+    try:
+        while (True):
+            await asyncio.sleep(1)
+            recorder.tick()
+
+    finally:
+        task.cancel()
+        recorder.flush()
+        logger.info("Recorder stats %r, archive stats %r", recorder.stats, archive.stats)
+
+def parse_ts(s, now):
+    """
+    @param s unix epoch timestamp, seconds relative to now if negative, "now"
+           or ISO date and time in UTC, eg 2021-07-01T12:00
+    """
+    if (s == "now"):
+        return now
+
+    try:
+        ts = int(s)
+        return ts if (ts >= 0) else now + ts
+
+    except ValueError:
+        return calendar.timegm(time.strptime(s, "%Y-%m-%dT%H:%M" if ("T" in s) else "%Y-%m-%d"))
+
+def query(args):
+    archive = Archive(args.archive)
+    if (args.device is None):
+        for device in archive.devices():
+            days = archive.days(device)
+            print("%s %d days" % (device, len(days)))
+        return
+
+    now = int(time.time())
+    columns = archive.read(args.device, args.stream, parse_ts(args.from_ts, now), parse_ts(args.to_ts, now), args.period)
+    names = [name for name, _, _ in STREAMS[args.stream]] + (["count"] if (args.period is not None) else [])
+    print(",".join(names))
+    for row in zip(*[columns[name] for name in names]):
+        print(",".join([str(v) for v in row]))
+
+def analyze(args):
+    archive = Archive(args.archive)
+    now = int(time.time())
+    from_ts = parse_ts(args.from_ts, now)
+    to_ts = parse_ts(args.to_ts, now)
+    if (args.period is not None):
+        grid = duty_grid(archive, args.device, from_ts, to_ts, args.period)
+        names = list(grid.keys())
+        print(",".join(names))
+        for row in zip(*[grid[name] for name in names]):
+            print(",".join([str(v) for v in row]))
+        return
+
+    devices = archive.devices() if (args.device is None) else [args.device]
+    reports = [analyze_device(archive, device, from_ts, to_ts,
+        min_on_secs=args.min_on_mins * 60, min_off_secs=args.min_off_mins * 60) for device in devices]
+    print(json.dumps(reports, indent=4, sort_keys=True))
+
+async def serve_publishes(packets, reader, writer):
+    """
+    Broker stand-in that acks the connection and subscription and sends the
+    given packets
+    """
+    await reader.read(65536)
+    writer.write(b"\x20\x02\x00\x00" + b"\x90\x03\x00\x01\x01")
+    for i in range(0, len(packets), 1024):
+        writer.write(b"".join(packets[i:i + 1024]))
+        await writer.drain()
+    # Leave the connection open so the subscriber doesn't reconnect and get
+    # the packets again
+
+def bench(args):
+    """
+    Record synthetic JSON sensor and relay messages sent over TCP by a local
+    broker stand-in
+    """
+    packets = []
+    ts = int(time.time()) - args.messages // args.devices * 10
+    for i in range(args.messages):
+        device = "device%d/lessmostat/" % (i % args.devices)
+        if (i % 50 == 0):
+            topic = device + "info/ac"
+            payload = json.dumps({ "state" : "on" if (i % 100 == 0) else "off", "mod_ts" : ts, "uptime" : i, "ts" : ts })
+        else:
+            topic = device + "info/sensor"
+            payload = json.dumps({ "temp" : 20 + (i % 100) / 10.0, "humid" : 50 + (i % 37) / 10.0, "ts" : ts })
+        if (i % args.devices == args.devices - 1):
+            ts += 10
+        body = encode_str(topic) + payload.encode("utf-8")
+        packets.append(b"\x30" + encode_len(len(body)) + body)
+
+    dirpath = tempfile.mkdtemp(prefix="lessmostat_recorder_")
+    try:
+        archive = Archive(dirpath)
+        recorder = Recorder(archive)
+        subscriber = MQTTSubscriber("127.0.0.1", 0, reconnect_secs=0)
+
+        async def run():
+            server = await asyncio.start_server(lambda r, w : serve_publishes(packets, r, w), "127.0.0.1", 0)
+            subscriber.port = server.sockets[0].getsockname()[1]
+            task = asyncio.ensure_future(subscriber.run(subscription_patterns("+/lessmostat/"), recorder.on_message))
+            while (subscriber.stats["messages"] < len(packets)):
+                await asyncio.sleep(0.01)
+            task.cancel()
+            server.close()
+
+        start = time.perf_counter()
+        asyncio.run(run())
+        recorder.flush()
+        secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows = 0
+        for device in archive.devices():
+            rows += len(archive.read(device, "sensor", 0, 2**32 - 1, 300)["ts"])
+        query_secs = time.perf_counter() - start
+
+        report = {
+            "messages" : len(packets),
+            "secs" : secs,
+            "messages_per_sec" : len(packets) / secs,
+            "recorder" : recorder.stats,
+            "archive" : archive.stats,
+            "downsampled_rows" : rows,
+            "query_secs" : query_secs,
+        }
+        print(json.dumps(report, indent=4, sort_keys=True))
+
+    finally:
+        shutil.rmtree(dirpath)
+
+def main():
+    parser = argparse.ArgumentParser(description="Record the telemetry of lessmostat devices")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparser = subparsers.add_parser("record", help="record the devices' messages")
+    subparser.add_argument("--broker", required=True, help="MQTT broker HOST[:PORT]")
+    subparser.add_argument("--archive", required=True, help="archive directory")
+    subparser.add_argument("--topic-root", default="+/lessmostat/", help="topic root of the devices, with MQTT wildcards")
+    subparser.add_argument("--client-id", help="MQTT client id, for the broker to queue messages while not recording")
+    subparser.add_argument("--batch-rows", type=int, default=16384, help="rows buffered before writing")
+    subparser.add_argument("--flush-secs", type=float, default=10.0, help="maximum seconds rows are buffered")
+
+    subparser = subparsers.add_parser("query", help="print a device's rows as CSV, or the devices if no device")
+    subparser.add_argument("--archive", required=True, help="archive directory")
+    subparser.add_argument("--device", help="device topic root, eg apartment/lessmostat")
+    subparser.add_argument("--stream", default="sensor", choices=sorted(STREAMS.keys()))
+    subparser.add_argument("--from", dest="from_ts", default="0",
+        help="unix timestamp, negative seconds relative to now, now or UTC YYYY-MM-DD[THH:MM]")
+    subparser.add_argument("--to", dest="to_ts", default=str(2**32 - 1), help="same as --from")
+    subparser.add_argument("--period", type=int, help="seconds to downsample to")
+
+    subparser = subparsers.add_parser("analyze", help="print the relay analytics of the devices as JSON")
+    subparser.add_argument("--archive", required=True, help="archive directory")
+    subparser.add_argument("--device", help="device topic root, all the devices if not given")
+    subparser.add_argument("--from", dest="from_ts", default="-86400", help="same as query")
+    subparser.add_argument("--to", dest="to_ts", default="now", help="same as query")
+    subparser.add_argument("--period", type=int, help="print the duty cycles and sensor averages of each period of "
+        "these seconds as CSV instead, requires --device")
+    subparser.add_argument("--min-on-mins", type=float, default=5, help="on time below which a cycle is short")
+    subparser.add_argument("--min-off-mins", type=float, default=5, help="off time below which a cycle is short")
+
+    subparser = subparsers.add_parser("bench", help="measure the recording throughput")
+    subparser.add_argument("--devices", type=int, default=100)
+    subparser.add_argument("--messages", type=int, default=200000)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s:%(name)s: %(message)s")
+
+    if (args.command == "record"):
+        try:
+            asyncio.run(record(args))
+        except KeyboardInterrupt:
+            logger.info("Interrupted")
+
+    elif (args.command == "query"):
+        query(args)
+
+    elif (args.command == "analyze"):
+        if ((args.period is not None) and (args.device is None)):
+            parser.error("--period requires --device")
+        analyze(args)
+
+    else:
+        bench(args)
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Duty cycle, short cycling and energy analytics of the recorded relay changes
+
+The relay changes of the archive are turned into arrays of on intervals per
+relay and everything else is interval arithmetic on those arrays, so months
+of data of a device take a few NumPy operations instead of a loop per change
+- the on time in any set of periods comes from the cumulative on time at the
+  period edges, see on_secs_until
+- short cycles are on or off intervals shorter than a minimum
+- the temperature swing of a cycle is the sensor temperature interpolated at
+  the start and the end of the on intervals, which can be compared with the
+  configured lo_threshold_decidegs + hi_threshold_decidegs hysteresis
+
+Repeated changes to the same state (eg a device that reset while the relay was
+on and turned it on again) are taken as a single change to that state.
+"""
+import numpy as np
+
+from recorder.archive import DAY_SECS, RELAY_NAMES
+
+# Default power draw in kW of the equipment on each relay, for the energy
+# estimates
+DEFAULT_RELAY_KW = {
+    "ac" : 3.5,
+    "heat" : 5.0,
+    "fan" : 0.5,
+}
+
+# On and off intervals shorter than these are short cycles. AC compressors are
+# usually recommended to run and rest at least 5 minutes
+DEFAULT_MIN_ON_SECS = 5 * 60
+DEFAULT_MIN_OFF_SECS = 5 * 60
+
+def relay_intervals(ts, state, from_ts, to_ts):
+    """
+    Turn the changes of a relay into on intervals
+
+    @param ts timestamps of the changes of one relay, sorted
+    @param state 1 if the relay was turned on, 0 if off at each timestamp
+    @return (starts, ends) int64 arrays with the on intervals clipped to
+            [from_ts, to_ts), sorted and not overlapping. A relay turned off
+            before any on was on since from_ts, a relay left on is on until
+            to_ts
+    """
+    ts = np.asarray(ts, np.int64)
+    state = np.asarray(state)
+    if (len(ts) == 0):
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    # Keep the first of the repeated states so the changes alternate
+    keep = np.concatenate(([True], state[1:] != state[:-1]))
+    ts = ts[keep]
+    state = state[keep]
+
+    starts = ts[state != 0]
+    ends = ts[state == 0]
+    if (state[0] == 0):
+        starts = np.concatenate(([from_ts], starts))
+    if (state[-1] != 0):
+        ends = np.concatenate((ends, [to_ts]))
+
+    starts = np.clip(starts, from_ts, to_ts)
+    ends = np.clip(ends, from_ts, to_ts)
+    nonempty = ends > starts
+
+    return starts[nonempty], ends[nonempty]
+
+def on_secs_until(starts, ends, t):
+    """
+    @param starts, ends on intervals, see relay_intervals
+    @param t array of timestamps
+    @return array with the on seconds from the start of the first interval up
+            to each timestamp
+    """
+    t = np.asarray(t, np.int64)
+    if (len(starts) == 0):
+        return np.zeros(len(t), np.int64)
+
+    durations = ends - starts
+    # On seconds of the intervals before each interval
+    before = np.concatenate(([0], np.cumsum(durations)[:-1]))
+    # Last interval starting at or before t, the intervals before it are
+    # complete
+    k = np.searchsorted(starts, t, "right") - 1
+    valid = k >= 0
+    k = np.maximum(k, 0)
+
+    return np.where(valid, before[k] + np.minimum(t - starts[k], durations[k]), 0)
+
+def grid_edges(from_ts, to_ts, period):
+    """
+    @return edges of the periods covering [from_ts, to_ts), aligned to the
+            period
+    """
+    first = (from_ts // period) * period
+    n = (to_ts - first + period - 1) // period
+
+    return first + period * np.arange(n + 1, dtype=np.int64)
+
+def relays_by_name(columns, from_ts, to_ts):
+    """
+    @param columns columns of the relays stream, see Archive.read
+    @return dict of relay name to (starts, ends) on intervals
+    """
+    relay_column = columns["relay"]
+    intervals = {}
+    for relay, name in enumerate(RELAY_NAMES):
+        mask = relay_column == relay
+        intervals[name] = relay_intervals(columns["ts"][mask], columns["state"][mask], from_ts, to_ts)
+
+    return intervals
+
+def cycle_swings(starts, ends, sensor_ts, sensor_temp, cooling):
+    """
+    @return array with the temperature swing in tenths of degree of each on
+            interval, positive if the temperature went in the expected
+            direction, empty if there are no sensor samples
+    """
+    if (len(sensor_ts) == 0):
+        return np.zeros(0)
+    temp_start = np.interp(starts, sensor_ts, sensor_temp)
+    temp_end = np.interp(ends, sensor_ts, sensor_temp)
+
+    return (temp_start - temp_end) if cooling else (temp_end - temp_start)
+
+def analyze_device(archive, device, from_ts, to_ts, relay_kw=DEFAULT_RELAY_KW,
+    min_on_secs=DEFAULT_MIN_ON_SECS, min_off_secs=DEFAULT_MIN_OFF_SECS, lookback_secs=DAY_SECS):
+    """
+    @param lookback_secs how far before from_ts to look for the relay states
+           at from_ts
+    @return dict with the duty cycle, cycles, short cycles, energy and
+            temperature swing of each relay
+    """
+    relays = archive.read(device, "relays", max(from_ts - lookback_secs, 0), to_ts - 1)
+    sensor = archive.read(device, "sensor", from_ts, to_ts - 1)
+    sensor_ts = sensor["ts"]
+    sensor_temp = sensor["temp"]
+    secs = float(to_ts - from_ts)
+
+    report = {
+        "device" : device,
+        "from_ts" : from_ts,
+        "to_ts" : to_ts,
+        "sensor_samples" : int(len(sensor_ts)),
+        "relays" : {},
+    }
+
+    state = archive.read_state(device)
+    if (state is not None):
+        config = state["state"]["config"]
+        report["hysteresis_decidegs"] = config["lo_threshold_decidegs"] + config["hi_threshold_decidegs"]
+
+    for name, (starts, ends) in relays_by_name(relays, from_ts, to_ts).items():
+        on = ends - starts
+        # Time off between consecutive on intervals
+        off = starts[1:] - ends[:-1]
+        # Only count the cycles started in the range, not the ones clipped
+        cycles = int(np.count_nonzero(starts > from_ts))
+        on_secs = int(on.sum())
+        r = {
+            "on_hours" : on_secs / 3600.0,
+            "duty" : on_secs / secs,
+            "cycles" : cycles,
+            "cycles_per_hour" : cycles * 3600.0 / secs,
+            # The intervals clipped at the end of the range are not short
+            "short_on_cycles" : int(np.count_nonzero((on < min_on_secs) & (ends < to_ts))),
+            "short_off_cycles" : int(np.count_nonzero(off < min_off_secs)),
+            "median_on_mins" : float(np.median(on)) / 60.0 if (len(on) > 0) else None,
+            "median_off_mins" : float(np.median(off)) / 60.0 if (len(off) > 0) else None,
+            "kwh" : on_secs / 3600.0 * relay_kw.get(name, 0.0),
+        }
+        if (name in ("ac", "heat")):
+            swings = cycle_swings(starts, ends, sensor_ts, sensor_temp, name == "ac")
+            r["mean_swing_decidegs"] = float(swings.mean()) if (len(swings) > 0) else None
+        report["relays"][name] = r
+
+    return report
+
+def duty_grid(archive, device, from_ts, to_ts, period, lookback_secs=DAY_SECS):
+    """
+    Resample the relays and the sensor onto a common grid of periods
+
+    @return dict of column name to array with a row per period: "ts" the start
+            of the period, "<relay>_duty" the fraction of the period the relay
+            was on, "temp" and "humid" the average sensor values (NaN if no
+            samples) and "samples" the number of samples
+    """
+    edges = grid_edges(from_ts, to_ts, period)
+    relays = archive.read(device, "relays", max(edges[0] - lookback_secs, 0), edges[-1] - 1)
+    grid = { "ts" : edges[:-1] }
+    for name, (starts, ends) in relays_by_name(relays, edges[0], edges[-1]).items():
+        grid["%s_duty" % name] = np.diff(on_secs_until(starts, ends, edges)) / float(period)
+
+    sensor = archive.read(device, "sensor", edges[0], edges[-1] - 1, period)
+    i = (sensor["ts"].astype(np.int64) - edges[0]) // period
+    for name in ("temp", "humid"):
+        column = np.full(len(edges) - 1, np.nan)
+        column[i] = sensor[name]
+        grid[name] = column
+    samples = np.zeros(len(edges) - 1, np.int64)
+    samples[i] = sensor["count"]
+    grid["samples"] = samples
+
+    return grid
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Columnar archive of the device telemetry
+
+The archive is a directory per device and UTC day, eg
+
+    archive/apartment%2Flessmostat/20210701/sensor.ts
+    archive/apartment%2Flessmostat/20210701/sensor.temp
+    ...
+
+with a file per column of each stream holding the little endian values back
+to back, so a column can be memory-mapped as a NumPy array. The rows of a
+partition are sorted by timestamp, range queries are a binary search on the
+timestamp column of each day in the range.
+
+Rows are only ever appended to the files, except for rows older than the last
+row of the partition (eg a device whose clock went back), which rewrite the
+partition sorted. If the recorder dies while appending, the columns of a
+partition may have different lengths, the extra rows are truncated the next
+time the partition is appended to and ignored when read.
+"""
+import calendar
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DAY_SECS = 24 * 60 * 60
+
+ARCHIVE_VERSION = 1
+
+# Columns of each stream as (name, dtype, how to aggregate when downsampling)
+# tuples, the first column is always the unix epoch timestamp
+STREAMS = {
+    # Sensor samples, temperature in tenths of degree, humidity in tenths of
+    # percentage and the relay bitmask (see upython/telemetry.py) at the time
+    # of the sample
+    "sensor" : (
+        ("ts", "<u4", "first"),
+        ("temp", "<i2", "mean"),
+        ("humid", "<u2", "mean"),
+        ("relays", "u1", "or"),
+    ),
+    # Relay changes, relay index in RELAY_NAMES, state 1 for on, 0 for off and
+    # the accumulated uptime in seconds reported by the device
+    "relays" : (
+        ("ts", "<u4", "first"),
+        ("relay", "u1", "last"),
+        ("state", "u1", "last"),
+        ("uptime", "<u4", "last"),
+    ),
+}
+
+# Relay index in the relays stream to name and bit in the sensor relay bitmask
+RELAY_NAMES = ("ac", "heat", "fan")
+RELAY_BITS = (0x01, 0x02, 0x04)
+
+def day_dirname(day):
+    """
+    @param day days since the unix epoch
+    """
+    return time.strftime("%Y%m%d", time.gmtime(day * DAY_SECS))
+
+def dirname_day(dirname):
+    return calendar.timegm(time.strptime(dirname, "%Y%m%d")) // DAY_SECS
+
+def empty_columns(stream):
+    return { name : np.zeros(0, dtype) for name, dtype, _ in STREAMS[stream] }
+
+def downsample(stream, columns, period):
+    """
+    Aggregate the rows in periods of the given seconds
+
+    @param columns dict of column name to array sorted by timestamp, see
+           Archive.read
+    @return dict of column name to array with a row per period with rows, the
+            timestamp is the start of the period, the averages are float64 and
+            the "count" column has the number of rows in the period
+    """
+    ts = columns["ts"]
+    if (len(ts) == 0):
+        columns = empty_columns(stream)
+        columns["count"] = np.zeros(0, np.int64)
+        return columns
+
+    periods = ts // period
+    starts = np.flatnonzero(np.concatenate(([True], periods[1:] != periods[:-1])))
+    counts = np.diff(np.append(starts, len(ts)))
+
+    out = {}
+    for name, dtype, how in STREAMS[stream]:
+        column = columns[name]
+        if (name == "ts"):
+            out[name] = (periods[starts] * period).astype(dtype)
+        elif (how == "mean"):
+            out[name] = np.add.reduceat(column.astype(np.int64), starts) / counts
+        elif (how == "or"):
+            out[name] = np.bitwise_or.reduceat(column, starts)
+        elif (how == "last"):
+            out[name] = column[np.append(starts[1:], len(ts)) - 1]
+        else:
+            out[name] = column[starts]
+    out["count"] = counts
+
+    return out
+
+class Archive:
+    def __init__(self, root_dirpath):
+        self.root_dirpath = root_dirpath
+        # (device, stream, day) to the timestamp of the last row in the
+        # partition, for the partitions appended to since opened
+        self.last_ts = {}
+        self.stats = {
+            "rows" : 0,
+            "appends" : 0,
+            "rewrites" : 0,
+            "repairs" : 0,
+        }
+
+        if (not os.path.exists(root_dirpath)):
+            os.makedirs(root_dirpath)
+        meta_filepath = os.path.join(root_dirpath, "archive.json")
+        if (os.path.exists(meta_filepath)):
+            with open(meta_filepath, "r") as f:
+                meta = json.load(f)
+            if (meta["version"] != ARCHIVE_VERSION):
+                raise ValueError("Unsupported archive version %r" % meta["version"])
+
+        else:
+            # Describe the layout for other readers
+            meta = {
+                "version" : ARCHIVE_VERSION,
+                "streams" : { stream : [[name, dtype] for name, dtype, _ in columns] for stream, columns in STREAMS.items() },
+            }
+            with open(meta_filepath, "w") as f:
+                json.dump(meta, f, indent=4)
+
+    def device_dirpath(self, device):
+        # Devices are named after their topic root, which has slashes
+        return os.path.join(self.root_dirpath, urllib.parse.quote(device, safe=""))
+
+    def column_filepath(self, device, stream, day, name):
+        return os.path.join(self.device_dirpath(device), day_dirname(day), "%s.%s" % (stream, name))
+
+    def devices(self):
+        return sorted([urllib.parse.unquote(dirname) for dirname in os.listdir(self.root_dirpath)
+            if os.path.isdir(os.path.join(self.root_dirpath, dirname))])
+
+    def days(self, device):
+        """
+        @return sorted list of the days with data for the device, as days since
+                the unix epoch
+        """
+        dirpath = self.device_dirpath(device)
+        if (not os.path.exists(dirpath)):
+            return []
+
+        return sorted([dirname_day(dirname) for dirname in os.listdir(dirpath)
+            if os.path.isdir(os.path.join(dirpath, dirname))])
+
+    def write_state(self, device, state):
+        """
+        Replace the last state snapshot of the device
+        """
+        dirpath = self.device_dirpath(device)
+        if (not os.path.exists(dirpath)):
+            os.makedirs(dirpath)
+        filepath = os.path.join(dirpath, "state.json")
+        with open(filepath + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(filepath + ".tmp", filepath)
+
+    def read_state(self, device):
+        filepath = os.path.join(self.device_dirpath(device), "state.json")
+        if (not os.path.exists(filepath)):
+            return None
+        with open(filepath, "r") as f:
+            return json.load(f)
+
+    def open_partition(self, device, stream, day):
+        """
+        Prepare a partition for appending, creating it or truncating the
+        columns to the same length
+
+        @return timestamp of the last row, None if empty
+        """
+        key = (device, stream, day)
+        if (key in self.last_ts):
+            return self.last_ts[key]
+
+        filepaths = [self.column_filepath(device, stream, day, name) for name, _, _ in STREAMS[stream]]
+        dirpath = os.path.dirname(filepaths[0])
+        if (not os.path.exists(dirpath)):
+            os.makedirs(dirpath)
+
+        sizes = [os.path.getsize(filepath) if os.path.exists(filepath) else 0 for filepath in filepaths]
+        itemsizes = [np.dtype(dtype).itemsize for _, dtype, _ in STREAMS[stream]]
+        n = min([size // itemsize for size, itemsize in zip(sizes, itemsizes)])
+        for filepath, size, itemsize in zip(filepaths, sizes, itemsizes):
+            if (size != n * itemsize):
+                logger.warning("Truncating %s from %d to %d rows", filepath, size // itemsize, n)
+                self.stats["repairs"] += 1
+                with open(filepath, "r+b") as f:
+                    f.truncate(n * itemsize)
+
+        last_ts = None
+        if (n > 0):
+            last_ts = int(np.memmap(filepaths[0], STREAMS[stream][0][1], mode="r")[n - 1])
+        self.last_ts[key] = last_ts
+
+        return last_ts
+
+    def append(self, device, stream, columns):
+        """
+        Append rows to the device's stream
+
+        @param columns dict of column name to array-like, eg array.array, all
+               with the same length, in any order
+        """
+        specs = STREAMS[stream]
+        arrays = [np.asarray(columns[name]) for name, _, _ in specs]
+        if (len(arrays[0]) == 0):
+            return
+
+        ts = arrays[0]
+        if (np.any(ts[1:] < ts[:-1])):
+            order = np.argsort(ts, kind="stable")
+            arrays = [a[order] for a in arrays]
+            ts = arrays[0]
+
+        # Split in days
+        days = ts // DAY_SECS
+        bounds = np.concatenate(([0], np.flatnonzero(days[1:] != days[:-1]) + 1, [len(ts)]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            day = int(days[start])
+            rows = [a[start:end] for a in arrays]
+            last_ts = self.open_partition(device, stream, day)
+            if ((last_ts is None) or (rows[0][0] >= last_ts)):
+                for (name, dtype, _), a in zip(specs, rows):
+                    with open(self.column_filepath(device, stream, day, name), "ab") as f:
+                        f.write(a.astype(dtype).tobytes())
+                self.stats["appends"] += 1
+
+            else:
+                self.rewrite_partition(device, stream, day, rows)
+
+            self.last_ts[(device, stream, day)] = max(int(rows[0][-1]), last_ts or 0)
+            self.stats["rows"] += int(end - start)
+
+    def rewrite_partition(self, device, stream, day, rows):
+        """
+        Merge out of order rows into the partition
+        """
+        specs = STREAMS[stream]
+        existing = self.read_partition(device, stream, day)
+        merged = [np.concatenate((existing[name], a.astype(dtype))) for (name, dtype, _), a in zip(specs, rows)]
+        order = np.argsort(merged[0], kind="stable")
+        for (name, dtype, _), a in zip(specs, merged):
+            filepath = self.column_filepath(device, stream, day, name)
+            with open(filepath + ".tmp", "wb") as f:
+                f.write(a[order].astype(dtype).tobytes())
+            os.replace(filepath + ".tmp", filepath)
+        self.stats["rewrites"] += 1
+
+    def read_partition(self, device, stream, day):
+        """
+        @return dict of column name to memory-mapped array, empty arrays if the
+                partition doesn't exist
+        """
+        columns = {}
+        for name, dtype, _ in STREAMS[stream]:
+            filepath = self.column_filepath(device, stream, day, name)
+            n = (os.path.getsize(filepath) // np.dtype(dtype).itemsize) if os.path.exists(filepath) else 0
+            if (n > 0):
+                # Ignore any partial row at the end
+                columns[name] = np.memmap(filepath, dtype, mode="r", shape=(n,))
+            else:
+                columns[name] = np.zeros(0, dtype)
+
+        # Ignore the rows of an interrupted append
+        n = min([len(a) for a in columns.values()])
+
+        return { name : a[:n] for name, a in columns.items() }
+
+    def read(self, device, stream, from_ts, to_ts, period=None):
+        """
+        Read the rows from from_ts to to_ts, both included
+
+        @param period seconds to downsample the rows to, see downsample, None
+               to return all the rows
+        @return dict of column name to array
+        """
+        parts = []
+        for day in self.days(device):
+            if ((day < from_ts // DAY_SECS) or (day > to_ts // DAY_SECS)):
+                continue
+            columns = self.read_partition(device, stream, day)
+            ts = columns["ts"]
+            start = np.searchsorted(ts, from_ts, "left")
+            end = np.searchsorted(ts, to_ts, "right")
+            if (start < end):
+                parts.append({ name : a[start:end] for name, a in columns.items() })
+
+        if (len(parts) == 0):
+            columns = empty_columns(stream)
+        elif (len(parts) == 1):
+            columns = parts[0]
+        else:
+            columns = { name : np.concatenate([part[name] for part in parts]) for name, _, _ in STREAMS[stream] }
+
+        if (period is not None):
+            columns = downsample(stream, columns, period)
+
+        return columns
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Minimal asyncio MQTT 3.1.1 subscriber
+
+Only what the recorder needs: connect, subscribe, receive QoS 0 and 1
+publishes and keep the connection alive. The packets are parsed from large
+reads instead of a read per packet, which is what makes thousands of messages
+per second cheap.
+"""
+import asyncio
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+class MQTTError(Exception):
+    pass
+
+def encode_len(n):
+    b = bytearray()
+    while (True):
+        digit = n & 0x7F
+        n >>= 7
+        if (n > 0):
+            digit |= 0x80
+        b.append(digit)
+        if (n == 0):
+            return bytes(b)
+
+def encode_str(s):
+    b = s.encode("utf-8")
+    return struct.pack("!H", len(b)) + b
+
+class MQTTSubscriber:
+    def __init__(self, host, port=1883, client_id="lessmostat-recorder", clean_session=True,
+        keepalive_secs=60, reconnect_secs=5):
+        """
+        @param clean_session False to have the broker keep the subscriptions
+               and queue the QoS 1 messages while disconnected
+        """
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.clean_session = clean_session
+        self.keepalive_secs = keepalive_secs
+        self.reconnect_secs = reconnect_secs
+        self.pid = 0
+        self.stats = {
+            "connections" : 0,
+            "messages" : 0,
+            "bytes" : 0,
+        }
+
+    def next_pid(self):
+        self.pid = (self.pid % 0xFFFF) + 1
+        return self.pid
+
+    async def connect(self, patterns):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        body = (encode_str("MQTT") + bytes([4, 0x02 if self.clean_session else 0x00]) +
+            struct.pack("!H", self.keepalive_secs) + encode_str(self.client_id))
+        writer.write(b"\x10" + encode_len(len(body)) + body)
+
+        body = struct.pack("!H", self.next_pid())
+        for pattern in patterns:
+            body += encode_str(pattern) + b"\x01"
+        writer.write(b"\x82" + encode_len(len(body)) + body)
+        await writer.drain()
+
+        return reader, writer
+
+    async def ping(self, writer):
+        try:
+            while (True):
+                await asyncio.sleep(self.keepalive_secs / 2.0)
+                writer.write(b"\xc0\x00")
+                await writer.drain()
+
+        except OSError:
+            # The receive loop will notice the connection is broken
+            pass
+
+    async def receive(self, reader, writer, callback):
+        buf = bytearray()
+        while (True):
+            data = await reader.read(65536)
+            if (len(data) == 0):
+                raise MQTTError("Connection closed by the broker")
+            buf += data
+
+            # Parse all the complete packets
+            i = 0
+            while (True):
+                # Decode the remaining length
+                j = i + 1
+                sz = 0
+                shift = 0
+                while ((j < len(buf)) and (buf[j] & 0x80)):
+                    sz |= (buf[j] & 0x7F) << shift
+                    shift += 7
+                    j += 1
+                if (j >= len(buf)):
+                    break
+                sz |= buf[j] << shift
+                j += 1
+                if (j + sz > len(buf)):
+                    break
+
+                op = buf[i]
+                kind = op & 0xF0
+                if (kind == 0x30):
+                    # PUBLISH
+                    (topic_len,) = struct.unpack_from("!H", buf, j)
+                    topic = buf[j + 2:j + 2 + topic_len].decode("utf-8")
+                    k = j + 2 + topic_len
+                    if (op & 0x06):
+                        (pid,) = struct.unpack_from("!H", buf, k)
+                        k += 2
+                        writer.write(b"\x40\x02" + struct.pack("!H", pid))
+                    self.stats["messages"] += 1
+                    self.stats["bytes"] += j + sz - k
+                    callback(topic, bytes(buf[k:j + sz]))
+
+                elif (kind == 0x20):
+                    # CONNACK
+                    if (buf[j + 1] != 0):
+                        raise MQTTError("Connection refused with code %d" % buf[j + 1])
+                    logger.info("Connected to %s:%d", self.host, self.port)
+
+                elif (kind == 0x90):
+                    # SUBACK
+                    if (0x80 in buf[j + 2:j + sz]):
+                        raise MQTTError("Subscription refused")
+
+                i = j + sz
+
+            del buf[:i]
+
+    async def run(self, patterns, callback):
+        """
+        Receive the messages on the given topic patterns forever, reconnecting
+        on errors
+
+        @param callback function called with the topic string and payload bytes
+        """
+        while (True):
+            writer = None
+            ping_task = None
+            try:
+                reader, writer = await self.connect(patterns)
+                self.stats["connections"] += 1
+                ping_task = asyncio.ensure_future(self.ping(writer))
+                await self.receive(reader, writer, callback)
+
+            except (OSError, MQTTError) as e:
+                logger.warning("MQTT connection to %s:%d failed: %s, reconnecting in %ds",
+                    self.host, self.port, e, self.reconnect_secs)
+
+            finally:
+                if (ping_task is not None):
+                    ping_task.cancel()
+                if (writer is not None):
+                    writer.close()
+
+            await asyncio.sleep(self.reconnect_secs)
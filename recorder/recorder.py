@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Decode the device info messages and append them to the archive in batches
+
+A device is identified by its topic root, eg the messages on
+"apartment/lessmostat/info/sensor" are recorded for "apartment/lessmostat".
+The messages are decoded into rows appended to in-memory columns, which are
+written to the archive once there are enough rows or after some time, so the
+archive sees a few large appends instead of one per message.
+"""
+import array
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+from recorder.archive import RELAY_BITS, RELAY_NAMES, STREAMS
+
+logger = logging.getLogger(__name__)
+
+upython_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "upython")
+
+def import_telemetry():
+    """
+    Import upython/telemetry.py, which decodes the binary sensor samples, without
+    leaving the firmware modules (eg its logging.py) in the import path
+    """
+    sys.path.insert(0, upython_dir)
+    try:
+        import telemetry
+    finally:
+        sys.path.remove(upython_dir)
+
+    return telemetry
+
+telemetry = import_telemetry()
+
+# Array typecodes for the buffered columns, same size as the archive dtypes
+ARRAY_TYPECODES = {
+    "<u4" : "I",
+    "<i2" : "h",
+    "<u2" : "H",
+    "u1" : "B",
+}
+
+# Info subtopics recorded
+SUBTOPICS = ("sensor", "sensor_bin", "ac", "heat", "fan", "state", "state_delta")
+
+def subscription_patterns(topic_root):
+    """
+    @param topic_root topic root of the devices, with MQTT wildcards, eg
+           "+/lessmostat/"
+    """
+    return [topic_root + "info/" + subtopic for subtopic in SUBTOPICS]
+
+class Recorder:
+    def __init__(self, archive, batch_rows=16384, flush_secs=10.0):
+        """
+        @param batch_rows rows buffered in memory before writing them to the
+               archive
+        @param flush_secs maximum time rows are buffered, see tick
+        """
+        self.archive = archive
+        self.batch_rows = batch_rows
+        self.flush_secs = flush_secs
+        # (device, stream) to dict of column name to array.array
+        self.batches = {}
+        self.batched_rows = 0
+        self.last_flush_time = time.time()
+        # Device to dict with the relay bitmask, the timestamp of the last
+        # sensor sample and the last state snapshot
+        self.devices = {}
+        # Devices with a state snapshot not written to the archive yet
+        self.dirty_states = set()
+        self.handlers = {
+            "sensor" : self.on_sensor,
+            "sensor_bin" : self.on_sensor_bin,
+            "ac" : self.on_relay,
+            "heat" : self.on_relay,
+            "fan" : self.on_relay,
+            "state" : self.on_state,
+            "state_delta" : self.on_state_delta,
+        }
+        self.stats = {
+            "messages" : 0,
+            "ignored" : 0,
+            "duplicates" : 0,
+            "errors" : 0,
+            "rows" : 0,
+            "flushes" : 0,
+        }
+
+    def device(self, name):
+        device = self.devices.get(name, None)
+        if (device is None):
+            device = { "relays" : 0, "sensor_ts" : None, "state" : None }
+            self.devices[name] = device
+
+        return device
+
+    def append_row(self, name, stream, row):
+        key = (name, stream)
+        columns = self.batches.get(key, None)
+        if (columns is None):
+            columns = [array.array(ARRAY_TYPECODES[dtype]) for _, dtype, _ in STREAMS[stream]]
+            self.batches[key] = columns
+        for column, value in zip(columns, row):
+            column.append(value)
+
+        self.batched_rows += 1
+        self.stats["rows"] += 1
+        if (self.batched_rows >= self.batch_rows):
+            self.flush()
+
+    def on_message(self, topic, payload):
+        """
+        Record a message, this can be used directly as the callback of the
+        MQTT subscriber or of the simulator broker
+
+        @param topic string
+        @param payload bytes
+        """
+        self.stats["messages"] += 1
+        i = topic.rfind("/info/")
+        handler = self.handlers.get(topic[i + 6:], None) if (i >= 0) else None
+        if (handler is None):
+            self.stats["ignored"] += 1
+            return
+
+        name = topic[:i]
+        try:
+            handler(name, self.device(name), topic[i + 6:], payload)
+
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            self.stats["errors"] += 1
+            logger.debug("Ignoring malformed message on %s %r: %s", topic, payload, e)
+
+    def on_sensor_sample(self, name, device, ts, temp, humid, relays):
+        # Devices can publish the sample both as JSON and binary
+        if (ts == device["sensor_ts"]):
+            self.stats["duplicates"] += 1
+            return
+        device["sensor_ts"] = ts
+        self.append_row(name, "sensor", (ts, temp, humid, relays))
+
+    def on_sensor(self, name, device, subtopic, payload):
+        msg = json.loads(payload)
+        self.on_sensor_sample(name, device, msg["ts"], int(round(msg["temp"] * 10)),
+            int(round(msg["humid"] * 10)), device["relays"])
+
+    def on_sensor_bin(self, name, device, subtopic, payload):
+        version, ts, temp, humid, relays = struct.unpack(telemetry.telemetry_format, payload[:telemetry.telemetry_size])
+        if (version != telemetry.telemetry_version):
+            raise ValueError("Unsupported telemetry version %d" % version)
+        device["relays"] = relays
+        self.on_sensor_sample(name, device, ts, temp, humid, relays)
+
+    def set_relay(self, device, relay, on):
+        if (on):
+            device["relays"] |= RELAY_BITS[relay]
+        else:
+            device["relays"] &= ~RELAY_BITS[relay]
+
+    def on_relay(self, name, device, subtopic, payload):
+        msg = json.loads(payload)
+        relay = RELAY_NAMES.index(subtopic)
+        on = (msg["state"] == "on")
+        self.set_relay(device, relay, on)
+        # Use the time of the change, the message may have been buffered
+        ts = msg.get("mod_ts", None) or msg["ts"]
+        self.append_row(name, "relays", (ts, relay, int(on), msg.get("uptime", 0)))
+
+    def apply_state(self, device, state):
+        for relay, relay_name in enumerate(RELAY_NAMES):
+            if (relay_name in state):
+                self.set_relay(device, relay, state[relay_name] == "on")
+
+    def on_state(self, name, device, subtopic, payload):
+        msg = json.loads(payload)
+        device["state"] = msg
+        self.apply_state(device, msg["state"])
+        self.dirty_states.add(name)
+
+    def on_state_delta(self, name, device, subtopic, payload):
+        msg = json.loads(payload)
+        delta = msg["state"]
+        self.apply_state(device, delta)
+        # Merge into the last snapshot, same as html/lessmostat.html
+        snapshot = device["state"]
+        if (snapshot is None):
+            return
+        state = snapshot["state"]
+        for key, value in delta.items():
+            if (key == "config"):
+                state["config"].update(value)
+            else:
+                state[key] = value
+        snapshot["ts"] = msg["ts"]
+        self.dirty_states.add(name)
+
+    def flush(self):
+        """
+        Write the buffered rows and state snapshots to the archive
+        """
+        for (name, stream), columns in self.batches.items():
+            self.archive.append(name, stream, { spec[0] : column for spec, column in zip(STREAMS[stream], columns) })
+        for name in self.dirty_states:
+            self.archive.write_state(name, self.devices[name]["state"])
+
+        self.batches = {}
+        self.batched_rows = 0
+        self.dirty_states = set()
+        self.last_flush_time = time.time()
+        self.stats["flushes"] += 1
+
+    def tick(self):
+        """
+        Flush if rows have been buffered for too long, to be called
+        periodically
+        """
+        if (((self.batched_rows > 0) or (len(self.dirty_states) > 0)) and
+            (time.time() - self.last_flush_time >= self.flush_secs)):
+            self.flush()
@@ -0,0 +1,10 @@
+"""
+Host-side simulator for the lessmostat firmware
+
+Runs the unmodified firmware in upython/ on CPython against stand-ins for the
+dht, machine, ntptime and usocket MicroPython modules, an in-process MQTT
+broker and a virtual clock, so weeks of thermostat operation can be simulated
+in seconds.
+
+See python3 -m simulator --help
+"""
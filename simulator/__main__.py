@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Command line for the simulator, eg simulate a week with the repo config and a
+setpoint change after one day
+
+    python3 -m simulator --days 7 --config upython/lessmostat.cfg \\
+        --control '24:control/ac:{"state":"on","temp":24,"humid":60}'
+"""
+import argparse
+import json
+
+from simulator.room import csv_curve, sine_curve
+from simulator.simulation import Simulation
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the lessmostat firmware against simulated devices")
+    parser.add_argument("--days", type=float, default=7, help="simulated days to run")
+    parser.add_argument("--config", help="lessmostat.cfg to start with, defaults to the firmware defaults")
+    parser.add_argument("--workdir", help="directory for the firmware config, log and console files")
+    parser.add_argument("--outdoor-mean", type=float, default=29.0, help="outdoor temperature daily mean")
+    parser.add_argument("--outdoor-amplitude", type=float, default=5.0, help="outdoor temperature daily amplitude")
+    parser.add_argument("--outdoor-csv", help="file with hour,temperature lines for the outdoor temperature")
+    parser.add_argument("--coast-mins", type=float, default=0.0,
+        help="time constant of the lag of the AC/heat effect behind the relays")
+    parser.add_argument("--ntp-failure-rate", type=float, default=0.0, help="probability of NTP timeouts")
+    parser.add_argument("--control", action="append", default=[],
+        help="HOURS:SUBTOPIC:JSON control message to publish at the given simulated hours")
+    parser.add_argument("--outage", action="append", default=[],
+        help="HOURS:DURATION_HOURS broker outage")
+    parser.add_argument("--trace-memory", action="store_true", help="trace host memory allocations")
+    parser.add_argument("--record", help="archive directory to record the device messages to, see the recorder package")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if (args.outdoor_csv is not None):
+        outdoor_temp = csv_curve(args.outdoor_csv)
+    else:
+        outdoor_temp = sine_curve(args.outdoor_mean, args.outdoor_amplitude)
+
+    sim = Simulation(days=args.days, outdoor_temp=outdoor_temp, config_filepath=args.config,
+        workdir=args.workdir, trace_memory=args.trace_memory,
+        ntp_failure_rate=args.ntp_failure_rate, seed=args.seed, room_args={ "coast_secs" : args.coast_mins * 60 })
+
+    for control in args.control:
+        hours, subtopic, msg = control.split(":", 2)
+        sim.schedule_control(float(hours), subtopic, json.loads(msg))
+
+    for outage in args.outage:
+        hours, duration_hours = outage.split(":")
+        sim.schedule_outage(float(hours), float(duration_hours))
+
+    recorder = None
+    if (args.record is not None):
+        # Imported here since the recorder needs numpy
+        from recorder.archive import Archive
+        from recorder.recorder import Recorder
+        recorder = Recorder(Archive(args.record))
+        sim.install()
+        sim.broker.subscribe("#", recorder.on_message)
+
+    report = sim.run()
+    if (recorder is not None):
+        recorder.flush()
+        report["recorder"] = recorder.stats
+    print(json.dumps(report, indent=4, sort_keys=True))
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Backtest rule configurations against recorded or synthetic sensor traces, eg
+sweep the hysteresis and the AC temperature over a year of a recorded device
+
+    python3 -m simulator.backtest --archive _out/archive \\
+        --device apartment/lessmostat --from 2021-01-01 --to 2022-01-01 \\
+        --sweep hi_threshold_decidegs=2,4,8 --sweep lo_threshold_decidegs=2,4,8 \\
+        --sweep ac_rules.0.temp=24,25,26
+
+or against a synthetic trace of the room without AC or heat
+
+    python3 -m simulator.backtest --synthetic-days 365 --config upython/lessmostat.cfg \\
+        --sweep hi_threshold_decidegs=2,4,8
+
+Each sample of the trace goes through the firmware's own rules_check,
+thermal model, turn_ac_heat, turn_fan and relay queue, imported from upython/ as the
+simulator does, but without the rest of the main loop, which is what makes a
+year of samples take seconds. The sensor values fed to the rules are the
+recorded ones corrected for the backtest relays: where the backtest relays
+differ from the recorded ones (eg the AC recorded on but off in the backtest)
+the difference builds up at the cooling/heating rates of the room model and
+decays with its time constant, see TraceRoom.
+
+The configurations are run in parallel in a process pool, the firmware keeps
+its state in module globals so each worker process runs one configuration at
+a time.
+"""
+import argparse
+import array
+import concurrent.futures
+import copy
+import itertools
+import json
+import math
+import time
+
+from simulator.clock import VirtualClock, uepoch_delta_seconds
+from simulator.devices import FakeRelayUART
+from simulator.room import DAY_SECS, Room, sine_curve
+from simulator.simulation import Simulation, utc_to_upython_secs
+
+# Trace columns, same as the sensor stream of the recorder archive: unix epoch
+# timestamp, temperature in tenths of degree, humidity in tenths of percentage
+# and the relay bitmask at the time of the sample
+TRACE_COLUMNS = ("ts", "temp", "humid", "relays")
+
+# Relay bits in the trace relay bitmask, see upython/telemetry.py
+AC_BIT = 0x01
+HEAT_BIT = 0x02
+
+# Samples further apart than this are a gap in the trace, the comfort
+# deviation is not accumulated over the gap
+DEFAULT_MAX_GAP_SECS = 15 * 60
+
+# The temperature past the off threshold is overshoot while the AC/heat is on
+# and for this long after it stops, when it coasts past the threshold
+OVERSHOOT_SECS = 20 * 60
+
+class TraceRoom:
+    """
+    Room following a recorded trace, corrected for the backtest relays
+
+    The room model is linear, so the difference between the room with the
+    backtest relays and the recorded room follows the same first order model
+    as simulator.room.Room, only driven by the difference between the backtest
+    and the recorded cooling/heating instead of by the outdoor temperature
+    """
+    def __init__(self, clock, tau_secs=4 * 3600, cool_rate=3.0, heat_rate=3.0, dehumid_rate=10.0,
+        coast_secs=0):
+        """
+        @param tau_secs, cool_rate, heat_rate, dehumid_rate, coast_secs see
+               Room
+        """
+        self.clock = clock
+        self.tau_secs = float(tau_secs)
+        self.cool_rate = cool_rate / 3600.0
+        self.heat_rate = heat_rate / 3600.0
+        self.dehumid_rate = dehumid_rate / 3600.0
+        self.coast_secs = float(coast_secs)
+
+        self.t = clock.now
+        # Backtest minus recorded values
+        self.temp_delta = 0.0
+        self.humid_delta = 0.0
+        self.ac = False
+        self.heat = False
+        self.recorded_ac = False
+        self.recorded_heat = False
+        # Backtest minus recorded fraction of the cooling/heating rate applied,
+        # see Room
+        self.ac_level = 0.0
+        self.heat_level = 0.0
+
+    def update(self):
+        """
+        Integrate the model up to the current clock time, exactly since the
+        relay states are constant between updates
+        """
+        dt = self.clock.now - self.t
+        if (dt <= 0):
+            return
+        decay = math.exp(-dt / self.tau_secs)
+        gain = self.tau_secs * (1.0 - decay)
+        ac = float(int(self.ac) - int(self.recorded_ac))
+        heat = float(int(self.heat) - int(self.recorded_heat))
+        temp_delta = self.temp_delta * decay + (heat * self.heat_rate - ac * self.cool_rate) * gain
+        humid_delta = self.humid_delta * decay - ac * self.dehumid_rate * gain
+        if (self.coast_secs > 0):
+            # The levels approach the relay states exponentially, add the
+            # response to the part still to go
+            level_decay = math.exp(-dt / self.coast_secs)
+            ac_left = self.ac_level - ac
+            heat_left = self.heat_level - heat
+            if (self.coast_secs == self.tau_secs):
+                level_gain = dt * decay
+            else:
+                level_gain = (level_decay - decay) / (1.0 / self.tau_secs - 1.0 / self.coast_secs)
+            temp_delta += (heat_left * self.heat_rate - ac_left * self.cool_rate) * level_gain
+            humid_delta -= ac_left * self.dehumid_rate * level_gain
+            self.ac_level = ac + ac_left * level_decay
+            self.heat_level = heat + heat_left * level_decay
+        self.temp_delta = temp_delta
+        self.humid_delta = humid_delta
+        self.t = self.clock.now
+
+    def set_relays(self, ac, heat):
+        self.update()
+        self.ac = ac
+        self.heat = heat
+
+    def set_recorded_relays(self, relays):
+        """
+        @param relays recorded relay bitmask from now until the next sample
+        """
+        self.update()
+        self.recorded_ac = ((relays & AC_BIT) != 0)
+        self.recorded_heat = ((relays & HEAT_BIT) != 0)
+
+def synthetic_trace(days, start_time=None, outdoor_temp=None, outdoor_humid=None, period_secs=30):
+    """
+    Sample the simulator room model with the AC and heat off
+
+    @param start_time start time in seconds since 2000, defaults to
+           2021-07-01 00:00 UTC
+    @param outdoor_temp, outdoor_humid see Simulation
+    @return trace dict of column name to array.array, see TRACE_COLUMNS
+    """
+    if (start_time is None):
+        start_time = utc_to_upython_secs(2021, 7, 1)
+    if (outdoor_temp is None):
+        outdoor_temp = sine_curve(29.0, 5.0)
+    if (outdoor_humid is None):
+        outdoor_humid = sine_curve(60.0, -10.0)
+
+    clock = VirtualClock(start_time)
+    room = Room(clock, outdoor_temp, outdoor_humid)
+    trace = { name : array.array("l") for name in TRACE_COLUMNS }
+    for _ in range(int(days * DAY_SECS / period_secs)):
+        room.update()
+        trace["ts"].append(int(clock.now) + uepoch_delta_seconds)
+        trace["temp"].append(int(round(room.temp * 10)))
+        trace["humid"].append(int(round(room.humid * 10)))
+        trace["relays"].append(0)
+        clock.advance(period_secs)
+
+    return trace
+
+def archive_trace(archive, device, from_ts, to_ts):
+    """
+    @param archive recorder.archive.Archive
+    @return trace with the device's sensor samples from from_ts to to_ts, both
+            included
+    """
+    columns = archive.read(device, "sensor", from_ts, to_ts)
+
+    return { name : array.array("l", columns[name].tolist()) for name in TRACE_COLUMNS }
+
+def set_config_value(config, path, value):
+    """
+    @param path config key, or dot-separated keys and list indices for nested
+           values, eg "ac_rules.0.temp"
+    """
+    keys = path.split(".")
+    for key in keys[:-1]:
+        config = config[int(key)] if isinstance(config, list) else config[key]
+    key = keys[-1]
+    if (isinstance(config, list)):
+        config[int(key)] = value
+    else:
+        config[key] = value
+
+def sweep_configs(config, sweeps):
+    """
+    @param sweeps list of (path, values) tuples, see set_config_value
+    @return list of (params, config) tuples for all the combinations of the
+            values, where params is a dict of path to value
+    """
+    paths = [path for path, _ in sweeps]
+    configs = []
+    for values in itertools.product(*[values for _, values in sweeps]):
+        swept = copy.deepcopy(config)
+        for path, value in zip(paths, values):
+            set_config_value(swept, path, value)
+        configs.append((dict(zip(paths, values)), swept))
+
+    return configs
+
+def comfort_setpoints(config):
+    """
+    @return tuple with the lowest AC rule temperature, the highest heat rule
+            temperature and the lowest AC rule humidity, None if there's no
+            such rule
+    """
+    def values(rules, key):
+        return [rule[key] for rule in rules if ((rule["state"] == "on") and (rule.get(key, None) is not None))]
+
+    ac_temps = values(config["ac_rules"], "temp")
+    heat_temps = values(config["heat_rules"], "temp")
+    ac_humids = values(config["ac_rules"], "humid")
+
+    return (min(ac_temps) if ac_temps else None, max(heat_temps) if heat_temps else None,
+        min(ac_humids) if ac_humids else None)
+
+def safety_violations(transitions):
+    """
+    Check the relay transitions against the rules turn_ac_heat and turn_fan
+    in upython/lessmostat.py enforce
+
+    @param transitions list of (time, relay name, on) tuples, see FakeRelayUART
+    @return dict of rule to violation count
+    """
+    violations = {
+        # AC or heat started with the fan off
+        "fan_not_on" : 0,
+        # AC and heat on at the same time
+        "ac_and_heat" : 0,
+    }
+    on = { "ac" : False, "heat" : False, "fan" : False }
+    for t, name, turned_on in transitions:
+        if (turned_on and (name != "fan")):
+            if (not on["fan"]):
+                violations["fan_not_on"] += 1
+            if (on["heat" if (name == "ac") else "ac"]):
+                violations["ac_and_heat"] += 1
+        on[name] = turned_on
+
+    return violations
+
+def limit_exceedances(transitions, end_time, min_off_secs, max_on_secs):
+    """
+    Check the AC and heat cycles against optional rest and run time limits,
+    which the firmware doesn't enforce, eg to see how often a configuration
+    restarts the compressor too soon
+
+    @param min_off_secs rest below which a restart counts as short_off, None
+           not to check
+    @param max_on_secs run above which a cycle counts as long_on, None not to
+           check
+    @return dict of "ac"/"heat" to dict of limit to count
+    """
+    limits = {}
+    for name in ("ac", "heat"):
+        limits[name] = {}
+        if (min_off_secs is not None):
+            limits[name]["short_off"] = 0
+        if (max_on_secs is not None):
+            limits[name]["long_on"] = 0
+    on_since = {}
+    off_since = {}
+    for t, name, turned_on in transitions:
+        if (name not in limits):
+            continue
+        if (turned_on):
+            if ((min_off_secs is not None) and (name in off_since) and (t - off_since[name] < min_off_secs)):
+                limits[name]["short_off"] += 1
+            on_since[name] = t
+
+        else:
+            if ((max_on_secs is not None) and (name in on_since) and (t - on_since[name] > max_on_secs)):
+                limits[name]["long_on"] += 1
+            on_since.pop(name, None)
+            off_since[name] = t
+
+    # A cycle still running at the end counts if it's already over the limit
+    if (max_on_secs is not None):
+        for name, since in on_since.items():
+            if (end_time - since > max_on_secs):
+                limits[name]["long_on"] += 1
+
+    return limits
+
+class Backtest:
+    def __init__(self, trace, config, params=None, min_off_secs=None, max_on_secs=None,
+        max_gap_secs=DEFAULT_MAX_GAP_SECS, room_args=None):
+        """
+        @param trace dict of column name to sequence, see TRACE_COLUMNS
+        @param config lessmostat.cfg config to run, merged over the firmware
+               defaults
+        @param params dict copied to the report to identify the configuration,
+               see sweep_configs
+        @param min_off_secs, max_on_secs optional AC/heat rest and run time
+               limits to report the cycles exceeding, see limit_exceedances
+        @param room_args dict of keyword arguments for TraceRoom, None for the
+               defaults
+        """
+        if (len(trace["ts"]) == 0):
+            raise ValueError("Empty trace")
+
+        self.trace = trace
+        self.config = config
+        self.params = params
+        self.min_off_secs = min_off_secs
+        self.max_on_secs = max_on_secs
+        self.max_gap_secs = max_gap_secs
+
+        self.sim = Simulation(days=None, start_time=trace["ts"][0] - uepoch_delta_seconds)
+        self.clock = self.sim.clock
+        self.room = TraceRoom(self.clock, **({} if (room_args is None) else room_args))
+        self.uart = FakeRelayUART(self.clock, self.room)
+
+        # Comfort statistics
+        self.ac_temp, self.heat_temp, self.ac_humid = comfort_setpoints(config)
+        # Temperatures past which the AC and the heat should already be off
+        self.ac_off_temp = None
+        if (self.ac_temp is not None):
+            self.ac_off_temp = self.ac_temp - config["lo_threshold_decidegs"] / 10.0
+        self.heat_off_temp = None
+        if (self.heat_temp is not None):
+            self.heat_off_temp = self.heat_temp + config["hi_threshold_decidegs"] / 10.0
+        self.temp_degree_secs = 0.0
+        self.overshoot_degree_secs = 0.0
+        # Last time the AC/heat was seen on
+        self.ac_on_t = None
+        self.heat_on_t = None
+        self.temp_max_deviation = 0.0
+        self.humid_percent_secs = 0.0
+        self.covered_secs = 0.0
+
+    def run(self):
+        """
+        Feed the trace through the firmware rules and relay logic
+
+        @return report dict
+        """
+        start = time.perf_counter()
+        sim = self.sim
+        sim.install()
+        modules = sim.modules
+        logging = modules["logging"]
+        lessmostat = modules["lessmostat"]
+        mqtt = modules["mqtt"]
+        relays_module = modules["relays"]
+        rules = modules["rules"]
+
+        # Only the decisions matter, don't format or print the log messages
+        logging.log_set_level(logging.LOG_ERROR)
+        logging.log_set_stdout(False)
+
+        state = lessmostat.state
+        state["config"].update(copy.deepcopy(self.config))
+        # Same initialization as main_async
+        now_ts = mqtt.get_epoch()
+        for key in ("start_ts", "ac_mod_ts", "heat_mod_ts", "fan_mod_ts"):
+            state[key] = now_ts
+        relays = relays_module.relays_create(self.uart)
+        # The relay changes are published as in the firmware, to the simulator
+        # broker
+        client = mqtt.mqtt_create("localhost", b"backtest", state["config"]["mqtt_topic"], lessmostat.sub_cb)
+        mqtt.mqtt_connect(client)
+
+        # Same callbacks as rules_task
+        turn_ac_heat = mqtt.partial(lessmostat.turn_ac_heat, relays, client)
+        turn_fan = mqtt.partial(lessmostat.turn_fan, relays, client)
+        rules_check = rules.rules_check
+        rules_set_sensor = rules.rules_set_sensor
+        update_thermal_model = lessmostat.update_thermal_model
+        get_epoch = mqtt.get_epoch
+        relays_tick = relays_module.relays_tick
+        relays_pending = relays_module.relays_pending
+        poll_secs = lessmostat.rules_poll_ms / 1000.0
+        clock = self.clock
+        room = self.room
+        uart = self.uart
+        sensor = state["sensor"]
+        trace = self.trace
+        prev_t = None
+        prev_temp = None
+        prev_humid = None
+
+        for ts, temp, humid, recorded_relays in zip(trace["ts"], trace["temp"], trace["humid"], trace["relays"]):
+            t = ts - uepoch_delta_seconds
+            if (t > clock.now):
+                clock.advance(t - clock.now)
+            room.update()
+            # Same resolution as the DHT22
+            temp = round(temp / 10.0 + room.temp_delta, 1)
+            humid = round(max(0.0, min(100.0, humid / 10.0 + room.humid_delta)), 1)
+            room.set_recorded_relays(recorded_relays)
+
+            if (prev_t is not None):
+                # The relays are still the ones since the previous sample
+                self.accumulate_comfort(prev_t, t - prev_t, prev_temp, prev_humid, room.ac, room.heat)
+            prev_t, prev_temp, prev_humid = t, temp, humid
+
+            sensor["temp"] = temp
+            sensor["humid"] = humid
+            rules_set_sensor(temp, humid)
+            update_thermal_model(get_epoch(), int(round(temp * 10)))
+
+            # Run the rules task loop until the rules settle and the relay
+            # commands are written
+            write_count = uart.write_count
+            while (True):
+                changes = rules_check(state, turn_ac_heat, turn_fan)
+                relays_tick(relays)
+                if ((changes == 0) and (relays_pending(relays) == 0)):
+                    break
+                clock.advance(poll_secs)
+
+            if (uart.write_count != write_count):
+                # Process the acks of the relay messages, as mqtt_task would
+                while (mqtt.mqtt_check_msg(client) is not None):
+                    pass
+
+        return self.report(time.perf_counter() - start)
+
+    def accumulate_comfort(self, t, dt, temp, humid, ac, heat):
+        """
+        Accumulate the deviation from the setpoints of a sample over the time
+        until the next sample
+
+        @param ac, heat relay states until the next sample
+        """
+        if (dt > self.max_gap_secs):
+            return
+        self.covered_secs += dt
+
+        deviation = 0.0
+        if ((self.ac_temp is not None) and (temp > self.ac_temp)):
+            deviation = temp - self.ac_temp
+        elif ((self.heat_temp is not None) and (temp < self.heat_temp)):
+            deviation = self.heat_temp - temp
+        self.temp_degree_secs += deviation * dt
+        self.temp_max_deviation = max(self.temp_max_deviation, deviation)
+
+        if ((self.ac_humid is not None) and (humid > self.ac_humid)):
+            self.humid_percent_secs += (humid - self.ac_humid) * dt
+
+        if (ac):
+            self.ac_on_t = t
+        if (heat):
+            self.heat_on_t = t
+        if ((self.ac_on_t is not None) and (t - self.ac_on_t < OVERSHOOT_SECS) and
+            (self.ac_off_temp is not None) and (temp < self.ac_off_temp)):
+            self.overshoot_degree_secs += (self.ac_off_temp - temp) * dt
+        elif ((self.heat_on_t is not None) and (t - self.heat_on_t < OVERSHOOT_SECS) and
+            (self.heat_off_temp is not None) and (temp > self.heat_off_temp)):
+            self.overshoot_degree_secs += (temp - self.heat_off_temp) * dt
+
+    def report(self, wall_secs):
+        uart = self.uart
+        secs = float(self.trace["ts"][-1] - self.trace["ts"][0])
+        days = secs / DAY_SECS
+        r = {
+            "params" : self.params,
+            "samples" : len(self.trace["ts"]),
+            "days" : days,
+            "wall_secs" : wall_secs,
+            "relays" : {},
+            "relay_writes" : uart.write_count,
+            "relay_writes_lost" : uart.lost_count,
+            "comfort" : {
+                "ac_temp" : self.ac_temp,
+                "heat_temp" : self.heat_temp,
+                "ac_humid" : self.ac_humid,
+                # Time integral of the temperature over the AC temperature or
+                # under the heat temperature, and of the humidity over the AC
+                # humidity
+                "temp_degree_hours" : self.temp_degree_secs / 3600.0,
+                "temp_mean_deviation" : self.temp_degree_secs / max(self.covered_secs, 1e-9),
+                "temp_max_deviation" : self.temp_max_deviation,
+                "humid_percent_hours" : self.humid_percent_secs / 3600.0,
+                # Time integral of the temperature past the off threshold
+                # with the AC or heat on (eg kept on by the humidity) or
+                # coasting after they stopped
+                "overshoot_degree_hours" : self.overshoot_degree_secs / 3600.0,
+            },
+            "violations" : safety_violations(uart.transitions),
+        }
+        for name in ["ac", "heat", "fan"]:
+            on_secs = uart.get_on_secs(name)
+            r["relays"][name] = {
+                "cycles" : uart.cycles[name],
+                "cycles_per_day" : uart.cycles[name] / max(days, 1e-9),
+                "on_hours" : on_secs / 3600.0,
+                "duty" : on_secs / max(secs, 1e-9),
+            }
+
+        if ((self.min_off_secs is not None) or (self.max_on_secs is not None)):
+            r["limits"] = limit_exceedances(uart.transitions, self.clock.now, self.min_off_secs, self.max_on_secs)
+            r["limits"]["min_off_secs"] = self.min_off_secs
+            r["limits"]["max_on_secs"] = self.max_on_secs
+
+        return r
+
+# Trace and Backtest arguments of the worker processes, see run_sweep
+worker_args = None
+
+def init_worker(trace, kwargs):
+    global worker_args
+    worker_args = (trace, kwargs)
+
+def run_worker(params_config):
+    trace, kwargs = worker_args
+    params, config = params_config
+
+    return Backtest(trace, config, params, **kwargs).run()
+
+def run_sweep(trace, configs, processes=None, **kwargs):
+    """
+    Backtest the configurations in parallel
+
+    @param configs list of (params, config) tuples, see sweep_configs
+    @param processes number of worker processes, defaults to the number of
+           CPUs, 1 to run in this process
+    @param kwargs keyword arguments for Backtest
+    @return list of reports in the same order as the configurations
+    """
+    if (processes == 1):
+        return [Backtest(trace, config, params, **kwargs).run() for params, config in configs]
+
+    # The trace is sent once to each worker instead of with every
+    # configuration
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker,
+        initargs=(trace, kwargs)) as executor:
+        return list(executor.map(run_worker, configs))
+
+def parse_sweep(s):
+    """
+    @param s PATH=VALUE[,VALUE...] with JSON values, see set_config_value
+    """
+    path, _, values = s.partition("=")
+    return (path, [json.loads(value) for value in values.split(",")])
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest lessmostat rule configurations against sensor traces")
+    parser.add_argument("--archive", help="recorder archive directory to take the trace from")
+    parser.add_argument("--device", help="device topic root in the archive, eg apartment/lessmostat")
+    parser.add_argument("--from", dest="from_ts", default="0",
+        help="unix timestamp, negative seconds relative to now, now or UTC YYYY-MM-DD[THH:MM]")
+    parser.add_argument("--to", dest="to_ts", default="now", help="same as --from")
+    parser.add_argument("--synthetic-days", type=float, help="use a synthetic trace of this many days instead")
+    parser.add_argument("--synthetic-period", type=int, default=30, help="seconds between synthetic samples")
+    parser.add_argument("--outdoor-mean", type=float, default=29.0, help="synthetic outdoor temperature daily mean")
+    parser.add_argument("--outdoor-amplitude", type=float, default=5.0, help="synthetic outdoor temperature daily amplitude")
+    parser.add_argument("--config", help="lessmostat.cfg to start with, defaults to the last config recorded for the "
+        "device or to the firmware defaults")
+    parser.add_argument("--set", action="append", default=[], help="PATH=VALUE config value to set, eg "
+        "ac_rules.0.humid=60")
+    parser.add_argument("--sweep", action="append", default=[], help="PATH=VALUE,VALUE... config values to sweep, "
+        "all the combinations of the swept values are backtested")
+    parser.add_argument("--processes", type=int, help="worker processes, defaults to the number of CPUs")
+    parser.add_argument("--min-off-mins", type=float, help="report the AC/heat restarts after resting less than this, "
+        "eg 5, the firmware doesn't enforce it")
+    parser.add_argument("--max-on-mins", type=float, help="report the AC/heat cycles running longer than this, eg 30, "
+        "the firmware doesn't enforce it")
+    parser.add_argument("--tau-hours", type=float, default=4.0, help="room model time constant")
+    parser.add_argument("--cool-rate", type=float, default=3.0, help="room model degrees per hour removed by the AC")
+    parser.add_argument("--heat-rate", type=float, default=3.0, help="room model degrees per hour added by the heat")
+    parser.add_argument("--dehumid-rate", type=float, default=10.0, help="room model humidity per hour removed by the AC")
+    parser.add_argument("--coast-mins", type=float, default=0.0, help="room model lag of the AC/heat effect")
+    args = parser.parse_args()
+
+    if ((args.synthetic_days is None) == (args.archive is None)):
+        parser.error("one of --archive or --synthetic-days is required")
+    if ((args.archive is not None) and (args.device is None)):
+        parser.error("--archive requires --device")
+
+    config = None
+    if (args.synthetic_days is not None):
+        trace = synthetic_trace(args.synthetic_days, outdoor_temp=sine_curve(args.outdoor_mean, args.outdoor_amplitude),
+            period_secs=args.synthetic_period)
+
+    else:
+        # Imported here since the recorder needs numpy
+        from recorder.__main__ import parse_ts
+        from recorder.archive import Archive
+        archive = Archive(args.archive)
+        now = int(time.time())
+        trace = archive_trace(archive, args.device, parse_ts(args.from_ts, now), parse_ts(args.to_ts, now))
+        if (len(trace["ts"]) == 0):
+            parser.error("no samples for %s in that range" % args.device)
+        snapshot = archive.read_state(args.device)
+        if (snapshot is not None):
+            config = snapshot["state"]["config"]
+
+    if (args.config is not None):
+        with open(args.config, "r") as f:
+            config = json.load(f)
+    if (config is None):
+        # Backtest.run merges the config over the firmware defaults, only the
+        # rules and thresholds are needed here
+        sim = Simulation(days=None)
+        sim.install()
+        config = copy.deepcopy(sim.modules["lessmostat"].state["config"])
+
+    for s in args.set:
+        path, _, value = s.partition("=")
+        set_config_value(config, path, json.loads(value))
+
+    configs = sweep_configs(config, [parse_sweep(s) for s in args.sweep])
+    room_args = {
+        "tau_secs" : args.tau_hours * 3600,
+        "cool_rate" : args.cool_rate,
+        "heat_rate" : args.heat_rate,
+        "dehumid_rate" : args.dehumid_rate,
+        "coast_secs" : args.coast_mins * 60,
+    }
+
+    start = time.perf_counter()
+    reports = run_sweep(trace, configs, args.processes,
+        min_off_secs=None if (args.min_off_mins is None) else args.min_off_mins * 60,
+        max_on_secs=None if (args.max_on_mins is None) else args.max_on_mins * 60, room_args=room_args)
+    result = {
+        "samples" : len(trace["ts"]),
+        "configs" : len(configs),
+        "wall_secs" : time.perf_counter() - start,
+        "reports" : reports,
+    }
+    print(json.dumps(result, indent=4, sort_keys=True))
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+In-process MQTT 3.1.1 broker and usocket stand-in
+
+The firmware's umqtt_simple client talks to the broker through FakeSocket
+objects, packets written by the client are processed synchronously so
+responses are available as soon as the write returns. Host code can publish
+and subscribe directly on the broker.
+
+Supports CONNECT, SUBSCRIBE, PUBLISH with QoS 0 and 1, retained messages,
+PINGREQ and DISCONNECT, which is what umqtt_simple uses.
+"""
+import errno
+import os
+import struct
+import types
+
+def topic_matches(pattern, topic):
+    """
+    Return True if the topic matches the subscription pattern with + and #
+    wildcards
+    """
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(pattern_levels):
+        if (level == "#"):
+            return True
+        if (i >= len(topic_levels)):
+            return False
+        if ((level != "+") and (level != topic_levels[i])):
+            return False
+
+    return (len(pattern_levels) == len(topic_levels))
+
+def encode_len(n):
+    b = bytearray()
+    while (True):
+        digit = n & 0x7F
+        n >>= 7
+        if (n > 0):
+            digit |= 0x80
+        b.append(digit)
+        if (n == 0):
+            return bytes(b)
+
+def encode_str(s):
+    return struct.pack("!H", len(s)) + s
+
+def encode_publish(topic, payload, qos=0, retain=False, pid=0):
+    body = encode_str(topic)
+    if (qos > 0):
+        body += struct.pack("!H", pid)
+    body += payload
+    return bytes([0x30 | (qos << 1) | int(retain)]) + encode_len(len(body)) + body
+
+class FakeSocket:
+    """
+    Client side of a connection to the Broker, with the MicroPython socket
+    stream interface used by umqtt_simple
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.inbuf = bytearray()
+        self.parse_buf = bytearray()
+        self.blocking = True
+        self.connected = False
+        self.closed = False
+        self.client_id = None
+        # List of (pattern, qos)
+        self.subscriptions = []
+        self.pid = 0
+        self.write_calls = 0
+        self.bytes_written = 0
+
+    def connect(self, addr):
+        self.broker.accept(self)
+
+    def write(self, buf, sz=None):
+        if (self.closed or (not self.connected)):
+            err = errno.ENOTCONN if (not self.connected) else errno.ECONNRESET
+            raise OSError(err, os.strerror(err))
+
+        data = bytes(buf) if (sz is None) else bytes(buf[:sz])
+        self.write_calls += 1
+        self.bytes_written += len(data)
+        self.broker.receive(self, data)
+
+        return len(data)
+
+    send = write
+    sendall = write
+
+    def read(self, n):
+        if (len(self.inbuf) == 0):
+            if (self.closed):
+                return b""
+            if (not self.blocking):
+                return None
+            # A blocking read with no data would hang forever, since nothing
+            # else can run in the simulation
+            raise OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT))
+
+        data = bytes(self.inbuf[:n])
+        del self.inbuf[:n]
+
+        return data
+
+    recv = read
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def settimeout(self, timeout):
+        self.blocking = (timeout != 0)
+
+    def close(self):
+        if (not self.closed):
+            self.closed = True
+            self.broker.drop(self)
+
+class Broker:
+    def __init__(self):
+        self.online = True
+        self.sockets = []
+        # Host-side subscriptions as list of (pattern, callback(topic, payload))
+        self.subscribers = []
+        # topic to payload
+        self.retained = {}
+        self.connect_count = 0
+        self.refused_count = 0
+        # topic to number of messages published by clients
+        self.publish_counts = {}
+        self.publish_bytes = 0
+        # Number of QoS 1 publishes retransmitted by the clients
+        self.dup_count = 0
+        # Number of socket writes done by the clients
+        self.write_count = 0
+
+    def set_online(self, online):
+        """
+        Take the broker offline (closing all the connections and refusing new
+        ones) or back online, to simulate network outages
+        """
+        self.online = online
+        if (not online):
+            for sock in list(self.sockets):
+                sock.closed = True
+            self.sockets = []
+
+    def accept(self, sock):
+        if (not self.online):
+            self.refused_count += 1
+            raise OSError(errno.EHOSTUNREACH, os.strerror(errno.EHOSTUNREACH))
+        sock.connected = True
+        self.sockets.append(sock)
+
+    def drop(self, sock):
+        if (sock in self.sockets):
+            self.sockets.remove(sock)
+
+    def subscribe(self, pattern, callback):
+        """
+        Subscribe host code to the given pattern, callback is called with topic
+        string and payload bytes
+        """
+        self.subscribers.append((pattern, callback))
+        for topic, payload in list(self.retained.items()):
+            if (topic_matches(pattern, topic)):
+                callback(topic, payload)
+
+    def publish(self, topic, payload, retain=False, qos=0):
+        """
+        Publish a message to all the subscribers
+
+        @param topic string
+        @param payload bytes or string
+        """
+        if (isinstance(payload, str)):
+            payload = payload.encode("utf-8")
+        if (retain):
+            if (len(payload) == 0):
+                self.retained.pop(topic, None)
+            else:
+                self.retained[topic] = payload
+
+        for sock in list(self.sockets):
+            for pattern, sub_qos in sock.subscriptions:
+                if (topic_matches(pattern, topic)):
+                    self.deliver(sock, topic, payload, min(qos, sub_qos), False)
+                    break
+
+        for pattern, callback in list(self.subscribers):
+            if (topic_matches(pattern, topic)):
+                callback(topic, payload)
+
+    def deliver(self, sock, topic, payload, qos, retain):
+        pid = 0
+        if (qos > 0):
+            sock.pid = (sock.pid % 0xFFFF) + 1
+            pid = sock.pid
+        sock.inbuf += encode_publish(topic.encode("utf-8"), payload, qos, retain, pid)
+
+    def receive(self, sock, data):
+        self.write_count += 1
+        sock.parse_buf += data
+        buf = sock.parse_buf
+        while (len(buf) >= 2):
+            # Decode the remaining length, wait for more data if incomplete
+            sz = 0
+            shift = 0
+            i = 1
+            while (True):
+                if (i >= len(buf)):
+                    return
+                b = buf[i]
+                sz |= (b & 0x7F) << shift
+                shift += 7
+                i += 1
+                if (not (b & 0x80)):
+                    break
+
+            if (len(buf) < i + sz):
+                return
+
+            op = buf[0]
+            body = bytes(buf[i:i + sz])
+            del buf[:i + sz]
+            self.process(sock, op, body)
+
+            if (sock.closed):
+                return
+
+    def process(self, sock, op, body):
+        kind = op & 0xF0
+        if (kind == 0x10):
+            # CONNECT, skip protocol name, level, flags and keepalive
+            (proto_len,) = struct.unpack("!H", body[:2])
+            i = 2 + proto_len + 4
+            (id_len,) = struct.unpack("!H", body[i:i + 2])
+            sock.client_id = body[i + 2:i + 2 + id_len]
+            self.connect_count += 1
+            sock.inbuf += b"\x20\x02\x00\x00"
+
+        elif (kind == 0x80):
+            # SUBSCRIBE
+            (pid,) = struct.unpack("!H", body[:2])
+            i = 2
+            granted = bytearray()
+            new_patterns = []
+            while (i < len(body)):
+                (topic_len,) = struct.unpack("!H", body[i:i + 2])
+                pattern = body[i + 2:i + 2 + topic_len].decode("utf-8")
+                qos = min(body[i + 2 + topic_len], 1)
+                i += 2 + topic_len + 1
+                sock.subscriptions.append((pattern, qos))
+                new_patterns.append((pattern, qos))
+                granted.append(qos)
+            sock.inbuf += bytes([0x90]) + encode_len(2 + len(granted)) + struct.pack("!H", pid) + bytes(granted)
+            for pattern, qos in new_patterns:
+                for topic, payload in self.retained.items():
+                    if (topic_matches(pattern, topic)):
+                        self.deliver(sock, topic, payload, qos, True)
+
+        elif (kind == 0x30):
+            # PUBLISH
+            qos = (op >> 1) & 3
+            retain = bool(op & 1)
+            if (op & 0x08):
+                self.dup_count += 1
+            (topic_len,) = struct.unpack("!H", body[:2])
+            topic = body[2:2 + topic_len].decode("utf-8")
+            i = 2 + topic_len
+            if (qos > 0):
+                (pid,) = struct.unpack("!H", body[i:i + 2])
+                i += 2
+            payload = body[i:]
+
+            self.publish_counts[topic] = self.publish_counts.get(topic, 0) + 1
+            self.publish_bytes += len(payload)
+
+            if (qos == 1):
+                sock.inbuf += b"\x40\x02" + struct.pack("!H", pid)
+            elif (qos == 2):
+                raise Exception("QoS 2 is not supported")
+
+            self.publish(topic, payload, retain, qos)
+
+        elif (kind == 0x40):
+            # PUBACK for a QoS 1 message delivered to the client, nothing to do
+            pass
+
+        elif (kind == 0xC0):
+            # PINGREQ
+            sock.inbuf += b"\xd0\x00"
+
+        elif (kind == 0xE0):
+            # DISCONNECT
+            sock.close()
+
+        else:
+            raise Exception("Unsupported MQTT packet 0x%02x" % op)
+
+def create_usocket_module(broker):
+    usocket = types.ModuleType("usocket")
+    usocket.AF_INET = 2
+    usocket.SOCK_STREAM = 1
+    usocket.socket = lambda *args : FakeSocket(broker)
+    usocket.getaddrinfo = lambda host, port, *args : [(2, 1, 0, "", (host, port))]
+
+    return usocket
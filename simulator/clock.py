@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Virtual clock standing in for MicroPython's time module
+
+Sleeping advances the simulated time instantly, running any events scheduled
+in between. Times are in seconds since 2000 as in MicroPython
+"""
+import calendar
+import heapq
+import time as host_time
+
+# epoch is year 2000 in MicroPython but 1970 in unix
+uepoch_delta_seconds = 946684800
+
+class SimulationEnd(Exception):
+    """
+    Raised from a sleep once the simulated time reaches the end time, unwinds
+    the firmware's forever loop
+    """
+    pass
+
+class VirtualClock:
+    def __init__(self, start_time, end_time=None):
+        """
+        @param start_time start time in seconds since 2000
+        @param end_time end time in seconds since 2000, None to run forever
+        """
+        self.now = float(start_time)
+        self.end_time = end_time
+        self.events = []
+        self.event_count = 0
+
+    def call_at(self, t, fn, *args):
+        """
+        Schedule fn(*args) to be called once the simulated time reaches t
+        """
+        # The event count is used as tie breaker so events with the same time
+        # are run in scheduling order and functions are never compared
+        heapq.heappush(self.events, (t, self.event_count, fn, args))
+        self.event_count += 1
+
+    def call_later(self, secs, fn, *args):
+        self.call_at(self.now + secs, fn, *args)
+
+    def advance(self, secs):
+        """
+        Advance the simulated time running any events that are due
+        """
+        target = self.now + secs
+        while (self.events and (self.events[0][0] <= target)):
+            t, _, fn, args = heapq.heappop(self.events)
+            self.now = max(self.now, t)
+            fn(*args)
+        self.now = max(self.now, target)
+
+        if ((self.end_time is not None) and (self.now >= self.end_time)):
+            raise SimulationEnd()
+
+    # MicroPython time module interface
+
+    def time(self):
+        return int(self.now)
+
+    def sleep(self, secs):
+        self.advance(secs)
+
+    def sleep_ms(self, ms):
+        self.advance(ms / 1000.0)
+
+    def sleep_us(self, us):
+        self.advance(us / 1000000.0)
+
+    def ticks_ms(self):
+        return int(self.now * 1000)
+
+    def ticks_us(self):
+        return int(self.now * 1000000)
+
+    def ticks_add(self, ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(self, ticks1, ticks2):
+        return ticks1 - ticks2
+
+    def localtime(self, secs=None):
+        """
+        Return MicroPython's 8-tuple
+        (year, month, mday, hour, minute, second, weekday, yearday)
+        """
+        if (secs is None):
+            secs = self.now
+        return tuple(host_time.gmtime(int(secs) + uepoch_delta_seconds)[:8])
+
+    gmtime = localtime
+
+    def mktime(self, t):
+        return calendar.timegm(tuple(t[:6]) + (0, 0, 0)) - uepoch_delta_seconds
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Stand-ins for the dht, machine and ntptime MicroPython modules
+"""
+import errno
+import os
+import random
+import types
+
+# Relay numbers on the relay board, see the relay_x_on/off commands in
+# upython/lessmostat.py
+RELAY_NAMES = {
+    1 : "ac",
+    2 : "fan",
+    3 : "heat",
+    4 : "relay4",
+}
+
+class SimulatedReset(Exception):
+    """
+    Raised by machine.reset()
+    """
+    pass
+
+class FakeDHT22:
+    def __init__(self, clock, room, measure_secs=0.025, initial_timeouts=2):
+        """
+        @param measure_secs simulated time a measure() call blocks, the 18ms
+               start pulse plus the data transfer (the 2s of the DHT22 is the
+               minimum period between measures, not the measure time)
+        @param initial_timeouts number of initial measure() calls that time
+               out, as the real DHT22 does
+        """
+        self.clock = clock
+        self.room = room
+        self.measure_secs = measure_secs
+        self.timeouts_left = initial_timeouts
+        self.measure_count = 0
+        self.temp = None
+        self.humid = None
+
+    def measure(self):
+        self.clock.advance(self.measure_secs)
+        if (self.timeouts_left > 0):
+            self.timeouts_left -= 1
+            raise OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT))
+
+        self.measure_count += 1
+        self.room.update()
+        # DHT22 has 0.1 degree and 0.1% resolution
+        self.temp = round(self.room.temp, 1)
+        self.humid = round(self.room.humid, 1)
+
+    def temperature(self):
+        return self.temp
+
+    def humidity(self):
+        return self.humid
+
+class FakeRelayUART:
+    """
+    UART connected to the relay board, decodes the relay commands and keeps
+    relay statistics
+    """
+    def __init__(self, clock, room, min_write_interval_secs=1.0):
+        """
+        @param min_write_interval_secs commands written closer than this to the
+               previous write are lost, as observed on the real relay board
+        """
+        self.clock = clock
+        self.room = room
+        self.min_write_interval_secs = min_write_interval_secs
+        self.last_write_time = None
+        self.write_count = 0
+        self.lost_count = 0
+        self.invalid_count = 0
+        # Relay name to True/False
+        self.relays = { name : False for name in RELAY_NAMES.values() }
+        # Relay name to number of off to on switches
+        self.cycles = { name : 0 for name in RELAY_NAMES.values() }
+        # Relay name to accumulated on seconds
+        self.on_secs = { name : 0.0 for name in RELAY_NAMES.values() }
+        self.on_since = { name : None for name in RELAY_NAMES.values() }
+        # List of (time, relay name, on) transitions
+        self.transitions = []
+
+    def write(self, b):
+        now = self.clock.now
+        self.write_count += 1
+        # Allow some slack for the float rounding of the virtual clock, the
+        # firmware measures intervals in integer ms ticks
+        lost = ((self.last_write_time is not None) and
+            ((now - self.last_write_time) < self.min_write_interval_secs - 0.001))
+        self.last_write_time = now
+        if (lost):
+            self.lost_count += 1
+            return len(b)
+
+        b = bytes(b)
+        if ((len(b) != 4) or (b[0] != 0xA0) or (((b[0] + b[1] + b[2]) & 0xFF) != b[3]) or
+            (b[1] not in RELAY_NAMES)):
+            self.invalid_count += 1
+            return len(b)
+
+        name = RELAY_NAMES[b[1]]
+        on = (b[2] != 0)
+        if (self.relays[name] != on):
+            self.relays[name] = on
+            self.transitions.append((now, name, on))
+            if (on):
+                self.cycles[name] += 1
+                self.on_since[name] = now
+            else:
+                self.on_secs[name] += now - self.on_since[name]
+                self.on_since[name] = None
+            self.room.set_relays(self.relays["ac"], self.relays["heat"])
+
+        return len(b)
+
+    def read(self, n=None):
+        return None
+
+    def get_on_secs(self, name):
+        on_secs = self.on_secs[name]
+        if (self.on_since[name] is not None):
+            on_secs += self.clock.now - self.on_since[name]
+        return on_secs
+
+class FakePin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+
+    def __init__(self, id, mode=-1, pull=-1):
+        self.id = id
+        self.mode = mode
+
+def create_machine_module(clock, uart, unique_id=b"\x5e\xc0\x0d\x00\x01\x02"):
+    machine = types.ModuleType("machine")
+    machine.Pin = FakePin
+    machine.UART = lambda *args, **kwargs: uart
+    machine.unique_id = lambda : unique_id
+
+    def reset():
+        raise SimulatedReset()
+    machine.reset = reset
+
+    return machine
+
+def create_dht_module(dht_sensor):
+    dht = types.ModuleType("dht")
+    dht.DHT22 = lambda pin : dht_sensor
+    dht.DHT11 = dht.DHT22
+
+    return dht
+
+def create_ntptime_module(clock, latency_secs=0.05, timeout_secs=1.0, failure_rate=0.0, seed=0):
+    """
+    @param failure_rate probability of a settime call timing out
+    """
+    ntptime = types.ModuleType("ntptime")
+    rnd = random.Random(seed)
+    ntptime.stats = { "calls" : 0, "timeouts" : 0 }
+
+    def settime():
+        ntptime.stats["calls"] += 1
+        if (rnd.random() < failure_rate):
+            ntptime.stats["timeouts"] += 1
+            clock.advance(timeout_secs)
+            raise OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT))
+        clock.advance(latency_secs)
+
+    ntptime.settime = settime
+
+    return ntptime
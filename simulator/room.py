@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Simple first order thermal model of the room the thermostat is in
+
+The room temperature drifts towards the outdoor temperature with a time
+constant, the AC and the heat add a constant cooling/heating rate, the AC also
+dehumidifies. The model is integrated lazily, whenever the sensor is read or a
+relay changes, so the relay state is constant between integration steps.
+
+Optionally the cooling/heating follows the relays with a lag, eg the
+evaporator keeps cooling for a while after the AC stops, which makes the
+temperature coast past the point where the relay was turned off.
+"""
+import math
+
+DAY_SECS = 24 * 60 * 60
+
+def sine_curve(mean, amplitude, peak_hour=15):
+    """
+    Return a function of the time in seconds returning a daily sine curve with
+    the given mean and amplitude, peaking at the given hour
+    """
+    def curve(t):
+        return mean + amplitude * math.cos(2 * math.pi * (t - peak_hour * 3600) / DAY_SECS)
+
+    return curve
+
+def csv_curve(filepath):
+    """
+    Return a function of the time in seconds interpolating the hour,value
+    lines of the given file, the curve repeats every day
+    """
+    points = []
+    with open(filepath, "r") as f:
+        for l in f:
+            l = l.strip()
+            if ((l == "") or l.startswith("#")):
+                continue
+            hour, value = [float(field) for field in l.split(",")]
+            points.append((hour * 3600, value))
+    points.sort()
+    # Wrap around midnight
+    points = [(points[-1][0] - DAY_SECS, points[-1][1])] + points + [(points[0][0] + DAY_SECS, points[0][1])]
+
+    def curve(t):
+        t = t % DAY_SECS
+        for i in range(1, len(points)):
+            if (t <= points[i][0]):
+                (t0, v0), (t1, v1) = points[i-1], points[i]
+                return v0 + (v1 - v0) * (t - t0) / (t1 - t0)
+
+    return curve
+
+class Room:
+    def __init__(self, clock, outdoor_temp, outdoor_humid, temp=None, humid=None,
+        tau_secs=4 * 3600, cool_rate=3.0, heat_rate=3.0, dehumid_rate=10.0,
+        coast_secs=0, step_secs=10):
+        """
+        @param outdoor_temp function of time returning the outdoor temperature
+        @param outdoor_humid function of time returning the outdoor humidity
+        @param tau_secs time constant of the drift towards outdoor values
+        @param cool_rate degrees per hour removed by the AC
+        @param heat_rate degrees per hour added by the heat
+        @param dehumid_rate humidity percentage per hour removed by the AC
+        @param coast_secs time constant of the lag of the cooling/heating
+               behind the relays, 0 for no lag
+        """
+        self.clock = clock
+        self.outdoor_temp = outdoor_temp
+        self.outdoor_humid = outdoor_humid
+        self.tau_secs = float(tau_secs)
+        self.cool_rate = cool_rate / 3600.0
+        self.heat_rate = heat_rate / 3600.0
+        self.dehumid_rate = dehumid_rate / 3600.0
+        self.coast_secs = float(coast_secs)
+        self.step_secs = step_secs
+
+        self.t = clock.now
+        self.temp = outdoor_temp(self.t) if (temp is None) else temp
+        self.humid = outdoor_humid(self.t) if (humid is None) else humid
+        self.ac = False
+        self.heat = False
+        # Fraction of the cooling/heating rate currently applied
+        self.ac_level = 0.0
+        self.heat_level = 0.0
+
+    def update(self):
+        """
+        Integrate the model up to the current clock time
+        """
+        now = self.clock.now
+        while (self.t < now):
+            dt = min(self.step_secs, now - self.t)
+            dtemp = (self.outdoor_temp(self.t) - self.temp) / self.tau_secs
+            dhumid = (self.outdoor_humid(self.t) - self.humid) / self.tau_secs
+            if (self.coast_secs > 0):
+                k = 1.0 - math.exp(-dt / self.coast_secs)
+                self.ac_level += (float(self.ac) - self.ac_level) * k
+                self.heat_level += (float(self.heat) - self.heat_level) * k
+            else:
+                self.ac_level = float(self.ac)
+                self.heat_level = float(self.heat)
+            dtemp -= self.cool_rate * self.ac_level
+            dhumid -= self.dehumid_rate * self.ac_level
+            dtemp += self.heat_rate * self.heat_level
+            self.temp += dtemp * dt
+            self.humid = max(0.0, min(100.0, self.humid + dhumid * dt))
+            self.t += dt
+
+    def set_relays(self, ac, heat):
+        self.update()
+        self.ac = ac
+        self.heat = heat
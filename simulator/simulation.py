@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Run the unmodified firmware in upython/ against the simulated devices
+
+The firmware keeps its state in module globals, so only one Simulation can be
+run per process.
+"""
+import binascii
+import calendar
+import contextlib
+import gc
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+import types
+
+from simulator.broker import Broker, create_usocket_module
+from simulator.clock import SimulationEnd, VirtualClock, uepoch_delta_seconds
+from simulator.devices import (FakeDHT22, FakeRelayUART, create_dht_module,
+    create_machine_module, create_ntptime_module)
+from simulator.room import Room, sine_curve
+from simulator.vasyncio import create_uasyncio_module
+
+upython_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "upython")
+
+# Firmware modules, in dependency order
+firmware_module_names = ["aio", "logging", "syncedtime", "umqtt_simple", "outbox", "mqtt", "config", "relays", "rules", "sampler", "telemetry", "history", "thermal", "lessmostat"]
+
+def proxy_module(module, **overrides):
+    """
+    Return a module that forwards to the given module with some attributes
+    overridden, used to add the MicroPython-only functions to CPython modules
+    without modifying them
+    """
+    proxy = types.ModuleType(module.__name__)
+    proxy.__dict__.update(overrides)
+    # Forward lazily so eg sys.stdout redirections are honored
+    proxy.__getattr__ = lambda name : getattr(module, name)
+
+    return proxy
+
+class upython_bytes(bytes):
+    """
+    bytes that, like MicroPython's, accept str arguments in startswith and
+    endswith, which the firmware relies on when matching MQTT topics
+    """
+    def startswith(self, prefix, *args):
+        if (isinstance(prefix, str)):
+            prefix = prefix.encode("utf-8")
+        return bytes.startswith(self, prefix, *args)
+
+    def endswith(self, suffix, *args):
+        if (isinstance(suffix, str)):
+            suffix = suffix.encode("utf-8")
+        return bytes.endswith(self, suffix, *args)
+
+def print_exception(e, file=sys.stdout):
+    traceback.print_exception(type(e), e, e.__traceback__, file=file)
+
+def utc_to_upython_secs(year, month, mday, hour=0, minute=0, second=0):
+    return calendar.timegm((year, month, mday, hour, minute, second, 0, 0, 0)) - uepoch_delta_seconds
+
+class Simulation:
+    def __init__(self, days=7, start_time=None, outdoor_temp=None, outdoor_humid=None,
+        config_filepath=None, workdir=None, trace_memory=False, ntp_failure_rate=0.0,
+        seed=0, room_args=None):
+        """
+        @param days simulated days to run, None to run until the caller stops
+        @param start_time start time in seconds since 2000, defaults to
+               2021-07-01 00:00 UTC
+        @param outdoor_temp function of time returning the outdoor temperature,
+               defaults to a sine curve from 24 to 34 degrees
+        @param outdoor_humid function of time returning the outdoor humidity
+        @param config_filepath lessmostat.cfg to start with, None to use the
+               firmware defaults
+        @param workdir directory where the firmware writes its config and
+               log files, defaults to a temporary directory
+        @param trace_memory trace host memory allocations (slower)
+        @param room_args dict of keyword arguments for Room, eg the cooling
+               rate, None for the defaults
+        """
+        if (start_time is None):
+            start_time = utc_to_upython_secs(2021, 7, 1)
+        if (outdoor_temp is None):
+            outdoor_temp = sine_curve(29.0, 5.0)
+        if (outdoor_humid is None):
+            outdoor_humid = sine_curve(60.0, -10.0)
+        if (room_args is None):
+            room_args = {}
+
+        self.start_time = start_time
+        self.end_time = None if (days is None) else start_time + days * 24 * 3600
+        self.clock = VirtualClock(start_time, self.end_time)
+        self.room = Room(self.clock, outdoor_temp, outdoor_humid, **room_args)
+        self.dht_sensor = FakeDHT22(self.clock, self.room)
+        self.uart = FakeRelayUART(self.clock, self.room)
+        self.broker = Broker()
+        self.config_filepath = config_filepath
+        self.workdir = workdir
+        self.trace_memory = trace_memory
+
+        self.shims = {
+            "dht" : create_dht_module(self.dht_sensor),
+            "machine" : create_machine_module(self.clock, self.uart),
+            "ntptime" : create_ntptime_module(self.clock, failure_rate=ntp_failure_rate, seed=seed),
+            "usocket" : create_usocket_module(self.broker),
+            "ujson" : json,
+            "ubinascii" : binascii,
+            "ustruct" : struct,
+            "utime" : self.clock,
+            "uasyncio" : create_uasyncio_module(self.clock),
+        }
+        self.modules = {}
+
+        # Statistics
+        self.check_msg_count = 0
+        self.last_check_msg_time = None
+        self.max_check_msg_gap = 0.0
+        self.sum_check_msg_gap = 0.0
+        self.control_pending = []
+        self.control_latencies = []
+        self.loop_count = 0
+        self.memory_min = None
+        self.memory_max = None
+        # Running sensor message statistics, don't store the samples so the
+        # traced memory is the firmware's
+        self.sensor_count = 0
+        self.last_sensor_ts = None
+        self.temp_min = None
+        self.temp_max = None
+        self.temp_sum = 0.0
+        self.history_messages = 0
+        self.history_records = 0
+        self.wall_secs = 0.0
+
+    def install(self):
+        """
+        Install the MicroPython module stand-ins and import the firmware
+        """
+        sys.modules.update(self.shims)
+
+        # The firmware's logging.py would shadow the standard library one,
+        # import the firmware and then restore whatever was there before
+        saved = { name : sys.modules.pop(name) for name in firmware_module_names if name in sys.modules }
+        sys.path.insert(0, upython_dir)
+        try:
+            for name in firmware_module_names:
+                self.modules[name] = __import__(name)
+        finally:
+            sys.path.remove(upython_dir)
+            for name in firmware_module_names:
+                sys.modules.pop(name, None)
+            sys.modules.update(saved)
+
+        for module in self.modules.values():
+            if (getattr(module, "time", None) is time):
+                module.time = self.clock
+
+        lessmostat = self.modules["lessmostat"]
+        lessmostat.os = proxy_module(os, dupterm=lambda stream, index=0 : None)
+        lessmostat.gc = proxy_module(gc, collect=self.gc_collect,
+            mem_free=lambda : 0, mem_alloc=lambda : tracemalloc.get_traced_memory()[0])
+        self.modules["logging"].sys = proxy_module(sys, print_exception=print_exception)
+
+        # Wrap the firmware functions that are used to gather statistics
+        mqtt_check_msg = lessmostat.mqtt_check_msg
+        def check_msg_wrapper(client):
+            self.on_check_msg()
+            return mqtt_check_msg(client)
+        lessmostat.mqtt_check_msg = check_msg_wrapper
+
+        sub_cb = lessmostat.sub_cb
+        def sub_cb_wrapper(client, topic, msg):
+            self.on_control_message(topic)
+            return sub_cb(client, upython_bytes(topic), msg)
+        lessmostat.sub_cb = sub_cb_wrapper
+
+        self.broker.subscribe("#", self.on_broker_message)
+
+    def gc_collect(self):
+        # Collecting on the host for every loop iteration is too slow and
+        # doesn't say anything about the device heap, just count
+        self.loop_count += 1
+        if (self.trace_memory):
+            current = tracemalloc.get_traced_memory()[0]
+            self.memory_min = current if (self.memory_min is None) else min(self.memory_min, current)
+            self.memory_max = current if (self.memory_max is None) else max(self.memory_max, current)
+
+    def on_check_msg(self):
+        now = self.clock.now
+        if (self.last_check_msg_time is not None):
+            gap = now - self.last_check_msg_time
+            self.max_check_msg_gap = max(self.max_check_msg_gap, gap)
+            self.sum_check_msg_gap += gap
+        self.last_check_msg_time = now
+        self.check_msg_count += 1
+
+    def on_control_message(self, topic):
+        topic = topic.decode("utf-8")
+        for i, (publish_time, pending_topic) in enumerate(self.control_pending):
+            if (pending_topic == topic):
+                self.control_latencies.append(self.clock.now - publish_time)
+                del self.control_pending[i]
+                break
+
+    def on_broker_message(self, topic, payload):
+        if (topic.endswith("/info/sensor")):
+            sample = json.loads(payload)
+
+        elif (topic.endswith("/info/sensor_bin")):
+            sample = self.modules["telemetry"].telemetry_decode(payload)
+
+        elif (topic.endswith("/info/history")):
+            history = self.modules["history"]
+            self.history_messages += 1
+            self.history_records += (len(payload) - history.history_chunk_header_size) // history.history_record_size
+            return
+
+        else:
+            return
+
+        # Count once when published in both formats
+        if (sample["ts"] == self.last_sensor_ts):
+            return
+        self.last_sensor_ts = sample["ts"]
+        temp = sample["temp"]
+        self.sensor_count += 1
+        self.temp_sum += temp
+        self.temp_min = temp if (self.temp_min is None) else min(self.temp_min, temp)
+        self.temp_max = temp if (self.temp_max is None) else max(self.temp_max, temp)
+
+    def publish_control(self, subtopic, msg):
+        topic = self.modules["lessmostat"].state["config"]["mqtt_topic"] + subtopic
+        self.control_pending.append((self.clock.now, topic))
+        self.broker.publish(topic, json.dumps(msg))
+
+    def schedule_control(self, hours, subtopic, msg):
+        """
+        Publish a control message at the given simulated hours since the start
+        """
+        self.clock.call_at(self.start_time + hours * 3600, self.publish_control, subtopic, msg)
+
+    def schedule_outage(self, hours, duration_hours):
+        """
+        Take the broker offline at the given simulated hours since the start
+        """
+        self.clock.call_at(self.start_time + hours * 3600, self.broker.set_online, False)
+        self.clock.call_at(self.start_time + (hours + duration_hours) * 3600, self.broker.set_online, True)
+
+    def run(self, console=None):
+        """
+        Run the firmware main() until the end of the simulated time
+
+        @param console file where the firmware console output goes, defaults
+               to console.txt in the working directory
+        """
+        if (not self.modules):
+            self.install()
+
+        workdir = self.workdir
+        if (workdir is None):
+            workdir = tempfile.mkdtemp(prefix="lessmostat_sim_")
+        self.workdir = workdir
+        os.makedirs(workdir, exist_ok=True)
+        lessmostat = self.modules["lessmostat"]
+        if (self.config_filepath is not None):
+            shutil.copy(self.config_filepath, os.path.join(workdir, lessmostat.config_filename))
+
+        prev_cwd = os.getcwd()
+        os.chdir(workdir)
+        close_console = False
+        if (console is None):
+            console = open("console.txt", "w")
+            close_console = True
+        if (self.trace_memory):
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        try:
+            self.modules["logging"].log_set_filename("lessmostat.log")
+            with contextlib.redirect_stdout(console):
+                lessmostat.main()
+
+        except SimulationEnd:
+            pass
+
+        finally:
+            self.wall_secs = time.perf_counter() - start
+            if (self.trace_memory):
+                self.traced_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            if (close_console):
+                console.close()
+            os.chdir(prev_cwd)
+
+        return self.report()
+
+    def report(self):
+        uart = self.uart
+        simulated_secs = self.clock.now - self.start_time
+        days = simulated_secs / (24 * 3600.0)
+        r = {
+            "simulated_days" : days,
+            "wall_secs" : self.wall_secs,
+            "speedup" : simulated_secs / max(self.wall_secs, 1e-9),
+            "loops" : self.loop_count,
+            "sensor_measures" : self.dht_sensor.measure_count,
+            "relays" : {},
+            "relay_writes" : uart.write_count,
+            "relay_writes_lost" : uart.lost_count,
+            "check_msg_count" : self.check_msg_count,
+            "check_msg_max_gap_secs" : self.max_check_msg_gap,
+            "check_msg_mean_gap_secs" : self.sum_check_msg_gap / max(self.check_msg_count - 1, 1),
+            "control_latency_max_secs" : max(self.control_latencies) if self.control_latencies else None,
+            "control_messages" : len(self.control_latencies),
+            "mqtt_publish_counts" : dict(self.broker.publish_counts),
+            "mqtt_publish_bytes" : self.broker.publish_bytes,
+            "mqtt_client_writes" : self.broker.write_count,
+            "mqtt_publish_dups" : self.broker.dup_count,
+            "history_messages" : self.history_messages,
+            "history_records" : self.history_records,
+            "ntp" : dict(self.shims["ntptime"].stats),
+            "workdir" : self.workdir,
+        }
+        for name in ["ac", "heat", "fan"]:
+            r["relays"][name] = {
+                "cycles" : uart.cycles[name],
+                "cycles_per_day" : uart.cycles[name] / max(days, 1e-9),
+                "on_hours" : uart.get_on_secs(name) / 3600.0,
+            }
+        if (self.sensor_count > 0):
+            r["temp_min"] = self.temp_min
+            r["temp_max"] = self.temp_max
+            r["temp_mean"] = self.temp_sum / self.sensor_count
+        if (self.trace_memory):
+            r["host_traced_bytes"] = self.traced_memory[0]
+            r["host_traced_peak_bytes"] = self.traced_memory[1]
+            if (self.memory_min is not None):
+                r["host_traced_loop_min_bytes"] = self.memory_min
+                r["host_traced_loop_max_bytes"] = self.memory_max
+
+        return r
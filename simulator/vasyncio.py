@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Virtual time stand-in for the subset of MicroPython's uasyncio used by the
+firmware
+
+Sleeping tasks are kept in a heap by wake up time and the virtual clock is
+advanced straight to the next wake up, so simulated time runs as fast as the
+tasks can execute. The CPython asyncio event loop can't be used because it
+sleeps in real time.
+"""
+import heapq
+import types
+
+class CancelledError(BaseException):
+    pass
+
+class _Yield:
+    """
+    Awaitable yielding a request to the scheduler
+    """
+    def __init__(self, request, arg):
+        self.request = request
+        self.arg = arg
+
+    def __await__(self):
+        return (yield self)
+
+class Task:
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = []
+        # Tasks this task is waiting on, any of them finishing wakes it up
+        self.waiting_on = []
+
+    def __await__(self):
+        if (not self.done):
+            yield _Yield("task", self)
+        if (self.exception is not None):
+            raise self.exception
+        return self.result
+
+class Event:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.state = False
+        self.waiters = []
+
+    def is_set(self):
+        return self.state
+
+    def set(self):
+        self.state = True
+        for task in self.waiters:
+            self.scheduler.schedule(task, 0)
+        self.waiters = []
+
+    def clear(self):
+        self.state = False
+
+    async def wait(self):
+        if (not self.state):
+            await _Yield("event", self)
+        return True
+
+class Scheduler:
+    def __init__(self, clock):
+        self.clock = clock
+        self.ready = []
+        self.count = 0
+
+    def schedule(self, task, delay_secs, value=None):
+        heapq.heappush(self.ready, (self.clock.now + delay_secs, self.count, task, value))
+        self.count += 1
+
+    def create_task(self, coro):
+        task = Task(coro)
+        self.schedule(task, 0)
+        return task
+
+    def step(self, task, value):
+        try:
+            if (isinstance(value, BaseException)):
+                request = task.coro.throw(value)
+            else:
+                request = task.coro.send(value)
+
+        except StopIteration as e:
+            self.finish(task, e.value, None)
+            return
+
+        except Exception as e:
+            self.finish(task, None, e)
+            return
+
+        if (request.request == "sleep"):
+            self.schedule(task, request.arg)
+
+        elif (request.request == "event"):
+            request.arg.waiters.append(task)
+
+        elif (request.request == "task"):
+            request.arg.waiters.append(task)
+            task.waiting_on = [request.arg]
+
+        elif (request.request == "any_task"):
+            for other in request.arg:
+                other.waiters.append(task)
+            task.waiting_on = list(request.arg)
+
+        else:
+            raise Exception("Unknown request %r" % request.request)
+
+    def finish(self, task, result, exception):
+        task.done = True
+        task.result = result
+        task.exception = exception
+        for waiter in task.waiters:
+            for other in waiter.waiting_on:
+                if ((other is not task) and (waiter in other.waiters)):
+                    other.waiters.remove(waiter)
+            waiter.waiting_on = []
+            self.schedule(waiter, 0)
+        task.waiters = []
+
+    def run(self, coro):
+        main_task = self.create_task(coro)
+        while (not main_task.done):
+            t, _, task, value = heapq.heappop(self.ready)
+            if (task.done):
+                continue
+            if (t > self.clock.now):
+                # This raises SimulationEnd once the end time is reached
+                self.clock.advance(t - self.clock.now)
+            self.step(task, value)
+
+        # Close the tasks that didn't finish, eg the forever tasks left when an
+        # exception is propagated
+        for _, _, task, _ in self.ready:
+            task.coro.close()
+        self.ready = []
+
+        if (main_task.exception is not None):
+            raise main_task.exception
+        return main_task.result
+
+def create_uasyncio_module(clock):
+    scheduler = Scheduler(clock)
+    uasyncio = types.ModuleType("uasyncio")
+    uasyncio.CancelledError = CancelledError
+    uasyncio.Task = Task
+    uasyncio.create_task = scheduler.create_task
+    uasyncio.run = scheduler.run
+    uasyncio.Event = lambda : Event(scheduler)
+    uasyncio.scheduler = scheduler
+
+    def sleep(secs):
+        return _Yield("sleep", secs)
+    uasyncio.sleep = sleep
+    uasyncio.sleep_ms = lambda ms : _Yield("sleep", ms / 1000.0)
+
+    async def gather(*awaitables, return_exceptions=False):
+        tasks = [aw if isinstance(aw, Task) else scheduler.create_task(aw) for aw in awaitables]
+        while (True):
+            # Raise as soon as any task fails, not when it's its turn in order
+            pending = []
+            for task in tasks:
+                if (not task.done):
+                    pending.append(task)
+                elif ((task.exception is not None) and (not return_exceptions)):
+                    raise task.exception
+            if (len(pending) == 0):
+                break
+            await _Yield("any_task", pending)
+
+        return [task.result if (task.exception is None) else task.exception for task in tasks]
+    uasyncio.gather = gather
+
+    return uasyncio
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Fake WebREPL device to run deploy.py against without hardware, eg
+
+    python3 -m simulator.webrepl --root _out/fake --port 8266 --password pw
+
+and put "localhost" and "pw" in _out/host_password.txt
+
+The device filesystem is a directory. The file and version requests behave as
+the ESP8266 WebREPL's, the raw REPL runs the code with CPython with os, uos,
+ubinascii and open restricted to the directory, and a soft reset (ctrl+d)
+prints the boot report of upython/main.py
+"""
+import argparse
+import asyncio
+import binascii
+import contextlib
+import io
+import logging
+import os
+import struct
+import traceback
+
+import websockets
+
+WEBREPL_REQ_S = "<2sBBQLH64s"
+WEBREPL_REQ_SIZE = struct.calcsize(WEBREPL_REQ_S)
+WEBREPL_PUT_FILE = 1
+WEBREPL_GET_FILE = 2
+WEBREPL_GET_VER  = 3
+
+logger = logging.getLogger(__name__)
+
+class FakeOs:
+    """
+    Subset of the os module used by the raw REPL code, restricted to the fake
+    device's directory
+    """
+    def __init__(self, webrepl):
+        self.webrepl = webrepl
+
+    def stat(self, filename):
+        return tuple(os.stat(self.webrepl.filepath(filename)))
+
+    def remove(self, filename):
+        os.remove(self.webrepl.filepath(filename))
+
+    def rename(self, old_filename, new_filename):
+        os.rename(self.webrepl.filepath(old_filename), self.webrepl.filepath(new_filename))
+
+    def listdir(self, dirname=""):
+        return os.listdir(self.webrepl.filepath(dirname))
+
+class FakeWebRepl:
+    def __init__(self, root_dirpath, password, ver=(1, 19, 1), get_chunk_size=256, max_put_chunk_size=1024,
+        boot_output="Boot heap free 31232 before imports, 22848 after imports\r\n"):
+        """
+        @param get_chunk_size size of the chunks sent for a file request, the
+               device's buffer size
+        @param max_put_chunk_size larger chunks are ignored and the transfer
+               hangs, as observed on the device
+        @param boot_output console text after a soft reset
+        """
+        self.root_dirpath = root_dirpath
+        self.password = password
+        self.ver = ver
+        self.get_chunk_size = get_chunk_size
+        self.max_put_chunk_size = max_put_chunk_size
+        self.boot_output = boot_output
+        # WebSocket of the current connection, None if not connected
+        self.ws = None
+        self.stats = {
+            "connections" : 0,
+            "rejected" : 0,
+            "put_files" : 0,
+            "put_bytes" : 0,
+            "get_files" : 0,
+            "get_bytes" : 0,
+            "execs" : 0,
+            "soft_resets" : 0,
+        }
+
+    def filepath(self, filename):
+        filepath = os.path.normpath(os.path.join(self.root_dirpath, filename))
+        if (not filepath.startswith(os.path.normpath(self.root_dirpath))):
+            raise OSError(13, "Access outside of the device's directory %r" % filename)
+
+        return filepath
+
+    def exec_code(self, code):
+        """
+        @return (stdout, stderr) of running the code
+        """
+        self.stats["execs"] += 1
+        fake_os = FakeOs(self)
+        fake_modules = { "os" : fake_os, "uos" : fake_os, "ubinascii" : binascii, "binascii" : binascii }
+        builtins = dict(__builtins__ if isinstance(__builtins__, dict) else vars(__builtins__))
+        real_import = builtins["__import__"]
+        builtins["__import__"] = lambda name, *args, **kwargs : fake_modules.get(name) or real_import(name, *args, **kwargs)
+        builtins["open"] = lambda filename, mode="r" : open(self.filepath(filename), mode)
+
+        out = io.StringIO()
+        err = ""
+        with contextlib.redirect_stdout(out):
+            try:
+                exec(code, { "__builtins__" : builtins })
+            except Exception as e:
+                err = "Traceback (most recent call last):\r\n%s: %s\r\n" % (type(e).__name__, e)
+                logger.debug("Exception in raw REPL code %s", traceback.format_exc())
+
+        return out.getvalue().replace("\n", "\r\n"), err
+
+    async def handle(self, ws, path=None):
+        if (self.ws is not None):
+            # The device only allows one connection
+            self.stats["rejected"] += 1
+            await ws.close()
+            return
+
+        self.ws = ws
+        self.stats["connections"] += 1
+        try:
+            await self.handle_session(ws)
+
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+        finally:
+            self.ws = None
+
+    async def console_write(self, text):
+        """
+        Send text to the console of the current connection, if any, eg to
+        simulate the firmware's output
+        """
+        if (self.ws is not None):
+            try:
+                await self.ws.send(text)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+    async def handle_session(self, ws):
+        await ws.send("Password: ")
+        password = await ws.recv()
+        if (password != self.password + "\r"):
+            await ws.send("\r\nAccess denied\r\n")
+            await ws.close()
+            return
+        await ws.send("\r\nWebREPL connected\r\n>>> ")
+
+        raw_code = None
+        header = b""
+        while (True):
+            msg = await ws.recv()
+            if (isinstance(msg, str)):
+                if (msg == "\r\x01"):
+                    raw_code = ""
+                    await ws.send("raw REPL; CTRL-B to exit\r\n>")
+                elif (raw_code is not None):
+                    if (msg == "\x04"):
+                        out, err = self.exec_code(raw_code)
+                        raw_code = ""
+                        await ws.send("OK" + out + "\x04" + err + "\x04>")
+                    elif (msg == "\x02"):
+                        raw_code = None
+                        await ws.send("\r\n>>> ")
+                    else:
+                        raw_code += msg
+                elif (msg == "\x03"):
+                    await ws.send("\r\nKeyboardInterrupt: \r\n>>> ")
+                elif (msg == "\x04"):
+                    self.stats["soft_resets"] += 1
+                    await ws.send("\r\nMPY: soft reboot\r\n")
+                    await ws.send(self.boot_output)
+                else:
+                    # Echo
+                    await ws.send(msg)
+                continue
+
+            # File and version requests, stray data from a previous request
+            # would be taken as the start of the next one, as the device does
+            header += msg
+            if (len(header) < WEBREPL_REQ_SIZE):
+                continue
+            sig, op, _, _, size, fname_len, fname = struct.unpack(WEBREPL_REQ_S, header[:WEBREPL_REQ_SIZE])
+            header = header[WEBREPL_REQ_SIZE:]
+            if (sig != b"WA"):
+                logger.warning("Invalid request signature %r, closing", sig)
+                await ws.close()
+                return
+            filename = fname[:fname_len].decode("utf-8")
+
+            if (op == WEBREPL_GET_VER):
+                await ws.send(bytes(self.ver))
+
+            elif (op == WEBREPL_PUT_FILE):
+                await ws.send(b"WB\0\0")
+                data = bytearray()
+                while (len(data) < size):
+                    chunk = await ws.recv()
+                    if (len(chunk) > self.max_put_chunk_size):
+                        # Ignore everything until the client gives up and
+                        # closes the connection
+                        while (True):
+                            await ws.recv()
+                    data += chunk
+                with open(self.filepath(filename), "wb") as f:
+                    f.write(data)
+                self.stats["put_files"] += 1
+                self.stats["put_bytes"] += len(data)
+                await ws.send(b"WB\0\0")
+
+            elif (op == WEBREPL_GET_FILE):
+                try:
+                    f = open(self.filepath(filename), "rb")
+                except OSError:
+                    # The device closes the connection when the file doesn't
+                    # exist
+                    await ws.close()
+                    return
+                with f:
+                    await ws.send(b"WB\0\0")
+                    while (True):
+                        # A chunk per ack
+                        await ws.recv()
+                        chunk = f.read(self.get_chunk_size)
+                        await ws.send(struct.pack("<H", len(chunk)) + chunk)
+                        self.stats["get_bytes"] += len(chunk)
+                        if (len(chunk) == 0):
+                            break
+                self.stats["get_files"] += 1
+                await ws.send(b"WB\0\0")
+
+            else:
+                logger.warning("Invalid request op %d, closing", op)
+                await ws.close()
+                return
+
+    async def serve(self, host="localhost", port=8266):
+        """
+        @return the websockets server, see websockets.serve
+        """
+        if (not os.path.exists(self.root_dirpath)):
+            os.makedirs(self.root_dirpath)
+
+        return await websockets.serve(self.handle, host, port, ping_interval=None, max_size=None)
+
+async def serve_forever(webrepl, host, port):
+    server = await webrepl.serve(host, port)
+    logger.info("Serving fake WebREPL for %s on %s:%d", webrepl.root_dirpath, host, port)
+    await server.wait_closed()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake WebREPL device")
+    parser.add_argument("--root", required=True, help="directory with the device's files")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8266)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--ver", default="1.19.1", help="firmware version to report")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    webrepl = FakeWebRepl(args.root, args.password, ver=tuple([int(v) for v in args.ver.split(".")]))
+    asyncio.run(serve_forever(webrepl, args.host, args.port))
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+asyncio compatibility between MicroPython's uasyncio and CPython's asyncio
+
+uasyncio v3 is frozen in the esp8266 MicroPython firmware since 1.13
+"""
+try:
+    import uasyncio as asyncio
+
+except ImportError:
+    import asyncio
+
+try:
+    sleep_ms = asyncio.sleep_ms
+
+except AttributeError:
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000.0)
@@ -20,11 +20,11 @@ import ujson as json
 import logging
 
 def read_config(config_filename, state):
-    logging.log_info("Reading config file %r" % config_filename)
+    logging.log_info("Reading config file %r", config_filename)
     try:
         with open(config_filename, "r") as f:
             js = f.read()
-            logging.log_info("Read config data %r" % js)
+            logging.log_info("Read config data %r", js)
             state["config"].update(json.loads(js))
 
             # Validate the configuration
@@ -33,16 +33,16 @@ def read_config(config_filename, state):
                 state["config"]["fan_rules"] = [ { "state" : "auto" } ]
 
     except Exception as e:
-        logging.log_exception("Exception reading config file %r" % config_filename, e)
+        logging.log_exception("Exception reading config file %r", e, config_filename)
 
 def write_config(config_filename, state):
-    logging.log_info("Writing config file %r" % config_filename)
+    logging.log_info("Writing config file %r", config_filename)
     try:
         with open(config_filename, "w") as f:
             js = json.dumps(state["config"])
             f.write(js)
-            logging.log_info("Written config data %r" % js)
+            logging.log_info("Written config data %r", js)
 
     except Exception as e:
-        logging.log_exception("Exception writing config file %r" % config_filename, e)
+        logging.log_exception("Exception writing config file %r", e, config_filename)
 
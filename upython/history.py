@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Sensor and relay history on flash
+
+The history is kept in tiers of increasing period, eg 10 second samples for a
+day and 5 minute averages for a month. The samples are averaged over each
+period of the tier and each tier is a preallocated file used as a ring of
+8-byte records in network order
+- unix epoch timestamp of the start of the period (uint32)
+- temperature in tenths of degree (int16)
+- humidity in tenths of percentage in the low 10 bits and, in the high bits,
+  the relay bitmask of the relays that were on at any time during the period,
+  see telemetry.relay_bits (uint16)
+
+The files are never resized, so the flash and RAM used are constant. There's no
+header with the ring position to rewrite on every append, the ring is sorted
+by timestamp except at the write position, which is found with a binary search
+when the file is opened.
+
+The records of a tier are buffered in RAM and written a few at a time to save
+flash writes, the buffered records and the periods being averaged are lost on
+reset.
+
+The records are sent over MQTT in chunks of a header followed by the records,
+the header is 8 bytes in network order
+- version (uint8), currently 1
+- request id (uint16), from the request
+- chunk index (uint16), starting at 0
+- period of the tier in seconds (uint16)
+- flags (uint8), history_flag_last on the last chunk of the request
+"""
+import os
+import ustruct as struct
+
+from logging import log_info, log_exception
+
+history_record_format = "!IhH"
+history_record_size = struct.calcsize(history_record_format)
+history_humid_mask = 0x3ff
+history_relays_shift = 10
+
+history_chunk_version = 1
+history_chunk_format = "!BHHHB"
+history_chunk_header_size = struct.calcsize(history_chunk_format)
+history_flag_last = 0x01
+
+# Size of the writes done when preallocating a tier file
+history_fill_size = 512
+
+def tier_read_ts(tier, i):
+    f = tier["file"]
+    f.seek(i * history_record_size)
+    return struct.unpack("!I", f.read(4))[0]
+
+def tier_open(tier):
+    """
+    Open the tier file, creating it if it doesn't exist or has a different
+    size, and find the ring position
+    """
+    filename = tier["filename"]
+    max_records = tier["max_records"]
+    file_size = max_records * history_record_size
+    try:
+        size = os.stat(filename)[6]
+    except OSError:
+        size = None
+
+    if (size != file_size):
+        log_info("Creating history file %r with %d records", filename, max_records)
+        zeros = bytes(history_fill_size)
+        with open(filename, "wb") as f:
+            for i in range(0, file_size, history_fill_size):
+                f.write(zeros[:min(history_fill_size, file_size - i)])
+
+    tier["file"] = open(filename, "r+b")
+
+    first_ts = tier_read_ts(tier, 0)
+    if (first_ts == 0):
+        head = 0
+        count = 0
+
+    else:
+        # The records before the first one older than the record at 0 are the
+        # newest ones, the unused records have a 0 timestamp so they are
+        # older too
+        lo = 1
+        hi = max_records
+        while (lo < hi):
+            mid = (lo + hi) // 2
+            if (tier_read_ts(tier, mid) < first_ts):
+                hi = mid
+            else:
+                lo = mid + 1
+        head = lo % max_records
+        count = max_records if (tier_read_ts(tier, max_records - 1) != 0) else lo
+
+    tier["head"] = head
+    tier["count"] = count
+    tier["last_ts"] = tier_read_ts(tier, (head - 1) % max_records) if (count > 0) else 0
+    log_info("Opened history file %r with %d records", filename, count)
+
+def history_create(tiers):
+    """
+    @param tiers list of (filename, period_secs, max_records, buffered_records)
+           tuples, finest period first. The records are written to the file
+           once buffered_records are buffered
+    """
+    history = { "tiers" : [] }
+    for filename, period, max_records, buffered_records in tiers:
+        tier = {
+            "filename" : filename,
+            "period" : period,
+            "max_records" : max_records,
+            "file" : None,
+            # Index of the next record to write and number of records in the
+            # file
+            "head" : 0,
+            "count" : 0,
+            # Timestamp of the newest record in the file or buffered, the
+            # records must be written in increasing timestamp order
+            "last_ts" : 0,
+            # Records not written to the file yet
+            "buffer" : bytearray(buffered_records * history_record_size),
+            "buffered" : 0,
+            # Period being averaged
+            "period_ts" : 0,
+            "samples" : 0,
+            "temp_sum" : 0,
+            "humid_sum" : 0,
+            "relays" : 0,
+        }
+        try:
+            tier_open(tier)
+            history["tiers"].append(tier)
+
+        except Exception as e:
+            # Carry on without this tier, eg if the flash is full
+            log_exception("Exception opening history file %r", e, filename)
+
+    return history
+
+def tier_flush(tier):
+    buffered = tier["buffered"]
+    if (buffered == 0):
+        return
+
+    max_records = tier["max_records"]
+    buf = memoryview(tier["buffer"])
+    f = tier["file"]
+    head = tier["head"]
+    try:
+        # Write up to the end of the file and wrap around
+        i = 0
+        while (i < buffered):
+            n = min(buffered - i, max_records - head)
+            f.seek(head * history_record_size)
+            f.write(buf[i * history_record_size:(i + n) * history_record_size])
+            head = (head + n) % max_records
+            i += n
+        f.flush()
+        tier["head"] = head
+        tier["count"] = min(tier["count"] + buffered, max_records)
+
+    except Exception as e:
+        # Skip the records on failure, don't retry forever. Leave the ring
+        # position unchanged so the records that failed to write are not taken
+        # as valid
+        log_exception("Exception writing history file %r", e, tier["filename"])
+
+    tier["buffered"] = 0
+
+def tier_append_period(tier):
+    """
+    Buffer the average of the period being averaged
+    """
+    samples = tier["samples"]
+    # Round half up, also for negative temperatures
+    temp = (2 * tier["temp_sum"] + samples) // (2 * samples)
+    humid = (2 * tier["humid_sum"] + samples) // (2 * samples)
+    struct.pack_into(history_record_format, tier["buffer"], tier["buffered"] * history_record_size,
+        tier["period_ts"], temp, (tier["relays"] << history_relays_shift) | min(humid, history_humid_mask))
+    tier["last_ts"] = tier["period_ts"]
+    tier["buffered"] += 1
+    tier["samples"] = 0
+    if (tier["buffered"] * history_record_size == len(tier["buffer"])):
+        tier_flush(tier)
+
+def history_add(history, ts, temp, humid, relays):
+    """
+    Add a sample to all the tiers
+
+    @param ts unix epoch timestamp
+    @param temp temperature in tenths of degree
+    @param humid humidity in tenths of percentage
+    @param relays relay bitmask, see telemetry_relays
+    """
+    for tier in history["tiers"]:
+        period_ts = ts - (ts % tier["period"])
+        # Samples from before the current period (eg the clock went back after
+        # an NTP sync) are averaged in the current period so the timestamps
+        # in the file are always increasing
+        if ((tier["samples"] > 0) and (period_ts > tier["period_ts"])):
+            tier_append_period(tier)
+
+        if (tier["samples"] == 0):
+            # Drop samples not newer than the last record, eg the clock went
+            # back across a period or is not synced after a reset, which would
+            # break the ring order tier_open and tier_find rely on
+            if (period_ts <= tier["last_ts"]):
+                continue
+            tier["period_ts"] = period_ts
+            tier["temp_sum"] = 0
+            tier["humid_sum"] = 0
+            tier["relays"] = 0
+
+        tier["samples"] += 1
+        tier["temp_sum"] += temp
+        tier["humid_sum"] += humid
+        tier["relays"] |= relays
+
+def history_flush(history):
+    """
+    Write the buffered records of all the tiers
+    """
+    for tier in history["tiers"]:
+        tier_flush(tier)
+
+def tier_find(tier, ts):
+    """
+    @return number of records in the ring older than ts
+    """
+    max_records = tier["max_records"]
+    first = tier["head"] - tier["count"]
+    lo = 0
+    hi = tier["count"]
+    while (lo < hi):
+        mid = (lo + hi) // 2
+        if (tier_read_ts(tier, (first + mid) % max_records) < ts):
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return lo
+
+def history_query(history, from_ts, to_ts, period=None):
+    """
+    Find the records between from_ts and to_ts, both included
+
+    @param period period of the tier to read, None to read the finest tier with
+           records as old as from_ts, or the coarsest one if none
+    @return cursor to read the records with history_read, None if there's no
+            tier with that period
+    """
+    # Include the buffered records
+    history_flush(history)
+
+    selected = None
+    for tier in history["tiers"]:
+        if (period is None):
+            selected = tier
+            if ((tier["count"] > 0) and
+                (tier_read_ts(tier, (tier["head"] - tier["count"]) % tier["max_records"]) <= from_ts)):
+                break
+
+        elif (tier["period"] == period):
+            selected = tier
+            break
+
+    if (selected is None):
+        return None
+
+    start = tier_find(selected, from_ts)
+    end = tier_find(selected, to_ts + 1)
+
+    return {
+        "tier" : selected,
+        "index" : (selected["head"] - selected["count"] + start) % selected["max_records"],
+        "left" : end - start,
+        "last_ts" : 0,
+    }
+
+def history_read(cursor, buf):
+    """
+    Read the next records of the query into buf
+
+    @param buf bytearray or memoryview, read up to len(buf) // 8 records
+    @return number of records read, 0 once all were read
+    """
+    tier = cursor["tier"]
+    max_records = tier["max_records"]
+    n = min(cursor["left"], len(buf) // history_record_size, max_records - cursor["index"])
+    if (n == 0):
+        return 0
+
+    f = tier["file"]
+    f.seek(cursor["index"] * history_record_size)
+    f.readinto(memoryview(buf)[:n * history_record_size])
+
+    # Stop at records written after the query, which are not newer than the
+    # ones before since they overwrote the oldest records
+    last_ts = cursor["last_ts"]
+    left = cursor["left"] - n
+    for i in range(n):
+        ts = struct.unpack_from("!I", buf, i * history_record_size)[0]
+        if (ts <= last_ts):
+            n = i
+            left = 0
+            break
+        last_ts = ts
+
+    cursor["last_ts"] = last_ts
+    cursor["index"] = (cursor["index"] + n) % max_records
+    cursor["left"] = left
+
+    return n
+
+def history_encode_chunk_header(buf, request_id, seq, cursor):
+    """
+    Encode the header of the chunk with the records last read by the cursor,
+    the chunk is the last one if there are no records left to read
+
+    @param buf bytearray with the records after history_chunk_header_size
+    """
+    struct.pack_into(history_chunk_format, buf, 0, history_chunk_version, request_id & 0xffff,
+        seq & 0xffff, cursor["tier"]["period"], history_flag_last if (cursor["left"] == 0) else 0)
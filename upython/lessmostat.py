@@ -45,14 +45,21 @@ import errno
 import gc
 import machine
 import os
-import time
 import ujson as json
 import ubinascii as binascii
 
+from aio import asyncio, sleep_ms
 from config import read_config, write_config
-from logging import log_info, log_exception
-from mqtt import mqtt_create, mqtt_connect, mqtt_publish_message, mqtt_publish_state_message, get_epoch, mqtt_check_msg, mqtt_disconnect
-from syncedtime import sync_time_with_ntp, get_epoch
+from history import history_add, history_create, history_encode_chunk_header, history_flush, history_query, history_read, history_chunk_header_size, history_record_size
+from logging import log_info, log_exception, log_flush, log_flush_period_ms
+from mqtt import mqtt_create, mqtt_connect, mqtt_drain_outbox, mqtt_publish_message, mqtt_publish_payload, mqtt_publish_state_message, mqtt_publish_state_delta, mqtt_state_changed, get_epoch, mqtt_check_msg, mqtt_disconnect, partial
+from outbox import outbox_create
+from relays import relays_create, relays_set, relays_tick
+from rules import rules_check, rules_invalidate, rules_pending, rules_set_anticipation, rules_set_sensor, rules_threshold_distances
+from sampler import sampler_create, sampler_next_period
+from syncedtime import sync_time_with_ntp, get_epoch, min_ntp_sync_time, time_synced
+from telemetry import telemetry_encode_into, telemetry_relays, telemetry_size
+from thermal import thermal_add, thermal_coast, thermal_create, thermal_eta_secs
 
 # Test reception e.g. with:
 # mosquitto_sub -t foo_topic
@@ -101,6 +108,8 @@ def sub_cb(client, topic, msg):
     topic: x/lessmostat/control/ac msg: { timestamp: , state: "on" | "off", tod :,  dow, temp : degs }
     topic: x/lessmostat/control/reset:
     topic: x/lessmostat/control/state: force state publish
+    topic: x/lessmostat/control/history msg: { id :, from : ts, to : ts, period : secs }
+        stream the sensor history, see history_task
 
     state: "on" | "off" set the device to on or off
     start_dow : start day of the week from 0 to 6, null for today
@@ -150,34 +159,51 @@ def sub_cb(client, topic, msg):
 
     Get lat/long from https://sunrise-sunset.org/search?location=miami
     """
-    log_info("callback for topic %r msg %r" % (topic, msg))
+    log_info("callback for topic %r msg %r", topic, msg)
 
     try:
         d = json.loads(msg)
 
         if (topic.endswith("/state")):
+            # Full state requested
             mqtt_publish_state_message(client, state)
 
         elif (topic.endswith("control/ac")):
             state["config"]["ac_rules"] = [
                 { "state" : "on", "temp" : d["temp"], "humid" : d["humid"] },
             ]
-            # XXX Should this publish only the delta?
-            mqtt_publish_state_message(client, state)
+            rules_invalidate()
+            mqtt_state_changed(client, "config", "ac_rules")
+            mqtt_publish_state_delta(client, state)
 
         elif (topic.endswith("control/heat")):
             state["config"]["heat_rules"] = [
                 { "state" : "on", "temp" : d["temp"], "humid" : d["humid"] },
             ]
-            # XXX Should this publish only the delta?
-            mqtt_publish_state_message(client, state)
+            rules_invalidate()
+            mqtt_state_changed(client, "config", "heat_rules")
+            mqtt_publish_state_delta(client, state)
 
         elif (topic.endswith("control/fan")):
             state["config"]["fan_rules"] = [
                 { "state" : d["state"] },
             ]
-            # XXX Should this publish only the delta?
-            mqtt_publish_state_message(client, state)
+            rules_invalidate()
+            mqtt_state_changed(client, "config", "fan_rules")
+            mqtt_publish_state_delta(client, state)
+
+        elif (topic.endswith("control/history")):
+            # Records from "from" to "to" (the last hour by default) of the
+            # tier with the given "period" (by default the finest tier with
+            # records that old), streamed on info/history by the history task
+            # A new request cancels the one in progress
+            now_ts = get_epoch()
+            cursor = history_query(g_history, d.get("from", now_ts - 3600), d.get("to", now_ts), d.get("period", None))
+            if (cursor is None):
+                log_info("No history with period %r", d.get("period", None))
+            g_history_reply["cursor"] = cursor
+            g_history_reply["id"] = d.get("id", 0)
+            g_history_reply["seq"] = 0
 
         elif (topic.endswith("control/store_preset")):
             # Copy the current rules into the given preset
@@ -190,47 +216,31 @@ def sub_cb(client, topic, msg):
             else:
                 state["config"]["presets"][preset_index]["heat"] = state["config"]["heat_rules"][0]
 
-            # XXX Should this publish only the delta?
-            mqtt_publish_state_message(client, state)
+            mqtt_state_changed(client, "config", "presets")
+            mqtt_publish_state_delta(client, state)
             
             write_config(config_filename, state)
 
     except Exception as e:
-        log_exception("Exception handling topic %r message %r" % (topic, msg), e)
-
-# See 
-# http://www.icstation.com/esp8266-wifi-channel-relay-module-smart-home-remote-control-switch-android-phone-control-transmission-distance-100m-p-12592.html
-# https://www.icstation.com/esp8266-wifi-channel-relay-module-remote-control-switch-wireless-transmitter-smart-home-p-13420.html
-relay_1_off = [0xA0, 0x01, 0x00, 0xA1]
-relay_1_on = [0xA0, 0x01, 0x1, 0xA2]
-relay_2_off = [0xA0, 0x02, 0x00, 0xA2]
-relay_2_on = [0xA0, 0x02, 0x01, 0xA3]
-relay_3_off = [0xA0, 0x03, 0x00, 0xA3]
-relay_3_on = [0xA0, 0x03, 0x01, 0xA4]
-relay_4_off = [0xA0, 0x04, 0x00, 0xA4]
-relay_4_on = [0xA0, 0x04, 0x01, 0xA5]
-        
-def uart_write(uart, b):
-    uart.write(b)
-    # XXX Looks like some delay is needed between uart writes otherwise the 
-    #     second write is lost and the relay state is not modified
-    #     This is the case even with some code between uart_write invocations
-    time.sleep(1)
-
-fan_on = bytes(relay_2_on)
-fan_off = bytes(relay_2_off)
-def turn_fan(uart, client, on):
+        log_exception("Exception handling topic %r message %r", e, topic, msg)
+
+# Relay numbers on the relay board
+ac_relay = 1
+fan_relay = 2
+heat_relay = 3
+
+def turn_fan(relays, client, on):
     fan_state = state["fan"]
     # Uptime accumulation assumes there are no redundant calls
     assert ((on and (fan_state != "on")) or ((not on) and fan_state != "off"))
     if (on):
         # XXX Should prevent somewhere it's not trying to re-enable fan before the
         #     safety idle period
-        uart_write(uart, fan_on)
+        relays_set(relays, fan_relay, True)
         fan_state = "on"
 
     else:
-        uart_write(uart, fan_off)
+        relays_set(relays, fan_relay, False)
         fan_state = "off"
         
     state["fan"] = fan_state
@@ -239,14 +249,13 @@ def turn_fan(uart, client, on):
     if (not on):
         # Accumulate uptime
         state["fan_uptime"] += (state["fan_mod_ts"] - prev_fan_mod_ts)
+        mqtt_state_changed(client, "fan_uptime")
+    mqtt_state_changed(client, "fan")
+    mqtt_state_changed(client, "fan_mod_ts")
 
-    mqtt_publish_message(client, "info/fan", { 'state' : fan_state, 'mod_ts' : state["fan_mod_ts"], 'uptime' : state["fan_uptime"] })
+    mqtt_publish_message(client, "info/fan", { 'state' : fan_state, 'mod_ts' : state["fan_mod_ts"], 'uptime' : state["fan_uptime"] }, False, 1)
 
-ac_on = bytes(relay_1_on)
-ac_off = bytes(relay_1_off)
-heat_on = bytes(relay_3_on)
-heat_off = bytes(relay_3_off)
-def turn_ac_heat(uart, client, ac_heat, on):
+def turn_ac_heat(relays, client, ac_heat, on):
     """
     @param ac_heat one of "ac" or "heat"
     """
@@ -254,7 +263,7 @@ def turn_ac_heat(uart, client, ac_heat, on):
     other_ac_heat = "heat" if (ac_heat == "ac") else "ac"
     # Never turn on heat if ac is on or viceversa
     if ((state[other_ac_heat] == "on") and on):
-        log_info("Ignoring turning %s on when %s is already on" % (ac_heat, other_ac_heat))
+        log_info("Ignoring turning %s on when %s is already on", ac_heat, other_ac_heat)
         return
 
     # Uptime accumulation assumes there are no redundant calls
@@ -262,17 +271,19 @@ def turn_ac_heat(uart, client, ac_heat, on):
     if (on):
         # Always turn fan on before ac/heat
         if (state["fan"] != "on"):
-            log_info("%s forcing fan on" % ac_heat)
-            turn_fan(uart, client, on)
+            log_info("%s forcing fan on", ac_heat)
+            turn_fan(relays, client, on)
 
         # XXX Should prevent somewhere it's not trying to re-enable ac
         #     before the safety idle period
 
-        uart_write(uart, ac_on if (ac_heat == "ac") else heat_on)
+        # Note the relay queue keeps the order, so the fan relay is always
+        # written before the ac/heat one
+        relays_set(relays, ac_relay if (ac_heat == "ac") else heat_relay, True)
         ac_heat_state = "on"
         
     else:
-        uart_write(uart, ac_off if (ac_heat == "ac") else heat_off)
+        relays_set(relays, ac_relay if (ac_heat == "ac") else heat_relay, False)
         ac_heat_state = "off"
         
         # Leave the fan on, let it turn off depending on the rules
@@ -283,8 +294,11 @@ def turn_ac_heat(uart, client, ac_heat, on):
     if (not on):
         # Accumulate uptime
         state["%s_uptime" % ac_heat] += (state["%s_mod_ts" % ac_heat] - prev_ac_heat_mod_ts)
+        mqtt_state_changed(client, "%s_uptime" % ac_heat)
+    mqtt_state_changed(client, ac_heat)
+    mqtt_state_changed(client, "%s_mod_ts" % ac_heat)
 
-    mqtt_publish_message(client, "info/%s" % ac_heat, { 'state' : ac_heat_state, 'mod_ts' : state["%s_mod_ts" % ac_heat], 'uptime' : state["%s_uptime" % ac_heat] })
+    mqtt_publish_message(client, "info/%s" % ac_heat, { 'state' : ac_heat_state, 'mod_ts' : state["%s_mod_ts" % ac_heat], 'uptime' : state["%s_uptime" % ac_heat] }, False, 1)
 
 state = { 
     # Current state
@@ -303,6 +317,9 @@ state = {
     "fan_uptime" : 0,
 
     "sensor" : { "humid" : None, "temp" : None },
+    # Estimated time the running ac/heat will reach its off temperature, None
+    # if idle or unknown, see update_eta
+    "eta_ts" : None,
 
     
     # Configuration state
@@ -327,9 +344,9 @@ state = {
         # on or "auto" (match ac state)
         # XXX Allow setting the fan on a timer ("on", 15-30-60-120 min, "auto")
         #     and then revert to auto
-        # XXX The fan counter could also show a guess on how long it will take
-        #     to bring to the desired temp. Or move to a counter in the
-        #     idle/cooling/heating state
+        # The fan counter shows the estimated time to the desired temp, see
+        # eta_ts
+        # XXX Or move to a counter in the idle/cooling/heating state
         "fan_rules" : [
             { "state" : "auto" }
         ],
@@ -344,6 +361,22 @@ state = {
         "lo_threshold_decihumids" : 40,
         "hi_threshold_decihumids" : 40,
 
+        # Stop the ac/heat before the off threshold by how much the temperature
+        # was learned to keep going after stopping, so it lands on the off
+        # threshold instead of past it, see thermal.py
+        "predictive" : False,
+
+        # Minimum and maximum period between sensor samples, the period adapts
+        # to how fast the samples change and how close they are to a rule
+        # threshold, see sampler.py. Note the DHT22 needs at least 2000ms
+        # between measures
+        "min_sensor_period_ms" : 5000,
+        "max_sensor_period_ms" : 60000,
+
+        # Sensor sample messages to publish, "json" on info/sensor, "binary"
+        # on info/sensor_bin (see telemetry.py) or "both"
+        "sensor_format" : "json",
+
         # XXX Should this store the thresholds too?
         "presets" : [
             { "fan" : { "state" : "auto" }, "heat" : { "state" : "on", "temp" : 10, "humid" : 70 }, "ac" : { "state" : "on", "temp" : 30, "humid" : 70 } },
@@ -354,223 +387,333 @@ state = {
 }
 max_presets = len(state["config"]["presets"])
 
-def main():
-    try:
-        log_info("Reading initial configuration")
-        read_config(config_filename, state)
-        log_info("Initial state is %r" % state)
-
-        # Fetch some constant values from the config
-        hi_threshold_decidegs = state["config"]["hi_threshold_decidegs"]
-        lo_threshold_decidegs = state["config"]["lo_threshold_decidegs"]
-        hi_threshold_decihumids = state["config"]["hi_threshold_decihumids"]
-        lo_threshold_decihumids = state["config"]["lo_threshold_decihumids"]
-        mqtt_broker = state["config"]["mqtt_broker"]
-        mqtt_topic = state["config"]["mqtt_topic"]
-
-        # Update time with NTP
-        sync_time_with_ntp()
-        
-        client_id = binascii.hexlify(machine.unique_id())
+# Minimum period between DHT22 measures
+dht22_min_period_ms = 2000
+# Period between non-blocking MQTT message checks, short so control messages
+# are responsive
+mqtt_poll_ms = 50
+# Wait between MQTT reconnection attempts
+mqtt_reconnect_ms = 1000
+# Period between rule checks and relay queue drains. The rules are only
+# evaluated when they or the sensor sample changed, so this is cheap
+rules_poll_ms = 50
+# Messages buffered while the broker is unreachable, in RAM and in a file once
+# the RAM is full, ~30 minutes of sensor samples in total. Buffered messages
+# are published in batches on every MQTT poll once reconnected
+outbox_max_messages = 16
+outbox_spill_filename = "outbox.dat"
+outbox_max_spill_messages = 192
+outbox_drain_batch = 8
+# Sensor history on flash, 10 second samples for a day and 5 minute averages
+# for a month, ~70KB each, see history.py. The 10 second samples are written
+# to flash 30 at a time, ie every 5 to 30 minutes depending on the sensor
+# period
+history_tiers = (
+    ("history_10s.dat", 10, 24 * 360, 30),
+    ("history_5m.dat", 5 * 60, 31 * 24 * 12, 1),
+)
+# History records per info/history message and wait between messages
+history_chunk_records = 64
+history_chunk_ms = 50
+
+# Sensor history, created once the time is synced, see main_async
+g_history = None
+# Thermal model learned from the sensor samples, see update_thermal_model
+g_thermal = thermal_create()
+# The estimated time to target is only republished when it moves by more than
+# this
+eta_resolution_secs = 60
+# control/history request being replied to, see history_task
+g_history_reply = { "cursor" : None, "id" : 0, "seq" : 0 }
+
+def update_thermal_model(now_ts, decidegs):
+    """
+    Learn from the sensor sample and, if predictive, move the rule off
+    thresholds by the learned coast
+    """
+    thermal_add(g_thermal, now_ts, decidegs, state["ac"] == "on", state["heat"] == "on")
+    if (state["config"]["predictive"]):
+        rules_set_anticipation(thermal_coast(g_thermal, "ac"), thermal_coast(g_thermal, "heat"))
+    else:
+        rules_set_anticipation(0, 0)
 
-        # Now that we have an NTP time, initialize state times
+def update_eta(client, now_ts, temp_distance):
+    """
+    @param temp_distance distance to the nearest temperature threshold, see
+           rules_threshold_distances, while the ac/heat is on this is the
+           distance to its off threshold
+    """
+    eta_ts = None
+    ac_heat = "ac" if (state["ac"] == "on") else ("heat" if (state["heat"] == "on") else None)
+    if ((ac_heat is not None) and (temp_distance is not None)):
+        eta_secs = thermal_eta_secs(g_thermal, ac_heat, temp_distance)
+        if (eta_secs is not None):
+            eta_ts = now_ts + eta_secs
+
+    prev_eta_ts = state["eta_ts"]
+    if (((eta_ts is None) != (prev_eta_ts is None)) or
+        ((eta_ts is not None) and (abs(eta_ts - prev_eta_ts) > eta_resolution_secs))):
+        state["eta_ts"] = eta_ts
+        mqtt_state_changed(client, "eta_ts")
+
+async def sensor_task(dht_sensor, publish_event, client):
+    config = state["config"]
+    sampler = sampler_create(max(config["min_sensor_period_ms"], dht22_min_period_ms),
+        max(config["max_sensor_period_ms"], dht22_min_period_ms))
+    while (True):
+        # Doing a GC here seems to help random restarts without registering
+        # an exception, probably caused by logging code causing out of
+        # memory errors (which would explain why no exception is logged)
+        gc.collect()
+
+        # Gather sensor information
+        # Note measure() blocks but only for the start pulse and the data
+        # transfer (tens of ms), the DHT22 needs 2s between measures (1s on
+        # DHT11) which is ensured by the sensor period
+        dht_sensor.measure()
+
+        temp = dht_sensor.temperature()
+        humid = dht_sensor.humidity()
+
+        state["sensor"]["temp"] = temp
+        state["sensor"]["humid"] = humid
+        rules_set_sensor(temp, humid)
+
+        publish_event.set()
+
+        decidegs = int(round(temp * 10))
+        decihumids = int(round(humid * 10))
         now_ts = get_epoch()
-        state["start_ts"] = now_ts
-        state["ac_mod_ts"] = now_ts
-        state["fan_mod_ts"] = now_ts
-        
-        log_info("Initializing relays uart")
-        uart = machine.UART(0, baudrate=115200, bits=8, parity=None, stop=1)
-        # Detach REPL from UART so UART can be used for the relays
-        log_info("Detaching UART from repl")
-        os.dupterm(uart, 1)
-
-        # The DHT is connected to the 5V, GND and RX (gpio 3)
-        # Steal the RX pin from the uart, see
-        # https://forum.micropython.org/viewtopic.php?t=6669
-        log_info("Initializing DHT sensor")
-        dht_sensor = dht.DHT22(machine.Pin(3, machine.Pin.IN))
-        # DHT22 is known to timeout the first few times measure() is called, retry
-        num_retries = 10
-        while (num_retries > 0):
-            try:
-                num_retries -= 1
-                dht_sensor.measure()
-                break
-            except OSError as e:
-                if (e.errno == errno.ETIMEDOUT):
-                    log_info("DHT sensor timed out, retrying")
-
-                else:
-                    raise
-
-        # On power unplug reset the relays are closed, but on machine reset they
-        # are left to whatever state before reset, so set the AC and fan relays
-        # to a known state (closed)
-        # XXX Should this have some hysteresis in case this is always starting
-        #     and engaging the ac/fan? It already has a delay in main.py, but
-        #     the main loop could have a warm-up timer where it ignores the
-        #     rules (or just a plain sleep)
-        log_info("Setting ac to known state")
-        uart_write(uart, ac_off)
-        log_info("Setting heat to known state")
-        uart_write(uart, heat_off)
-        log_info("Setting fan to known state")
-        uart_write(uart, fan_off)
-
-        client = mqtt_create(mqtt_broker, client_id, mqtt_topic, sub_cb)
-        # Now that the state is known, connect and accept control commands
-        mqtt_connect(client)
-
-        # Advertise the initial state after accepting control commands so
-        # clients can start as soon as they get the initial state
-        # XXX There's the theoretical possibility of a stale control command 
-        #     coming in before the state is advertised?
-        mqtt_publish_state_message(client, state)
-        
-        log_info("Starting sensor reading and MQTT message handling forever loop")
-        while (True):
-            # Doing a GC here seems to help random restarts without registering
-            # an exception, probably caused by logging code causing out of
-            # memory errors (which would explain why no exception is logged)
-            gc.collect()
-
-            # Gather sensor information
-            # Do sparingly since this can take 2s on DHT22, 1s on DHT11
-            dht_sensor.measure()
+        # Don't record samples until the clock is synced, the timestamps in
+        # the history must be increasing, see history_add
+        if (time_synced()):
+            history_add(g_history, now_ts, decidegs, decihumids, telemetry_relays(state))
+        update_thermal_model(now_ts, decidegs)
+
+        # Wait for rules_task to apply the sample, otherwise a sample that
+        # crossed a threshold gives the distance to the next threshold and
+        # the relay change is missed, so the period could grow right when the
+        # relays change
+        while (rules_pending()):
+            await sleep_ms(rules_poll_ms)
+
+        # Note the sensor messages contain a timestamp so the period doesn't
+        # need to be regular
+        temp_distance, humid_distance = rules_threshold_distances(state)
+        update_eta(client, now_ts, temp_distance)
+        period_ms = sampler_next_period(sampler, decidegs, decihumids,
+            temp_distance, humid_distance, (state["ac"], state["heat"], state["fan"]))
+
+        await sleep_ms(period_ms)
+
+# Reused for all the binary sensor samples
+telemetry_buf = bytearray(telemetry_size)
+
+async def publish_task(client, publish_event):
+    while (True):
+        await publish_event.wait()
+        publish_event.clear()
+
+        # Publish sensor information
+        # XXX Should this only publish changes?
+        sensor = state["sensor"]
+        sensor_format = state["config"]["sensor_format"]
+        if (sensor_format != "binary"):
+            mqtt_publish_message(client, "info/sensor", {'temp' : sensor["temp"], 'humid' : sensor["humid"]})
+
+        if (sensor_format != "json"):
+            # The binary sample is encoded in place. If buffered, samples with
+            # the same sensor values and relays as the previous one are
+            # coalesced
+            telemetry_encode_into(telemetry_buf, get_epoch(), sensor["temp"], sensor["humid"], state)
+            mqtt_publish_payload(client, "info/sensor_bin", telemetry_buf, False, 0, True, (sensor["temp"], sensor["humid"], state["ac"], state["heat"], state["fan"]))
+
+async def mqtt_task(client):
+    while (True):
+        # Non-blocking check for messages
+        try:
+            # This raises OSERROR (-1), ECONNRESET (errno 114),
+            # ECONNABORTED (errno 103) on error
+            # Also returns EHOSTUNREACH (errno 113) if it was never able
+            # to connect
+            mqtt_check_msg(client)
+
+        except OSError as e:
+            # Don't bother logging these to file as they are too noisy
+            # and non fatal
+            log_exception("Exception checking MQTT message", e, stdout_only=True)
+
+            mqtt_connect(client)
+            if (client["connected"]):
+                # Subscribers may have missed deltas while disconnected. Note
+                # the snapshot is published before the buffered messages, but
+                # those are timestamped
+                mqtt_publish_state_message(client, state)
 
-            temp = dht_sensor.temperature()
-            humid = dht_sensor.humidity()
+            else:
+                await sleep_ms(mqtt_reconnect_ms)
+
+        # Publish messages buffered while disconnected, a batch at a time so
+        # control messages are still checked
+        mqtt_drain_outbox(client, outbox_drain_batch)
+
+        # Publish any state changes, eg relay changes made by the rules task
+        mqtt_publish_state_delta(client, state)
+
+        await sleep_ms(mqtt_poll_ms)
+
+# Reused for all the history messages
+history_buf = bytearray(history_chunk_header_size + history_chunk_records * history_record_size)
+
+async def history_task(client):
+    records_mv = memoryview(history_buf)[history_chunk_header_size:]
+    while (True):
+        await sleep_ms(history_chunk_ms)
+
+        cursor = g_history_reply["cursor"]
+        if (cursor is None):
+            continue
+
+        if (not client["connected"]):
+            # Drop the request, the messages wouldn't be buffered anyway
+            g_history_reply["cursor"] = None
+            continue
+
+        # Publish a chunk at a time, the last chunk is sent even if empty so
+        # the client knows the request is done
+        n = history_read(cursor, records_mv)
+        history_encode_chunk_header(history_buf, g_history_reply["id"], g_history_reply["seq"], cursor)
+        mqtt_publish_payload(client, "info/history", memoryview(history_buf)[:history_chunk_header_size + n * history_record_size], False, 0, False)
+        g_history_reply["seq"] += 1
+        if (cursor["left"] == 0):
+            g_history_reply["cursor"] = None
+
+async def log_task():
+    while (True):
+        # Write the buffered log lines, the log only writes to the file by
+        # itself when the buffer is full or on exceptions
+        await sleep_ms(log_flush_period_ms)
+        log_flush()
+
+async def ntp_task():
+    while (True):
+        await sleep_ms(min_ntp_sync_time * 1000)
+        await sync_time_with_ntp()
+
+async def rules_task(relays, client):
+    # Bind the relay functions once instead of every rule check
+    turn_ac_heat_cb = partial(turn_ac_heat, relays, client)
+    turn_fan_cb = partial(turn_fan, relays, client)
+
+    while (True):
+        # Check rules, this only evaluates them if the rules or the sensor
+        # sample changed since the last check
+        rules_check(state, turn_ac_heat_cb, turn_fan_cb)
+
+        # Write the next pending relay command, if any and if enough time
+        # passed since the last write
+        relays_tick(relays)
+
+        await sleep_ms(rules_poll_ms)
+
+async def main_async():
+    global g_history
+    log_info("Reading initial configuration")
+    read_config(config_filename, state)
+    log_info("Initial state is %r", state)
+
+    # Fetch some constant values from the config
+    mqtt_broker = state["config"]["mqtt_broker"]
+    mqtt_topic = state["config"]["mqtt_topic"]
+
+    # Update time with NTP
+    await sync_time_with_ntp()
+    
+    client_id = binascii.hexlify(machine.unique_id())
 
-            # Publish sensor information
-            # XXX Should this only publish changes?
-            mqtt_publish_message(client, "info/sensor", {'temp' : temp, 'humid' : humid})
+    # Now that we have an NTP time, initialize state times
+    now_ts = get_epoch()
+    state["start_ts"] = now_ts
+    state["ac_mod_ts"] = now_ts
+    state["fan_mod_ts"] = now_ts
 
-            state["sensor"]["temp"] = temp
-            state["sensor"]["humid"] = humid
+    log_info("Opening sensor history")
+    g_history = history_create(history_tiers)
+    
+    log_info("Initializing relays uart")
+    uart = machine.UART(0, baudrate=115200, bits=8, parity=None, stop=1)
+    # Detach REPL from UART so UART can be used for the relays
+    log_info("Detaching UART from repl")
+    os.dupterm(uart, 1)
+
+    # The DHT is connected to the 5V, GND and RX (gpio 3)
+    # Steal the RX pin from the uart, see
+    # https://forum.micropython.org/viewtopic.php?t=6669
+    log_info("Initializing DHT sensor")
+    dht_sensor = dht.DHT22(machine.Pin(3, machine.Pin.IN))
+    # DHT22 is known to timeout the first few times measure() is called, retry
+    num_retries = 10
+    while (num_retries > 0):
+        try:
+            num_retries -= 1
+            dht_sensor.measure()
+            break
+        except OSError as e:
+            if (e.errno == errno.ETIMEDOUT):
+                log_info("DHT sensor timed out, retrying")
 
-            sync_time_with_ntp()
-            
-            # Wait some seconds between reporting sensor data (the wait could be
-            # longer depending on the execution time of the loop below, but it's
-            # okay even if we ever need some time accurate policy because sensor
-            # messages contain timestamp)
-            sleep_ms = 10000
-            # Sleep a few millis between message checks so target temperature
-            # updates on the client are responsive
-            sleep_iteration_ms = 500
-            iterations = sleep_ms / sleep_iteration_ms
-            for i in range(iterations):
-                # Non-blocking check for messages
-                
-                try:
-                    # This raises OSERROR (-1), ECONNRESET (errno 114),
-                    # ECONNABORTED (errno 103) on error
-                    # Also returns EHOSTUNREACH (errno 113) if it was never able
-                    # to connect
-                    mqtt_check_msg(client)
-
-                except OSError as e:
-                    # Don't bother logging these to file as they are too noisy
-                    # and non fatal
-                    log_exception("Exception checking MQTT message", e, True)
-                    
-                    mqtt_connect(client)
-
-                time.sleep_ms(sleep_iteration_ms)
-
-                # Check rules
-                # Collect active rules
-                # No need to refresh temp, will be refreshed in the next 30s
-                # XXX This only needs checking if the rules changed, since the
-                #     temperature is only updated above
-                ac_rules = state["config"]["ac_rules"]
-                heat_rules = state["config"]["heat_rules"]
-                # XXX Note heating/cooling assumes the right wire (white heating
-                #     / yellow for cooling) is being driven by the ac_on relay.
-                #     Ideally this should use a three or four-channel relay,
-                #     another option is to connect the green wire (fan) to both,
-                #     drive heating with the current fan relay the and lose
-                #     independent fan control?
-                for rule in ac_rules + heat_rules:
-                    rule_state = rule["state"]
-                    rule_temp = rule.get("temp", None)
-                    # XXX In heating mode the AC seems to wait for around one
-                    #     minute to turn the fan off, there should be a way to
-                    #     put that safety rule
-                    
-                    # XXX This will turn heating on in the same iteration ac is
-                    #     turned off and without intervening fan turning off,
-                    #     should wait some time? (for the converse, ac & fan are
-                    #     not turned on until the next iteration because of the
-                    #     way heat_rules are processed after ac_rules in the for
-                    #     rule iteration above)
-
-                    heating = rule in heat_rules
-                    cooling = not heating
-                    turn_ac_heat_on_count = 0
-                    turn_ac_heat_off_count = 0
-                    ac_heat_state = state["ac" if cooling else "heat"]
-                    ac_heat = "ac" if cooling else "heat"
-                    if (rule_temp is not None):
-                        under_threshold = (temp*10 <= rule_temp*10 - lo_threshold_decidegs)
-                        over_threshold = (temp*10 >= rule_temp*10 + hi_threshold_decidegs)
-                        if ((ac_heat_state != "on") and (rule_state == "on") and 
-                            ((heating and under_threshold) or (cooling and over_threshold))):
-                            turn_ac_heat_on_count += 1
-                            
-                        elif ((ac_heat_state != "off") and (rule_state == "on") and 
-                            ((heating and over_threshold) or (cooling and under_threshold))):
-                            turn_ac_heat_off_count += 1
-                            
-                    rule_humid = rule.get("humid", None)
-                    if (rule_humid is not None):
-                        under_threshold = (humid*10 <= rule_humid*10 - lo_threshold_decihumids)
-                        over_threshold = (humid*10 >= rule_humid*10 + hi_threshold_decihumids)
-
-                        if ((ac_heat_state != "on") and (rule_state == "on") and over_threshold):
-                            turn_ac_heat_on_count +=1
-                            
-                        elif ((ac_heat_state != "off") and (rule_state == "on") and under_threshold):
-                            turn_ac_heat_off_count += 1
-
-                    # Turn AC off if any of temp or humid require it, turn off
-                    # if both temp and humid require it
-                    #
-                    # Note that due how thresholds work it's possible that the
-                    # AC gets turned on because of temp, but once below the temp
-                    # threshold it's kept on because of not being below the
-                    # humid threshold. This seems ok even if non-obvious, other
-                    # option would be to keep track of the rule that enabled the
-                    # ac and only allow that one to keep it on, but would
-                    # complicate the logic for little benefit?
-                    
-                    if (turn_ac_heat_on_count >= 1):
-                        log_info("Starting %s, on %d off %d" % (ac_heat, turn_ac_heat_on_count, turn_ac_heat_off_count))
-                        turn_ac_heat(uart, client, ac_heat, True)
-
-                    elif (turn_ac_heat_off_count == 2):
-                        log_info("Stopping %s, on %d off %d" % (ac_heat, turn_ac_heat_on_count, turn_ac_heat_off_count))
-                        turn_ac_heat(uart, client, ac_heat, False)
-
-                
-                fan_rules = state["config"]["fan_rules"]
-                ac_or_heat_on = ((state["heat"] == "on") or (state["ac"] == "on")) 
-                for rule in fan_rules:
-                    rule_state = rule["state"]
-                    if ((rule_state == "on") and (state["fan"] != "on")):
-                        log_info("Starting fan")
-                        turn_fan(uart, client, True)
-
-                    elif ((rule_state == "auto") and ((state["fan"] == "on") != ac_or_heat_on)):
-                        # Auto fan needs to be on if any of heat or ac are on
-                        # Note that in reality this code will only run to turn
-                        # the fan off, the fan is turned on unconditionally for
-                        # safety reasons at ac turn on time
-                        log_info("Matching fan to ac/heat")
-                        turn_fan(uart, client, ac_or_heat_on)
-
-        mqtt_disconnect(client)
+            else:
+                raise
+        # Wait the minimum DHT22 period between measures
+        await sleep_ms(dht22_min_period_ms)
+
+    # On power unplug reset the relays are closed, but on machine reset they
+    # are left to whatever state before reset, so set the AC and fan relays
+    # to a known state (closed)
+    # XXX Should this have some hysteresis in case this is always starting
+    #     and engaging the ac/fan? It already has a delay in main.py, but
+    #     the main loop could have a warm-up timer where it ignores the
+    #     rules (or just a plain sleep)
+    # Note the relay commands are queued and written from the rules task
+    log_info("Setting ac, heat and fan to known state")
+    relays = relays_create(uart)
+    relays_set(relays, ac_relay, False)
+    relays_set(relays, heat_relay, False)
+    relays_set(relays, fan_relay, False)
+
+    outbox = outbox_create(outbox_max_messages, outbox_spill_filename, outbox_max_spill_messages)
+    client = mqtt_create(mqtt_broker, client_id, mqtt_topic, sub_cb, outbox)
+    # Now that the state is known, connect and accept control commands
+    mqtt_connect(client)
+
+    # Advertise the initial state after accepting control commands so
+    # clients can start as soon as they get the initial state
+    # XXX There's the theoretical possibility of a stale control command 
+    #     coming in before the state is advertised?
+    mqtt_publish_state_message(client, state)
+
+    # Wait the minimum DHT22 period since the last measure
+    await sleep_ms(dht22_min_period_ms)
+
+    log_info("Starting sensor, publish, MQTT, NTP, rules, history and log tasks")
+    publish_event = asyncio.Event()
+    # Any exception in a task is propagated so main.py resets as it did with
+    # the single polling loop
+    await asyncio.gather(
+        sensor_task(dht_sensor, publish_event, client),
+        publish_task(client, publish_event),
+        mqtt_task(client),
+        ntp_task(),
+        rules_task(relays, client),
+        history_task(client),
+        log_task(),
+    )
+
+    mqtt_disconnect(client)
+
+def main():
+    try:
+        asyncio.run(main_async())
 
     finally:
         log_info("Exited main, writing configuration")
@@ -579,7 +722,9 @@ def main():
         # XXX This should write every day/hour if pending, otherwise when
         #     rebooting due to eg missing power it won't save
         write_config(config_filename, state)
+        if (g_history is not None):
+            history_flush(g_history)
+        log_flush()
 
 if (__name__ == "__main__"):
     main()
-        
\ No newline at end of file
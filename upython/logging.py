@@ -15,18 +15,92 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import io
 import os
 import sys
 import time
 
+# Log levels, messages below the current level are discarded before being
+# formatted, see log_all
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+g_log_level = LOG_INFO
+# Printing to stdout can be disabled when no REPL is attached, or removed at
+# compile time by cross-compiling with mpy-cross -O1, which sets __debug__ to
+# False
+g_log_stdout = True
+
+# The log is written to segments named <log filename>.<sequence number>, when the
+# current segment is over the max size a new segment is started and the oldest
+# segments over the max number of segments are deleted. The segments and their
+# start times are listed in the index file <log filename>.idx, one
+# "<sequence number> <start time>" line per segment from oldest to newest, so
+# the host can fetch only the segments it doesn't have
 g_log_filename = "logging.log"
-g_max_log_size_bytes = 16 * 1024
+g_max_log_size_bytes = 8 * 1024
+g_max_log_segments = 4
 g_log_file = None
+# Size of the current segment, tracked here instead of stat'ing the file on
+# every write, None if the file is not open
+g_log_file_size = None
+# List of (sequence number, start time string) of the existing segments, None
+# if the index hasn't been read yet
+g_log_segments = None
+
+# Lines are accumulated in this buffer and written to the file when the buffer
+# is full, when an exception is logged or when log_flush is called, see
+# log_flush_period_ms
+log_buffer_size = 1024
+# Period at which the log buffer is expected to be flushed by the caller
+log_flush_period_ms = 60 * 1000
+g_log_buf = bytearray(log_buffer_size)
+g_log_mv = memoryview(g_log_buf)
+g_log_buf_len = 0
+
+# Repeated identical messages are collapsed into a single "repeated" line
+g_last_msg = None
+g_repeat_count = 0
+
+# Bytes written to the file per hour are limited so eg exceptions ping ponging
+# when the network is down don't rotate the older segments out and wear out
+# the flash
+g_max_log_bytes_per_hour = 8 * 1024
+g_rate_window_ticks = None
+g_rate_bytes = 0
+g_rate_dropped = 0
 
 def log_set_max_file_size(max_size_bytes):
+    """
+    Set the max size of each log segment
+    """
     global g_max_log_size_bytes
     g_max_log_size_bytes = max_size_bytes
 
+def log_set_max_segments(max_segments):
+    global g_max_log_segments
+    g_max_log_segments = max_segments
+
+def log_set_max_bytes_per_hour(max_bytes):
+    global g_max_log_bytes_per_hour
+    g_max_log_bytes_per_hour = max_bytes
+
+def log_set_level(level):
+    global g_log_level
+    g_log_level = level
+
+def log_set_stdout(enabled):
+    global g_log_stdout
+    g_log_stdout = enabled
+
+def log_enabled(level):
+    """
+    Return True if messages of the given level are logged, for callers that
+    need to do some work to build the arguments
+    """
+    return (level >= g_log_level)
+
 def log_set_filename(filename):
     global g_log_filename
     if (g_log_file is not None):
@@ -34,57 +108,244 @@ def log_set_filename(filename):
 
     g_log_filename = filename
 
-def log_exception(msg, e, stdout_only = False):
-    log_all(msg, e, stdout_only)
+# The messages are format strings that are only formatted with the arguments
+# if the message is going to be logged, eg log_info("Got %r", msg) instead of
+# log_info("Got %r" % msg)
+
+def log_exception(msg, e, *args, stdout_only = False):
+    log_all(LOG_ERROR, msg, args, e, stdout_only)
 
-def log_info(msg, stdout_only = False):
-    log_all(msg, None, stdout_only)
+def log_warning(msg, *args, stdout_only = False):
+    log_all(LOG_WARNING, msg, args, None, stdout_only)
 
-def log_all(msg, e=None, stdout_only = False):
-    # XXX This should merge log entries, but also have a max log lines per hour
-    #     (eg what about ping pong of exceptions eg when network is down)
-    global g_log_file
+def log_info(msg, *args, stdout_only = False):
+    log_all(LOG_INFO, msg, args, None, stdout_only)
 
+def log_debug(msg, *args, stdout_only = False):
+    log_all(LOG_DEBUG, msg, args, None, stdout_only)
+
+def log_timestamp():
     (year, month, mday, hour, minute, second, weekday, yearday) = time.localtime()
-    s = "%d-%02d-%02d %02d:%02d:%02d " % (
+    return "%d-%02d-%02d %02d:%02d:%02d " % (
         year, month, mday,
         hour, minute, second
     )
 
-    # Do individual prints instead of string interpolation to prevent memory
-    # errors because of interpolating long strings
-    print(s, msg)
-    
-    if (e is not None):
-        print(e)
-        sys.print_exception(e, sys.stdout)
+def log_all(level, msg, args=(), e=None, stdout_only = False):
+    if (level < g_log_level):
+        return
+
+    to_stdout = __debug__ and g_log_stdout
+    if (stdout_only and (not to_stdout)):
+        return
+
+    if (len(args) > 0):
+        msg = msg % args
+    s = log_timestamp()
+
+    if (to_stdout):
+        # Do individual prints instead of string interpolation to prevent memory
+        # errors because of interpolating long strings
+        print(s, msg)
+
+        if (e is not None):
+            print(e)
+            sys.print_exception(e, sys.stdout)
 
     if (not stdout_only):
         try:
-            mode = "a+"
-            try:
-                st = os.stat(g_log_filename)
-                if (st[6] > g_max_log_size_bytes):
-                    log_info("Resetting %r over %d" % (g_log_filename, g_max_log_size_bytes), True)
-                    mode = "w"
-                    if (g_log_file is not None):
-                        g_log_file.close()
-                        g_log_file = None
-                    
-            except Exception as e:
-                # Note this can happen if the file doesn't exist, so open the
-                # file anyway
-                log_exception("Unable to stat %r" % g_log_filename, e, True)
-
-            if (g_log_file is None):
-                g_log_file = open(g_log_filename, mode)
-
-            g_log_file.write(s)
-            g_log_file.write(msg)
-            g_log_file.write("\n")
-            if (e is not None):
-                sys.print_exception(e, g_log_file)
-            g_log_file.flush()
-
-        except Exception as e:
-            log_exception("Exception writing exception to file", e, True)
+            log_write(s, msg, e)
+
+        except Exception as write_e:
+            # Note a different name is used for the exception so it doesn't
+            # clobber the exception being logged
+            log_exception("Exception writing log to file", write_e, stdout_only=True)
+
+def log_rate_allowed(s, n, exception):
+    """
+    Return True if n more bytes can be written to the file in the current hour
+
+    @param exception True if the bytes are an exception, which can also use
+           the bytes reserved for exceptions
+    """
+    global g_rate_window_ticks, g_rate_bytes, g_rate_dropped
+
+    now_ticks = time.ticks_ms()
+    if ((g_rate_window_ticks is None) or (time.ticks_diff(now_ticks, g_rate_window_ticks) >= 3600 * 1000)):
+        if (g_rate_dropped > 0):
+            log_append(s, "Dropped %d log entries over %d bytes per hour\n" % (g_rate_dropped, g_max_log_bytes_per_hour))
+        g_rate_window_ticks = now_ticks
+        g_rate_bytes = 0
+        g_rate_dropped = 0
+
+    # A quarter of the budget is reserved for exceptions, so a noisy loop
+    # can't drop the exception that precedes a reset
+    max_bytes = g_max_log_bytes_per_hour
+    if (not exception):
+        max_bytes -= max_bytes // 4
+    if (g_rate_bytes + n > max_bytes):
+        g_rate_dropped += 1
+        return False
+
+    g_rate_bytes += n
+    return True
+
+def log_write(s, msg, e):
+    global g_last_msg, g_repeat_count
+
+    if ((e is None) and (msg == g_last_msg)):
+        g_repeat_count += 1
+        return
+
+    if (g_repeat_count > 0):
+        log_append(s, "Last message repeated %d times\n" % g_repeat_count)
+        g_repeat_count = 0
+    # Never collapse exceptions, the traceback may be different, nor
+    # messages that were dropped
+    g_last_msg = None
+    line = msg + "\n"
+    if (e is not None):
+        tb = io.StringIO()
+        sys.print_exception(e, tb)
+        line += tb.getvalue()
+
+    if (not log_rate_allowed(s, len(s) + len(line), e is not None)):
+        return
+
+    if (e is None):
+        g_last_msg = msg
+    msg = line
+
+    log_append(s, msg)
+    if (e is not None):
+        # Exceptions can precede a reset, write them right away
+        log_flush()
+
+def log_append(s, msg):
+    """
+    Append a timestamp and a message, including the line terminator, to the log
+    buffer, flushing it first if it doesn't fit
+    """
+    global g_log_buf_len
+
+    b = (s + msg).encode("utf-8")
+    n = len(b)
+    if (g_log_buf_len + n > len(g_log_buf)):
+        log_flush()
+
+    if (n > len(g_log_buf)):
+        log_file_write(b)
+
+    else:
+        g_log_mv[g_log_buf_len:g_log_buf_len + n] = b
+        g_log_buf_len += n
+
+def log_flush():
+    """
+    Write the buffered log lines to the file, including the count of the
+    repeated messages not written yet
+    """
+    global g_log_buf_len, g_last_msg, g_repeat_count
+
+    if (g_repeat_count > 0):
+        n = g_repeat_count
+        g_repeat_count = 0
+        # Write the next repeat in full, the last message may be in an older
+        # segment by then
+        g_last_msg = None
+        log_append(log_timestamp(), "Last message repeated %d times\n" % n)
+
+    if (g_log_buf_len > 0):
+        # Empty the buffer even if the write fails, so a failing file doesn't
+        # cause a write per line
+        n = g_log_buf_len
+        g_log_buf_len = 0
+        log_file_write(g_log_mv[:n])
+
+def log_segment_filename(seq):
+    return "%s.%d" % (g_log_filename, seq)
+
+def log_index_filename():
+    return g_log_filename + ".idx"
+
+def log_write_index():
+    with open(log_index_filename(), "w") as f:
+        for seq, start in g_log_segments:
+            f.write("%d %s\n" % (seq, start))
+
+def log_open():
+    """
+    Read the segment index and open the newest segment for appending, starting
+    a new index if there's none
+    """
+    global g_log_file, g_log_file_size, g_log_segments
+
+    g_log_segments = []
+    try:
+        with open(log_index_filename(), "r") as f:
+            for l in f:
+                seq, start = l.strip().split(" ", 1)
+                g_log_segments.append((int(seq), start))
+
+    except OSError:
+        # No index
+        pass
+
+    if (len(g_log_segments) == 0):
+        g_log_segments.append((0, log_timestamp().strip()))
+        try:
+            # Keep the log from before segments were used as the first
+            # segment
+            os.rename(g_log_filename, log_segment_filename(0))
+
+        except OSError:
+            pass
+        log_write_index()
+
+    filename = log_segment_filename(g_log_segments[-1][0])
+    try:
+        g_log_file_size = os.stat(filename)[6]
+
+    except OSError:
+        # The file doesn't exist
+        g_log_file_size = 0
+
+    g_log_file = open(filename, "ab")
+
+def log_rotate():
+    """
+    Start a new segment, deleting the oldest segments over the max number of
+    segments
+    """
+    global g_log_file, g_log_file_size
+
+    g_log_file.close()
+    g_log_file = None
+
+    seq = g_log_segments[-1][0] + 1
+    log_info("Starting log segment %d", seq, stdout_only=True)
+    g_log_segments.append((seq, log_timestamp().strip()))
+    while (len(g_log_segments) > g_max_log_segments):
+        old_seq, _ = g_log_segments.pop(0)
+        try:
+            os.remove(log_segment_filename(old_seq))
+
+        except OSError:
+            pass
+    log_write_index()
+
+    g_log_file = open(log_segment_filename(seq), "wb")
+    g_log_file_size = 0
+
+def log_file_write(b):
+    global g_log_file_size
+
+    if (g_log_file is None):
+        log_open()
+
+    if ((g_log_file_size > 0) and (g_log_file_size + len(b) > g_max_log_size_bytes)):
+        log_rotate()
+
+    g_log_file.write(b)
+    g_log_file.flush()
+    g_log_file_size += len(b)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import gc
 import machine
 import time
 
@@ -7,11 +8,19 @@ import time
 # See https://forum.micropython.org/viewtopic.php?t=7457
 time.sleep(5)
 
+# Report the heap used by importing the local modules (which includes compiling
+# them unless they were deployed as .mpy), deploy.py waits for this report
+gc.collect()
+boot_mem_free = gc.mem_free()
+
 import lessmostat
-from logging import log_set_filename, log_exception
+from logging import log_set_filename, log_exception, log_info
 
 log_set_filename("lessmostat.log")
 
+gc.collect()
+log_info("Boot heap free %d before imports, %d after imports", boot_mem_free, gc.mem_free())
+
 # XXX Could this use multiprocess so the webrepl can be used at the same time?
 try:
     lessmostat.main()
@@ -21,7 +21,8 @@ import ujson as json
 
 from umqtt_simple import MQTTClient
 
-from logging import log_info, log_exception
+from logging import log_debug, log_info, log_exception
+from outbox import outbox_count, outbox_peek, outbox_pop, outbox_put
 from syncedtime import get_epoch
 
 # XXX This should be in some utils file?
@@ -42,8 +43,19 @@ def timestamp_message(msg):
     msg["ts"] = get_epoch()
     return msg
 
-def mqtt_create(mqtt_broker, client_id, topic_root, callback):
-    log_info("Creating MQTT client id %s for broker %s and topic %s" % (client_id, mqtt_broker, topic_root))
+# Message keys that identify a message on these subtopics, a message with the
+# same key as the previous buffered message on the same subtopic is superseded
+# by it, see outbox_put
+outbox_coalesce_keys = {
+    "info/sensor" : ("temp", "humid"),
+}
+
+def mqtt_create(mqtt_broker, client_id, topic_root, callback, outbox=None):
+    """
+    @param outbox outbox where messages are buffered while disconnected from
+           the broker, see outbox_create, None to drop them
+    """
+    log_info("Creating MQTT client id %s for broker %s and topic %s", client_id, mqtt_broker, topic_root)
     if (not topic_root.endswith("/")):
         topic_root += "/"
 
@@ -55,6 +67,12 @@ def mqtt_create(mqtt_broker, client_id, topic_root, callback):
         "id" : client_id,
         "client" : client,
         "connected" : False,
+        # State keys changed since the last state publish, key to None if the
+        # whole value changed or to a list of changed keys for "config"
+        "state_dirty" : {},
+        # Subtopic to encoded full topic, see mqtt_topic
+        "topics" : {},
+        "outbox" : outbox,
     }
 
     client.set_callback(partial(callback, d))
@@ -62,30 +80,82 @@ def mqtt_create(mqtt_broker, client_id, topic_root, callback):
     return d
 
 def mqtt_connect(client):
-    log_info("Connecting %s with MQTT broker %s" % (client["id"], client["broker"]))
+    log_info("Connecting %s with MQTT broker %s", client["id"], client["broker"])
     try:
         # This raises EHOSTUNREACH (errno 113), ECONNABORTED (errno 103)
         client["client"].connect()
         client["connected"] = True
 
-        client["client"].subscribe(str_to_bytes(client["topic_root"] + "control/+"))
+        client["client"].subscribe(mqtt_topic(client, "control/+"))
 
     except Exception as e:
         log_exception("Exception connecting to MQTT", e)
 
-def mqtt_publish_message(client, subtopic, msg):
-    log_info("Publishing client %s subtopic %s" % (client["id"], subtopic), True)
-    js = json.dumps(timestamp_message(msg))
+def mqtt_topic(client, subtopic):
+    """
+    Return the full topic for the subtopic as bytes, the topics are encoded once
+    and cached since only a few fixed subtopics are used
+    """
+    topics = client["topics"]
+    topic = topics.get(subtopic, None)
+    if (topic is None):
+        topic = str_to_bytes(client["topic_root"] + subtopic)
+        topics[subtopic] = topic
+
+    return topic
+
+def mqtt_publish_message(client, subtopic, msg, retain=False, qos=0, buffer=True):
+    """
+    Timestamp the message and publish it as JSON
+
+    @param qos 0 or 1, QoS 1 messages are acknowledged asynchronously as
+           mqtt_check_msg is called and retransmitted on reconnection
+    @param buffer buffer the message in the outbox if it can't be published,
+           False for messages that are superseded on reconnection anyway
+    """
+    log_debug("Publishing client %s subtopic %s", client["id"], subtopic, stdout_only=True)
+    js = str_to_bytes(json.dumps(timestamp_message(msg)))
+    keys = outbox_coalesce_keys.get(subtopic, None)
+    key = None if (keys is None) else tuple([msg[k] for k in keys])
+
+    mqtt_publish_payload(client, subtopic, js, retain, qos, buffer, key)
+
+def mqtt_publish_payload(client, subtopic, payload, retain=False, qos=0, buffer=True, key=None):
+    """
+    Publish the payload as is, see mqtt_publish_message
+
+    @param payload bytes or bytearray, can be reused by the caller after this
+           returns
+    @param key key to coalesce the message with the previous one if buffered,
+           see outbox_put
+    """
+    outbox = client["outbox"]
+    if (buffer and (outbox is not None) and 
+        ((not client["connected"]) or (outbox_count(outbox) > 0))):
+        # Buffer if disconnected, and also if there are buffered messages
+        # pending so messages are published in order
+        # Note the payload is copied since the caller may reuse it
+        outbox_put(outbox, (subtopic, bytes(payload), retain, qos), key)
+        return
+
     try:
         # This raises OSERROR (-1), ENOTCONN (errno 107), ECONNRESET (errno
         # 114), ECONNABORTED (errno 113) on error
-        client["client"].publish(str_to_bytes(client["topic_root"] + subtopic), str_to_bytes(js))
+        pid = client["client"].publish(mqtt_topic(client, subtopic), payload, retain, qos)
+        if (pid is None):
+            # Too many QoS 1 messages waiting for PUBACK, buffer it until
+            # mqtt_check_msg processes some, this also buffers the messages
+            # after it so they are published in order
+            if (outbox is not None):
+                outbox_put(outbox, (subtopic, bytes(payload), retain, qos))
+            else:
+                log_info("Dropping QoS 1 message on subtopic %s, too many in flight", subtopic)
     
     except OSError as e:
         # Ignore connection errors when publishing messages, let check_msg in
         # the main loop retry the connection and subscribe
         # Log only to stdout, as this can be noisy
-        log_exception("Exception publishing message", e, True)
+        log_exception("Exception publishing message", e, stdout_only=True)
         # Some errors (eg router rebooting) are caught by publish but not by
         # check_msg, forward the error to check_msg to retry the connection,
         # since retrying the connection on every publish would be too noisy
@@ -94,8 +164,101 @@ def mqtt_publish_message(client, subtopic, msg):
         #     check_msg?
         client["connected"] = False
 
+        # QoS 1 messages are already kept in flight by the client and will be
+        # retransmitted on reconnection
+        if (buffer and (outbox is not None) and (qos == 0)):
+            outbox_put(outbox, (subtopic, bytes(payload), retain, qos))
+
+def mqtt_drain_outbox(client, max_messages):
+    """
+    Publish up to max_messages buffered messages, oldest first
+
+    @return number of messages left in the outbox
+    """
+    outbox = client["outbox"]
+    if (outbox is None):
+        return 0
+
+    while ((max_messages > 0) and client["connected"]):
+        message = outbox_peek(outbox)
+        if (message is None):
+            break
+        max_messages -= 1
+
+        subtopic, js, retain, qos = message
+        log_debug("Publishing buffered client %s subtopic %s", client["id"], subtopic, stdout_only=True)
+        try:
+            pid = client["client"].publish(mqtt_topic(client, subtopic), js, retain, qos)
+
+        except OSError as e:
+            log_exception("Exception publishing buffered message", e, stdout_only=True)
+            client["connected"] = False
+            if (qos > 0):
+                # QoS 1 messages are kept in flight by the client if
+                # publishing fails, pop so they are not buffered twice
+                outbox_pop(outbox)
+            break
+
+        if (pid is None):
+            # Too many QoS 1 messages waiting for PUBACK, keep it buffered
+            # until mqtt_check_msg processes some
+            break
+        outbox_pop(outbox)
+
+    return outbox_count(outbox)
+
 def mqtt_publish_state_message(client, state):
-    mqtt_publish_message(client, "info/state", { 'state' : state } )
+    """
+    Publish the full state snapshot, retained so new subscribers get it without
+    having to request it. Only done on request and on (re)connect, otherwise
+    only the changes are published with mqtt_publish_state_delta
+    """
+    # The snapshot has all the changes
+    client["state_dirty"] = {}
+    mqtt_publish_message(client, "info/state", { 'state' : state }, True, 0, False)
+
+def mqtt_state_changed(client, key, config_key=None):
+    """
+    Mark state[key] or state["config"][config_key] as changed since the last
+    state publish
+    """
+    dirty = client["state_dirty"]
+    if (config_key is None):
+        dirty[key] = None
+
+    else:
+        config_keys = dirty.get(key, [])
+        # None means the whole value is already dirty
+        if ((config_keys is not None) and (config_key not in config_keys)):
+            config_keys.append(config_key)
+            dirty[key] = config_keys
+
+def mqtt_publish_state_delta(client, state):
+    """
+    Publish the state keys changed since the last state publish, if any.
+
+    The delta message has the same layout as the state message but only with
+    the changed keys, eg { "state" : { "config" : { "ac_rules" : [...] } } }
+
+    Note the sensor values are not tracked, they are published on info/sensor
+    """
+    dirty = client["state_dirty"]
+    if (len(dirty) == 0):
+        return
+
+    delta = {}
+    for key, config_keys in dirty.items():
+        if (config_keys is None):
+            delta[key] = state[key]
+
+        else:
+            value = state[key]
+            delta[key] = { config_key : value[config_key] for config_key in config_keys }
+
+    # Note if this fails to publish the delta is lost, but the full state is
+    # published on reconnect
+    client["state_dirty"] = {}
+    mqtt_publish_message(client, "info/state_delta", { 'state' : delta }, False, 0, False)
 
 def mqtt_check_msg(client):
     # XXX Move reconnection on exception here instead of pushing to the caller?
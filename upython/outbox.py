@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Bounded buffer of outgoing MQTT messages for when the broker is unreachable
+
+Messages are kept in a RAM ring and, if a spill file is configured, the oldest
+messages are moved to a ring of fixed-size records in that file once the RAM
+ring is full. Once both are full, the oldest messages are evicted. Messages are
+taken oldest first, ie first from the spill file and then from RAM.
+
+Each message is a (subtopic, payload bytes, retain, qos) tuple. The spill file
+is only used while there are buffered messages and is not preserved across
+reboots.
+"""
+import ustruct as struct
+
+from logging import log_exception
+
+def outbox_create(max_messages, spill_filename=None, max_spill_messages=0, spill_record_size=128):
+    """
+    @param max_messages number of messages kept in RAM
+    @param spill_filename file to move messages to when the RAM ring is full,
+           None to evict them instead
+    @param max_spill_messages number of records in the spill file, the file
+           is at most max_spill_messages * spill_record_size bytes
+    @param spill_record_size size of each record in the spill file, messages
+           that don't fit in a record are evicted instead of spilled
+    """
+    return {
+        "ram" : [None] * max_messages,
+        "ram_head" : 0,
+        "ram_count" : 0,
+        # Subtopic to key of the newest message on that subtopic, see
+        # outbox_put
+        "last_keys" : {},
+
+        "spill_filename" : spill_filename,
+        "spill_file" : None,
+        "max_spill_messages" : max_spill_messages if (spill_filename is not None) else 0,
+        "spill_record_size" : spill_record_size,
+        "spill_head" : 0,
+        "spill_count" : 0,
+        # Message at spill_head, cached so peek and pop only read it once
+        "spill_peeked" : None,
+
+        "coalesced_count" : 0,
+        "evicted_count" : 0,
+    }
+
+def outbox_count(outbox):
+    return outbox["spill_count"] + outbox["ram_count"]
+
+def spill_encode(outbox, message):
+    subtopic, payload, retain, qos = message
+    # Records are the 2-byte length of the data followed by the subtopic, a tab,
+    # the retain and qos flags as a digit, a tab and the payload
+    data = bytes(subtopic, "utf-8") + b"\t" + bytes([0x30 + (int(retain) | (qos << 1))]) + b"\t" + payload
+    if (len(data) + 2 > outbox["spill_record_size"]):
+        return None
+
+    return struct.pack("!H", len(data)) + data
+
+def spill_decode(record):
+    (sz,) = struct.unpack("!H", record[:2])
+    subtopic, flags, payload = record[2:2 + sz].split(b"\t", 2)
+    flags = flags[0] - 0x30
+
+    return (subtopic.decode("utf-8"), payload, bool(flags & 1), flags >> 1)
+
+def spill_put(outbox, message):
+    """
+    Write the message to the spill file, evicting the oldest spilled message if
+    the file is full
+
+    @return False if the message couldn't be spilled
+    """
+    record = spill_encode(outbox, message)
+    if (record is None):
+        return False
+
+    try:
+        f = outbox["spill_file"]
+        if (f is None):
+            # Truncate any file left from a previous run
+            f = open(outbox["spill_filename"], "wb")
+            f.close()
+            f = open(outbox["spill_filename"], "r+b")
+            outbox["spill_file"] = f
+
+        max_spill_messages = outbox["max_spill_messages"]
+        if (outbox["spill_count"] == max_spill_messages):
+            outbox["spill_head"] = (outbox["spill_head"] + 1) % max_spill_messages
+            outbox["spill_count"] -= 1
+            outbox["spill_peeked"] = None
+            outbox["evicted_count"] += 1
+
+        # Note the records are always written in order from the start of the
+        # file since the head is reset when the file is emptied, so there are
+        # no gaps in the file
+        i = (outbox["spill_head"] + outbox["spill_count"]) % max_spill_messages
+        f.seek(i * outbox["spill_record_size"])
+        f.write(record)
+        outbox["spill_count"] += 1
+
+    except Exception as e:
+        log_exception("Exception spilling message", e)
+        return False
+
+    return True
+
+def outbox_put(outbox, message, key=None):
+    """
+    Add a message to the outbox, evicting the oldest messages if full
+
+    @param message (subtopic, payload bytes, retain, qos) tuple
+    @param key if not None and equal to the key of the newest message in the
+           outbox for the same subtopic, the message is superseded by it and
+           dropped, eg (temp, humid) for sensor samples so the buffered samples
+           are only the changes
+    """
+    ram = outbox["ram"]
+    max_messages = len(ram)
+    ram_count = outbox["ram_count"]
+    last_keys = outbox["last_keys"]
+    subtopic = message[0]
+
+    if ((key is not None) and (last_keys.get(subtopic, None) == key)):
+        outbox["coalesced_count"] += 1
+        return
+
+    if (ram_count == max_messages):
+        # Move the oldest message in RAM to the spill file or evict it
+        ram_head = outbox["ram_head"]
+        oldest = ram[ram_head]
+        ram[ram_head] = None
+        outbox["ram_head"] = (ram_head + 1) % max_messages
+        ram_count -= 1
+        if ((outbox["max_spill_messages"] == 0) or (not spill_put(outbox, oldest))):
+            outbox["evicted_count"] += 1
+
+    ram[(outbox["ram_head"] + ram_count) % max_messages] = message
+    outbox["ram_count"] = ram_count + 1
+    last_keys[subtopic] = key
+
+def outbox_peek(outbox):
+    """
+    @return the oldest message in the outbox, None if empty
+    """
+    if (outbox["spill_count"] > 0):
+        message = outbox["spill_peeked"]
+        if (message is None):
+            record_size = outbox["spill_record_size"]
+            f = outbox["spill_file"]
+            f.seek(outbox["spill_head"] * record_size)
+            message = spill_decode(f.read(record_size))
+            outbox["spill_peeked"] = message
+
+        return message
+
+    if (outbox["ram_count"] > 0):
+        return outbox["ram"][outbox["ram_head"]]
+
+    return None
+
+def outbox_pop(outbox):
+    """
+    Remove the oldest message in the outbox
+    """
+    if (outbox["spill_count"] > 0):
+        outbox["spill_peeked"] = None
+        outbox["spill_count"] -= 1
+        if (outbox["spill_count"] == 0):
+            # Restart from the beginning of the file. Keep the file open so
+            # it's not created again on every outage, it's truncated on the
+            # next reboot
+            outbox["spill_head"] = 0
+
+        else:
+            outbox["spill_head"] = (outbox["spill_head"] + 1) % outbox["max_spill_messages"]
+
+    elif (outbox["ram_count"] > 0):
+        ram = outbox["ram"]
+        ram[outbox["ram_head"]] = None
+        outbox["ram_head"] = (outbox["ram_head"] + 1) % len(ram)
+        outbox["ram_count"] -= 1
+        if (outbox["ram_count"] == 0):
+            # The RAM is drained last, so the outbox is empty
+            outbox["last_keys"] = {}
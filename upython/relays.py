@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Non-blocking relay driver
+
+Relay commands are queued and written to the relay board UART from the main
+loop tick, enforcing the minimum interval between writes the relay board
+needs without sleeping. A command for a relay that already has a pending
+command supersedes it, and commands that would leave the relay in the state it
+was last sent are dropped.
+"""
+import time
+
+from logging import log_info
+
+# See
+# http://www.icstation.com/esp8266-wifi-channel-relay-module-smart-home-remote-control-switch-android-phone-control-transmission-distance-100m-p-12592.html
+# https://www.icstation.com/esp8266-wifi-channel-relay-module-remote-control-switch-wireless-transmitter-smart-home-p-13420.html
+# The commands are [0xA0, relay, on, checksum], eg
+# relay_1_off = [0xA0, 0x01, 0x00, 0xA1]
+# relay_1_on = [0xA0, 0x01, 0x1, 0xA2]
+# relay_4_on = [0xA0, 0x04, 0x01, 0xA5]
+max_relays = 4
+relay_commands = [
+    (bytes([0xA0, relay, 0x00, 0xA0 + relay]), bytes([0xA0, relay, 0x01, 0xA0 + relay + 1]))
+    for relay in range(max_relays + 1)
+]
+
+# XXX Looks like some delay is needed between uart writes otherwise the second
+#     write is lost and the relay state is not modified. This is the case even
+#     with some code between uart writes
+default_min_write_interval_ms = 1000
+
+def relays_create(uart, min_write_interval_ms=default_min_write_interval_ms):
+    return {
+        "uart" : uart,
+        "min_write_interval_ms" : min_write_interval_ms,
+        "last_write_ticks" : None,
+        # Relay number to the last on/off sent, missing if unknown
+        "sent" : {},
+        # Relay numbers with pending commands in sending order, and relay
+        # number to pending on/off
+        "queue" : [],
+        "pending" : {},
+        "written_count" : 0,
+        "coalesced_count" : 0,
+    }
+
+def relays_set(relays, relay, on):
+    """
+    Queue a command to turn the given relay on or off
+    """
+    pending = relays["pending"]
+    queue = relays["queue"]
+    if (relay in pending):
+        # The new command supersedes the pending one, which is removed from
+        # the queue. Note the new one is queued at the end instead of replacing
+        # the pending one in place, so the queue follows the order of the
+        # latest commands (eg fan on before ac on even if there were pending
+        # fan off and ac off commands in the opposite order)
+        relays["coalesced_count"] += 1
+        queue.remove(relay)
+        del pending[relay]
+
+    # Drop commands that would leave the relay in the state last sent, eg an on
+    # followed by an off before the on was sent
+    if (relays["sent"].get(relay, None) != on):
+        queue.append(relay)
+        pending[relay] = on
+
+def relays_tick(relays):
+    """
+    Write the next queued command if the minimum interval since the previous
+    write has elapsed, never blocks
+
+    @return True if a command was written
+    """
+    queue = relays["queue"]
+    if (len(queue) == 0):
+        return False
+
+    now_ticks = time.ticks_ms()
+    last_write_ticks = relays["last_write_ticks"]
+    if ((last_write_ticks is not None) and
+        (time.ticks_diff(now_ticks, last_write_ticks) < relays["min_write_interval_ms"])):
+        return False
+
+    relay = queue.pop(0)
+    on = relays["pending"].pop(relay)
+    log_info("Writing relay %d %s", relay, "on" if on else "off", stdout_only=True)
+    relays["uart"].write(relay_commands[relay][1 if on else 0])
+    relays["sent"][relay] = on
+    relays["last_write_ticks"] = now_ticks
+    relays["written_count"] += 1
+
+    return True
+
+def relays_pending(relays):
+    return len(relays["queue"])
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Compiled rule engine
+
+The ac, heat and fan rules in state["config"] are compiled into integer
+thresholds once per configuration change, and the rules are only evaluated
+when either a new sensor sample or a rule change arrived, instead of on every
+iteration of the main loop.
+
+A compiled ac/heat rule is a tuple
+    (ac_heat, temp_on, temp_off, humid_on, humid_off)
+where ac_heat is "ac" or "heat" and the rest are decidegrees/decipercents
+comparison values (None if the rule doesn't have temp or humid):
+- cooling turns on at temp >= temp_on and off at temp <= temp_off
+- heating turns on at temp <= temp_on and off at temp >= temp_off
+- both turn on at humid >= humid_on and off at humid <= humid_off
+
+The temperature off thresholds can be moved towards the rule temperature by
+an anticipation, so the ac/heat stops early enough for the temperature to
+coast to the off threshold instead of past it, see rules_set_anticipation and
+thermal.py
+"""
+from logging import log_info
+
+# Compiled rules, None if they need to be compiled from the config
+g_ac_heat_rules = None
+g_fan_rules = None
+# Latest sensor sample in decidegrees and decipercents
+g_temp_decidegs = None
+g_humid_decihumids = None
+# Set when the rules need to be evaluated, ie a new sample arrived, the rules
+# changed or the last evaluation modified the relay state
+g_dirty = True
+# Decidegrees to stop the ac and the heat before their off thresholds
+g_ac_anticipation_decidegs = 0
+g_heat_anticipation_decidegs = 0
+
+def rules_compile(config, ac_anticipation_decidegs=0, heat_anticipation_decidegs=0):
+    """
+    Compile the config rules, return a tuple with the ac_heat and the fan
+    compiled rules
+
+    @param ac_anticipation_decidegs, heat_anticipation_decidegs decidegrees to
+           move the off thresholds towards the rule temperature, at most up to
+           the rule temperature and always short of the on threshold
+    """
+    lo_threshold_decidegs = config["lo_threshold_decidegs"]
+    hi_threshold_decidegs = config["hi_threshold_decidegs"]
+    lo_threshold_decihumids = config["lo_threshold_decihumids"]
+    hi_threshold_decihumids = config["hi_threshold_decihumids"]
+
+    ac_heat_rules = []
+    # Note ac rules go before heat rules so heating can be turned on in the same
+    # evaluation the ac was turned off, but not the converse, see the comments
+    # in rules_check
+    for ac_heat in ["ac", "heat"]:
+        heating = (ac_heat == "heat")
+        for rule in config["%s_rules" % ac_heat]:
+            # Rules that are not "on" never trigger anything, don't even
+            # bother compiling them
+            if (rule["state"] != "on"):
+                continue
+
+            temp_on = None
+            temp_off = None
+            rule_temp = rule.get("temp", None)
+            if (rule_temp is not None):
+                under_threshold = int(round(rule_temp * 10)) - lo_threshold_decidegs
+                over_threshold = int(round(rule_temp * 10)) + hi_threshold_decidegs
+                if (heating):
+                    anticipation = min(heat_anticipation_decidegs, hi_threshold_decidegs,
+                        lo_threshold_decidegs + hi_threshold_decidegs - 1)
+                    temp_on, temp_off = under_threshold, over_threshold - max(0, anticipation)
+                else:
+                    anticipation = min(ac_anticipation_decidegs, lo_threshold_decidegs,
+                        lo_threshold_decidegs + hi_threshold_decidegs - 1)
+                    temp_on, temp_off = over_threshold, under_threshold + max(0, anticipation)
+
+            humid_on = None
+            humid_off = None
+            rule_humid = rule.get("humid", None)
+            if (rule_humid is not None):
+                humid_on = int(round(rule_humid * 10)) + hi_threshold_decihumids
+                humid_off = int(round(rule_humid * 10)) - lo_threshold_decihumids
+
+            ac_heat_rules.append((ac_heat, temp_on, temp_off, humid_on, humid_off))
+
+    fan_rules = tuple([rule["state"] for rule in config["fan_rules"]])
+
+    return (tuple(ac_heat_rules), fan_rules)
+
+def rules_invalidate():
+    """
+    Force a recompilation and evaluation of the rules, to be called whenever
+    the config rules or thresholds are modified
+    """
+    global g_ac_heat_rules, g_fan_rules, g_dirty
+    g_ac_heat_rules = None
+    g_fan_rules = None
+    g_dirty = True
+
+def rules_set_anticipation(ac_decidegs, heat_decidegs):
+    """
+    Set how many decidegrees before the off threshold the ac and the heat
+    should stop, the rules are recompiled if they changed
+    """
+    global g_ac_anticipation_decidegs, g_heat_anticipation_decidegs
+    if ((ac_decidegs != g_ac_anticipation_decidegs) or (heat_decidegs != g_heat_anticipation_decidegs)):
+        log_info("Setting anticipation to ac %d heat %d", ac_decidegs, heat_decidegs)
+        g_ac_anticipation_decidegs = ac_decidegs
+        g_heat_anticipation_decidegs = heat_decidegs
+        rules_invalidate()
+
+def rules_set_sensor(temp, humid):
+    """
+    Set a new sensor sample in degrees and percentage, the rules will be
+    evaluated on the next rules_check call
+    """
+    global g_temp_decidegs, g_humid_decihumids, g_dirty
+    g_temp_decidegs = int(round(temp * 10))
+    g_humid_decihumids = int(round(humid * 10))
+    g_dirty = True
+
+def rules_pending():
+    """
+    Return True if the latest sensor sample or rule change hasn't been
+    evaluated by rules_check yet
+    """
+    return (g_dirty and (g_temp_decidegs is not None))
+
+def rules_check(state, turn_ac_heat, turn_fan):
+    """
+    Evaluate the rules if anything changed since the last evaluation
+
+    @param turn_ac_heat function taking ac_heat ("ac" or "heat") and on
+    @param turn_fan function taking on
+    @return number of relay state changes
+    """
+    global g_ac_heat_rules, g_fan_rules, g_dirty
+
+    if ((not g_dirty) or (g_temp_decidegs is None)):
+        return 0
+
+    g_dirty = False
+    if (g_ac_heat_rules is None):
+        log_info("Compiling rules")
+        g_ac_heat_rules, g_fan_rules = rules_compile(state["config"],
+            g_ac_anticipation_decidegs, g_heat_anticipation_decidegs)
+
+    temp = g_temp_decidegs
+    humid = g_humid_decihumids
+    changes = 0
+
+    # XXX Note heating/cooling assumes the right wire (white heating
+    #     / yellow for cooling) is being driven by the ac_on relay.
+    #     Ideally this should use a three or four-channel relay,
+    #     another option is to connect the green wire (fan) to both,
+    #     drive heating with the current fan relay the and lose
+    #     independent fan control?
+    for (ac_heat, temp_on, temp_off, humid_on, humid_off) in g_ac_heat_rules:
+        # XXX In heating mode the AC seems to wait for around one
+        #     minute to turn the fan off, there should be a way to
+        #     put that safety rule
+
+        # XXX This will turn heating on in the same iteration ac is
+        #     turned off and without intervening fan turning off,
+        #     should wait some time? (for the converse, ac & fan are
+        #     not turned on until the next evaluation because
+        #     heat rules are processed after ac rules)
+        heating = (ac_heat == "heat")
+        ac_heat_state = state[ac_heat]
+        turn_ac_heat_on_count = 0
+        turn_ac_heat_off_count = 0
+
+        if (temp_on is not None):
+            if (heating):
+                wants_on = (temp <= temp_on)
+                wants_off = (temp >= temp_off)
+            else:
+                wants_on = (temp >= temp_on)
+                wants_off = (temp <= temp_off)
+
+            if ((ac_heat_state != "on") and wants_on):
+                turn_ac_heat_on_count += 1
+
+            elif ((ac_heat_state != "off") and wants_off):
+                turn_ac_heat_off_count += 1
+
+        if (humid_on is not None):
+            if ((ac_heat_state != "on") and (humid >= humid_on)):
+                turn_ac_heat_on_count += 1
+
+            elif ((ac_heat_state != "off") and (humid <= humid_off)):
+                turn_ac_heat_off_count += 1
+
+        # Turn AC on if any of temp or humid require it, turn off if both temp
+        # and humid require it
+        #
+        # Note that due how thresholds work it's possible that the AC gets
+        # turned on because of temp, but once below the temp threshold it's
+        # kept on because of not being below the humid threshold. This seems ok
+        # even if non-obvious, other option would be to keep track of the rule
+        # that enabled the ac and only allow that one to keep it on, but would
+        # complicate the logic for little benefit?
+        if (turn_ac_heat_on_count >= 1):
+            log_info("Starting %s, on %d off %d", ac_heat, turn_ac_heat_on_count, turn_ac_heat_off_count)
+            turn_ac_heat(ac_heat, True)
+
+        elif (turn_ac_heat_off_count == 2):
+            log_info("Stopping %s, on %d off %d", ac_heat, turn_ac_heat_on_count, turn_ac_heat_off_count)
+            turn_ac_heat(ac_heat, False)
+
+        # turn_ac_heat can ignore the request (eg turning ac on with heat on),
+        # only count effective changes
+        if (state[ac_heat] != ac_heat_state):
+            changes += 1
+
+    ac_or_heat_on = ((state["heat"] == "on") or (state["ac"] == "on"))
+    for rule_state in g_fan_rules:
+        fan_state = state["fan"]
+        if ((rule_state == "on") and (fan_state != "on")):
+            log_info("Starting fan")
+            turn_fan(True)
+
+        elif ((rule_state == "auto") and ((fan_state == "on") != ac_or_heat_on)):
+            # Auto fan needs to be on if any of heat or ac are on
+            # Note that in reality this code will only run to turn
+            # the fan off, the fan is turned on unconditionally for
+            # safety reasons at ac turn on time
+            log_info("Matching fan to ac/heat")
+            turn_fan(ac_or_heat_on)
+
+        if (state["fan"] != fan_state):
+            changes += 1
+
+    # Changing the relay state can enable other rules (eg ac can't be turned on
+    # while heat is on until the heat rule turns heat off), evaluate again on
+    # the next check until there are no changes
+    if (changes > 0):
+        g_dirty = True
+
+    return changes
+
+def rules_threshold_distances(state):
+    """
+    Return the distance from the latest sensor sample to the nearest threshold
+    that would change the ac/heat state, ie the on threshold if off and the off
+    threshold if on
+
+    Thresholds already reached are ignored, since the change then depends on
+    the other value (eg turning the ac off needs both temperature and humidity
+    under their thresholds) or is about to happen anyway
+
+    @return tuple with the temperature distance in decidegrees and the humidity
+            distance in decipercents, None if there are no rules, no sample or
+            all the thresholds have been reached
+    """
+    global g_ac_heat_rules, g_fan_rules
+
+    if (g_temp_decidegs is None):
+        return (None, None)
+
+    if (g_ac_heat_rules is None):
+        log_info("Compiling rules")
+        g_ac_heat_rules, g_fan_rules = rules_compile(state["config"],
+            g_ac_anticipation_decidegs, g_heat_anticipation_decidegs)
+
+    temp = g_temp_decidegs
+    humid = g_humid_decihumids
+    temp_distance = None
+    humid_distance = None
+    for (ac_heat, temp_on, temp_off, humid_on, humid_off) in g_ac_heat_rules:
+        on = (state[ac_heat] == "on")
+        if (temp_on is not None):
+            if (ac_heat == "heat"):
+                distance = (temp_off - temp) if on else (temp - temp_on)
+            else:
+                distance = (temp - temp_off) if on else (temp_on - temp)
+            if ((distance > 0) and ((temp_distance is None) or (distance < temp_distance))):
+                temp_distance = distance
+
+        if (humid_on is not None):
+            distance = (humid - humid_off) if on else (humid_on - humid)
+            if ((distance > 0) and ((humid_distance is None) or (distance < humid_distance))):
+                humid_distance = distance
+
+    return (temp_distance, humid_distance)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Adaptive sensor sampling period
+
+The period between sensor samples starts at the minimum period and
+- doubles after every sample where the values didn't change by more than the
+  sensor resolution, up to the maximum period
+- halves after every sample where the values changed by more than that
+- drops to the minimum period when a value is within a few tenths of a rule
+  threshold or the relays changed (eg right after the AC turned on)
+- is capped to half the time it would take to reach a rule threshold at the
+  current rate of change, so the threshold crossing is sampled promptly
+"""
+import time
+
+def sampler_create(min_period_ms, max_period_ms, near_decidegs=2, near_decihumids=10):
+    """
+    @param near_decidegs distance to a temperature threshold at which to sample
+           at the minimum period
+    @param near_decihumids distance to a humidity threshold at which to sample
+           at the minimum period
+    """
+    return {
+        "min_period_ms" : min_period_ms,
+        "max_period_ms" : max_period_ms,
+        "near_decidegs" : near_decidegs,
+        "near_decihumids" : near_decihumids,
+        "period_ms" : min_period_ms,
+        "last_ticks" : None,
+        "last_temp" : None,
+        "last_humid" : None,
+        "last_relays" : None,
+    }
+
+def sampler_next_period(sampler, temp, humid, temp_distance, humid_distance, relays):
+    """
+    Return the period to wait until the next sample given the current sample
+
+    @param temp current temperature in decidegrees
+    @param humid current humidity in decipercents
+    @param temp_distance distance to the nearest temperature threshold in
+           decidegrees, None if no threshold, see rules_threshold_distances
+    @param humid_distance distance to the nearest humidity threshold in
+           decipercents, None if no threshold
+    @param relays any value that changes when the relays change
+    """
+    now_ticks = time.ticks_ms()
+    min_period_ms = sampler["min_period_ms"]
+    period_ms = sampler["period_ms"]
+
+    if (sampler["last_ticks"] is None):
+        period_ms = min_period_ms
+
+    else:
+        elapsed_ms = time.ticks_diff(now_ticks, sampler["last_ticks"])
+        temp_change = abs(temp - sampler["last_temp"])
+        humid_change = abs(humid - sampler["last_humid"])
+
+        # Ignore single step changes, the DHT22 toggles between consecutive
+        # values even if stable
+        if ((temp_change > 1) or (humid_change > 1)):
+            period_ms //= 2
+        else:
+            period_ms *= 2
+
+        for distance, change, near in (
+            (temp_distance, temp_change, sampler["near_decidegs"]),
+            (humid_distance, humid_change, sampler["near_decihumids"])):
+            if (distance is None):
+                continue
+
+            if (distance <= near):
+                period_ms = min_period_ms
+
+            elif (change > 0):
+                # Sample at least twice before the threshold is reached at the
+                # current rate
+                period_ms = min(period_ms, (distance * elapsed_ms) // (change * 2))
+
+        if (relays != sampler["last_relays"]):
+            period_ms = min_period_ms
+
+    period_ms = max(min_period_ms, min(period_ms, sampler["max_period_ms"]))
+
+    sampler["period_ms"] = period_ms
+    sampler["last_ticks"] = now_ticks
+    sampler["last_temp"] = temp
+    sampler["last_humid"] = humid
+    sampler["last_relays"] = relays
+
+    return period_ms
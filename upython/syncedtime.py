@@ -20,6 +20,7 @@ import time
 
 import ntptime
 
+from aio import sleep_ms
 from logging import log_info
 
 # epoch is year 2000 in MicroPython but 1970 in unix
@@ -41,9 +42,16 @@ def get_epoch():
 # (and was observed when the relays had been on for some time)
 min_ntp_sync_time = 240
 g_last_ntp_sync_time = 0
+# Whether the clock was synced with NTP at least once since boot, until then
+# the RTC counts from 2000-01-01 after a power cut
+g_ntp_synced = False
 
-def sync_time_with_ntp():
+def time_synced():
+    return g_ntp_synced
+
+async def sync_time_with_ntp():
     global g_last_ntp_sync_time
+    global g_ntp_synced
     synced = False
     
     # Correct esp2866 clock drift (several seconds per minute) by doing
@@ -55,21 +63,24 @@ def sync_time_with_ntp():
 
     # Setup the clock using ntp
     # Note ntptime.settime() is known to timeout, try a few times
+    # XXX settime itself still blocks up to its 1 second socket timeout, only
+    #     the sleeps between retries yield to other tasks
     ntp_retries = 5
     while (ntp_retries > 0):
         try:
             # This can be noisy, log only failures to file
-            log_info("Querying NTP server", True)
+            log_info("Querying NTP server", stdout_only=True)
             ntp_retries -= 1
             before = get_epoch()
             ntptime.settime()
             after = get_epoch()
             synced = True
+            g_ntp_synced = True
             # Note this drift can be ~1 second misreported either way since
             # includes the time it takes to settime (which is less than one 
             # second for the NTP query, since it has a 1 second timeout, plus 
             # whatever time for the other calculations)
-            log_info("Got NTP, drift was around %d" % (after - before), True)
+            log_info("Got NTP, drift was around %d", after - before, stdout_only=True)
             break
 
         except OSError as e:
@@ -77,16 +88,16 @@ def sync_time_with_ntp():
             # ENOENT (2) if the NTP server can't be found, normally because of
             # network down
             if (e.errno not in [errno.ETIMEDOUT, -errno.ENOENT]):
-                log_info("Unexpected NTP error %d" % e.errno)
+                log_info("Unexpected NTP error %d", e.errno)
                 raise
 
             else:
-                log_info("Timeout querying NTP, retries left %d, sleeping" % ntp_retries)
-                time.sleep(1)
+                log_info("Timeout querying NTP, retries left %d, sleeping", ntp_retries)
+                await sleep_ms(1000)
         
-        # Note this may not have sync'ed if sync_time_with_ntp hit a timeout or
-        # network down. That's ok since we still want to wait some time before
-        # trying to sync again (and possibly timeout again)
-        g_last_ntp_sync_time = get_epoch()
+    # Note this may not have sync'ed if sync_time_with_ntp hit a timeout or
+    # network down. That's ok since we still want to wait some time before
+    # trying to sync again (and possibly timeout again)
+    g_last_ntp_sync_time = get_epoch()
     
     return synced
\ No newline at end of file
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Compact binary encoding of the sensor samples
+
+A sample is 10 bytes in network order, vs. ~50 bytes for the JSON message
+- version (uint8), currently 1
+- unix epoch timestamp (uint32)
+- temperature in tenths of degree (int16)
+- humidity in tenths of percentage (uint16)
+- relay bitmask (uint8), see relay_bits
+
+This module can also be imported on the host to decode samples, see also the
+decoder in html/lessmostat.html
+"""
+try:
+    import ustruct as struct
+
+except ImportError:
+    import struct
+
+telemetry_version = 1
+telemetry_format = "!BIhHB"
+telemetry_size = struct.calcsize(telemetry_format)
+
+# State key to bit in the relay bitmask
+relay_bits = (
+    ("ac", 0x01),
+    ("heat", 0x02),
+    ("fan", 0x04),
+)
+
+def telemetry_relays(state):
+    """
+    @param state dict with the "on"/"off" relay states, see relay_bits
+    @return relay bitmask
+    """
+    relays = 0
+    for key, bit in relay_bits:
+        if (state[key] == "on"):
+            relays |= bit
+
+    return relays
+
+def telemetry_encode_into(buf, ts, temp, humid, state):
+    """
+    Encode a sensor sample into buf without allocating a new buffer
+
+    @param buf bytearray of at least telemetry_size bytes
+    @param state dict with the "on"/"off" relay states, see relay_bits
+    @return buf
+    """
+    struct.pack_into(telemetry_format, buf, 0, telemetry_version, ts,
+        int(round(temp * 10)), int(round(humid * 10)), telemetry_relays(state))
+
+    return buf
+
+def telemetry_decode(payload):
+    """
+    Decode a sensor sample
+
+    @return dict with "ts", "temp", "humid" and the "on"/"off" relay states,
+            the same keys as the JSON sensor message plus the relays
+    """
+    version, ts, temp, humid, relays = struct.unpack(telemetry_format, payload[:telemetry_size])
+    if (version != telemetry_version):
+        raise ValueError("Unsupported telemetry version %d" % version)
+
+    d = { "ts" : ts, "temp" : temp / 10.0, "humid" : humid / 10.0 }
+    for key, bit in relay_bits:
+        d[key] = "on" if (relays & bit) else "off"
+
+    return d
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2021 Antonio Tejada
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Online thermal model of the room for predictive stop and time to target
+
+The model is learned from the sensor samples and kept in a fixed size dict,
+no samples are stored
+- the temperature rate of each relay mode ("idle", "ac" or "heat"), as a
+  moving average of the rate over windows of a few minutes, ignoring the
+  first minutes after a mode change
+- the coast of the ac and heat, ie how far the temperature keeps going after
+  they stop (the evaporator is still cold, the furnace still hot, the sensor
+  lags...), as a moving average of the difference between the temperature at
+  the stop and the extreme reached before the temperature turns around
+
+The coast is how early the ac/heat needs to stop to land on the off threshold
+instead of past it, see rules_set_anticipation, and the rate of the running
+mode gives the time to reach the off threshold.
+
+The values are integers in millidegrees and millidegrees per hour.
+"""
+
+# Temperature changes the sensor can toggle between even if stable, in
+# decidegrees, the coast ends once the temperature turned around by more
+thermal_noise_decidegs = 1
+
+def thermal_create(window_secs=5 * 60, settle_secs=5 * 60, max_coast_secs=30 * 60, weight=4):
+    """
+    @param window_secs minimum seconds to measure a rate over, the sensor
+           resolution is too coarse for the rate between consecutive samples
+    @param settle_secs seconds after a mode change before measuring rates
+    @param max_coast_secs seconds to wait for the temperature to turn around
+           after a stop, if it didn't turn around at all by then the room
+           was drifting that way anyway and the coast is ignored
+    @param weight of the current average against the new measure
+    """
+    return {
+        "window_secs" : window_secs,
+        "settle_secs" : settle_secs,
+        "max_coast_secs" : max_coast_secs,
+        "weight" : weight,
+        "mode" : None,
+        "mode_ts" : None,
+        # Start of the window the current rate is measured over
+        "window_ts" : None,
+        "window_temp" : None,
+        # Learned rates and coasts, None until measured
+        "rates" : { "idle" : None, "ac" : None, "heat" : None },
+        "coasts" : { "ac" : None, "heat" : None },
+        # Coast being measured, the mode that stopped, the time and temperature
+        # of the stop and the extreme temperature since
+        "coast_mode" : None,
+        "coast_ts" : None,
+        "coast_temp" : None,
+        "coast_extreme" : None,
+    }
+
+def thermal_average(model, value, sample):
+    if (value is None):
+        return sample
+
+    # Round the correction half away from zero, floor division would always
+    # move negative corrections and never move small positive ones
+    weight = model["weight"]
+    delta = sample - value
+    if (delta >= 0):
+        return value + (delta + weight // 2) // weight
+
+    return value - (weight // 2 - delta) // weight
+
+def thermal_add(model, ts, temp, ac_on, heat_on):
+    """
+    Learn from a sensor sample
+
+    @param ts timestamp in seconds
+    @param temp temperature in decidegrees
+    @param ac_on, heat_on relay states since the previous sample
+    """
+    mode = "heat" if heat_on else ("ac" if ac_on else "idle")
+    if (mode != model["mode"]):
+        prev_mode = model["mode"]
+        model["mode"] = mode
+        model["mode_ts"] = ts
+        model["window_ts"] = None
+        # Measure the coast after a stop, a start cancels the measure
+        model["coast_mode"] = None
+        if ((mode == "idle") and (prev_mode is not None) and (prev_mode != "idle")):
+            model["coast_mode"] = prev_mode
+            model["coast_ts"] = ts
+            model["coast_temp"] = temp
+            model["coast_extreme"] = temp
+
+    coast_mode = model["coast_mode"]
+    if (coast_mode is not None):
+        cooling = (coast_mode == "ac")
+        extreme = min(temp, model["coast_extreme"]) if cooling else max(temp, model["coast_extreme"])
+        model["coast_extreme"] = extreme
+        turned = abs(temp - extreme)
+        timeout = (ts - model["coast_ts"] > model["max_coast_secs"])
+        if ((turned > thermal_noise_decidegs) or (timeout and (turned > 0))):
+            coast = (model["coast_temp"] - extreme) if cooling else (extreme - model["coast_temp"])
+            model["coasts"][coast_mode] = thermal_average(model, model["coasts"][coast_mode], coast * 100)
+            model["coast_mode"] = None
+
+        elif (timeout):
+            model["coast_mode"] = None
+
+    if (ts - model["mode_ts"] < model["settle_secs"]):
+        return
+
+    if (model["window_ts"] is None):
+        model["window_ts"] = ts
+        model["window_temp"] = temp
+        return
+
+    elapsed = ts - model["window_ts"]
+    if (elapsed >= model["window_secs"]):
+        rate = (temp - model["window_temp"]) * 100 * 3600 // elapsed
+        model["rates"][mode] = thermal_average(model, model["rates"][mode], rate)
+        model["window_ts"] = ts
+        model["window_temp"] = temp
+
+def thermal_coast(model, ac_heat):
+    """
+    @param ac_heat "ac" or "heat"
+    @return learned coast in decidegrees, 0 if not learned yet
+    """
+    coast = model["coasts"][ac_heat]
+    if ((coast is None) or (coast <= 0)):
+        return 0
+
+    return (coast + 50) // 100
+
+def thermal_eta_secs(model, ac_heat, distance):
+    """
+    @param ac_heat "ac" or "heat", the running mode
+    @param distance distance to the off threshold in decidegrees
+    @return estimated seconds to reach the off threshold, None if the rate of
+            the mode is not known or doesn't go towards the threshold
+    """
+    rate = model["rates"][ac_heat]
+    if (rate is None):
+        return None
+    if (ac_heat == "ac"):
+        rate = -rate
+    if (rate <= 0):
+        return None
+
+    return distance * 100 * 3600 // rate
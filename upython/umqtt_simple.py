@@ -22,6 +22,7 @@ class MQTTClient:
         keepalive=0,
         ssl=False,
         ssl_params={},
+        max_inflight=4,
     ):
         if port == 0:
             port = 8883 if ssl else 1883
@@ -40,11 +41,23 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # Unacknowledged QoS 1 publishes as (pid, topic, msg, retain) in sending
+        # order, at most max_inflight
+        self.inflight = []
+        self.max_inflight = max_inflight
+        # Reusable publish packet buffer, see publish()
+        self.pub_buf = None
+        self.pub_mv = None
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
         self.sock.write(s)
 
+    def _next_pid(self):
+        # Packet ids are 16-bit and 0 is not a valid id
+        self.pid = (self.pid % 0xFFFF) + 1
+        return self.pid
+
     def _recv_len(self):
         n = 0
         sh = 0
@@ -112,6 +125,10 @@ class MQTTClient:
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
+        # Retransmit the QoS 1 publishes that were not acknowledged on the
+        # previous connection
+        for pid, topic, msg, retain in self.inflight:
+            self._write_publish(topic, msg, retain, 1, pid, True)
         return resp[2] & 1
 
     def disconnect(self):
@@ -121,46 +138,71 @@ class MQTTClient:
     def ping(self):
         self.sock.write(b"\xc0\0")
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+    def _get_pub_buf(self, sz):
+        # Grow the buffer as needed but never shrink it, so the same buffer is
+        # reused for all the publishes instead of allocating per message
+        if self.pub_buf is None or len(self.pub_buf) < sz:
+            self.pub_buf = bytearray((sz + 63) & ~63)
+            self.pub_mv = memoryview(self.pub_buf)
+        return self.pub_buf
+
+    def _write_publish(self, topic, msg, retain, qos, pid, dup):
+        # Encode the whole packet into the publish buffer and write it with a
+        # single call, instead of one write per packet field, which results in
+        # several small TCP segments
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
+        # Fixed header is one byte plus up to three remaining length bytes
+        pkt = self._get_pub_buf(sz + 4)
+        mv = self.pub_mv
+        pkt[0] = 0x30 | dup << 3 | qos << 1 | retain
         i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
+        n = sz
+        while n > 0x7F:
+            pkt[i] = (n & 0x7F) | 0x80
+            n >>= 7
             i += 1
-        pkt[i] = sz
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        pkt[i] = n
+        i += 1
+        n = len(topic)
+        struct.pack_into("!H", pkt, i, n)
+        i += 2
+        mv[i : i + n] = topic
+        i += n
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+            struct.pack_into("!H", pkt, i, pid)
+            i += 2
+        n = len(msg)
+        mv[i : i + n] = msg
+        i += n
+        # print(hex(i), hexlify(pkt[:i], ":"))
+        self.sock.write(pkt, i)
+
+    # Publish a message, returns the packet id for QoS 1, 0 for QoS 0.
+    # QoS 1 doesn't wait for the PUBACK, the message is kept in flight until
+    # check_msg()/wait_msg() process its PUBACK, and retransmitted on connect()
+    # if it's not acknowledged before a reconnection. If max_inflight
+    # messages are already in flight, the message is not sent and None is
+    # returned, the caller must keep it and retry once PUBACKs are processed.
+    def publish(self, topic, msg, retain=False, qos=0):
+        assert qos < 2, "QoS 2 is not supported"
+        pid = 0
+        if qos > 0:
+            if len(self.inflight) >= self.max_inflight:
+                return None
+            pid = self._next_pid()
+            # Track it before writing so it's retransmitted on reconnect if the
+            # write fails
+            self.inflight.append((pid, topic, msg, retain))
+        self._write_publish(topic, msg, retain, qos, pid, False)
+        return pid
 
     def subscribe(self, topic, qos=0):
         assert self.cb is not None, "Subscribe callback is not set"
         pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
+        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self._next_pid())
         # print(hex(len(pkt)), hexlify(pkt, ":"))
         self.sock.write(pkt)
         self._send_str(topic)
@@ -191,6 +233,16 @@ class MQTTClient:
             assert sz == 0
             return None
         op = res[0]
+        if op == 0x40:  # PUBACK
+            sz = self.sock.read(1)
+            assert sz == b"\x02"
+            rcv_pid = self.sock.read(2)
+            rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+            for i in range(len(self.inflight)):
+                if self.inflight[i][0] == rcv_pid:
+                    del self.inflight[i]
+                    break
+            return op
         if op & 0xF0 != 0x30:
             return op
         sz = self._recv_len()